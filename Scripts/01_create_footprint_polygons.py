@@ -4,6 +4,9 @@ import numpy as np
 from os import listdir
 from os.path import isfile, join
 import trimesh
+import concurrent.futures
+import lod2_mesh_cache as lod2meshcache
+import footprint_table as footprinttable
 
 
 """
@@ -15,6 +18,9 @@ input_path               = "S:/OSS/Data/LOD2/"
 output_filename          = "S:/OSS/Data/Footprints/test_footprint_0m_dilation.txt"
 dilation_amount          = 0.0
 visualize_results        = True
+worker_count             = os.cpu_count() # Number of processes extracting the footprints from the OBJ files. Results are written in the order of the input files regardless.
+output_npz               = True # If True, the polygons are also saved into a NumPy archive next to the output file (same name, '.npz' extension), which the later scripts load faster than the text (see 'footprint_table.py')
+lod2_mesh_cache_path     = None # Folder of the LOD2 mesh cache (see 'lod2_mesh_cache.py'). If set, OBJ files are parsed only once, and read from the cache on later runs (also by '05_combine_lod2_and_point_cloud.py').
 
 def main():
                   
@@ -22,40 +28,42 @@ def main():
     file_number = 0
     output_visualization_x = []
     output_visualization_y = []
+    footprint_polygons = []
+    model_files = [os.path.join(input_path, filename) for filename in input_files]
+    if worker_count > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker_count)
+        extracted_polygons = executor.map(extract_footprint, model_files, chunksize=4)
+    else:
+        executor = None
+        extracted_polygons = map(extract_footprint, model_files)
+    for filename, polygon in zip(input_files, extracted_polygons):
+        print("Processed file #{num}: {name}".format(num=file_number, name=filename))
+        footprint_polygons.append(polygon)
+        file_number += 1
+    if executor is not None:
+        executor.shutdown()
+    
+    # Dilate all polygons at once
+    if dilation_amount > 0.0 and len(footprint_polygons) > 0:
+        footprint_polygons = dilate_polygons( footprint_polygons )
+        
     with open(output_filename, 'w') as output_file:
-        for filename in input_files:
-            
-            print("Processing file #{num}: {name}".format(num=file_number, name=filename))
-            model_file = os.path.join(input_path, filename)
-            mesh = trimesh.load(model_file, process=False, force="mesh", skip_materials=True, skip_texture=True)
-            
-            # Calculate cross section of the mesh that will represent the building footprint
-            slice_2D, to_3D = cross_section(mesh)
-            
-            # Extract the point values that define the perimeter of the polygon
-            poly = slice_2D.polygons_full[0]
-            x_coordinates, y_coordinates = poly.exterior.coords.xy
-            
-            if dilation_amount > 0.0:
-                dilated_x, dilated_y = dilate_polygon( x_coordinates, y_coordinates )
-            else:
-                dilated_x = x_coordinates
-                dilated_y = y_coordinates
-            
+        for filename, polygon in zip(input_files, footprint_polygons):
+            dilated_x = polygon[:,0]
+            dilated_y = polygon[:,1]
             building_name = filename[:-4]
             polygon_string = filename + " " + building_name + "_points.ply"
+            for i in range(len(dilated_x)):
+                polygon_string += " " + str(dilated_x[i]) + " " + str(dilated_y[i])
             if visualize_results == True:
-                vis_data_x = []
-                vis_data_y = []
-                for i in range(len(dilated_x)):
-                    polygon_string += " " + str(dilated_x[i]) + " " + str(dilated_y[i])
-                    vis_data_x.append(dilated_x[i])
-                    vis_data_y.append(dilated_y[i])
-                output_visualization_x.append(np.asarray(vis_data_x))
-                output_visualization_y.append(np.asarray(vis_data_y))
+                output_visualization_x.append(dilated_x)
+                output_visualization_y.append(dilated_y)
             polygon_string += "\n"
             output_file.write(polygon_string)
-            file_number += 1
+    if output_npz == True:
+        point_cloud_names = [filename[:-4] + "_points.ply" for filename in input_files]
+        footprints = footprinttable.create_footprint_table(input_files, point_cloud_names, footprint_polygons)
+        footprinttable.save_footprint_table(footprints, footprinttable.get_archive_filename(output_filename))
 
     if visualize_results == True:
         plt.title("Polygons")
@@ -66,6 +74,30 @@ def main():
         plt.show()
             
 
+def extract_footprint(model_file):
+    """
+    Load a LOD2 mesh, and compute its footprint polygon from a cross section near the bottom of the mesh.
+    
+    Parameters
+    ----------
+    model_file : string
+        Full path and filename of the .obj file
+    
+    Returns
+    -------
+    polygon : Numpy.array
+        Nodes ([N,2]) of the closed footprint polygon (first and last nodes are the same)
+    """
+    mesh = lod2meshcache.load_lod2_mesh(model_file, lod2_mesh_cache_path)
+    
+    # Calculate cross section of the mesh that will represent the building footprint
+    slice_2D, to_3D = cross_section(mesh)
+    
+    # Extract the point values that define the perimeter of the polygon
+    poly = slice_2D.polygons_full[0]
+    return np.array(poly.exterior.coords)
+
+
 def cross_section(mesh):
     """
     Using just the mesh.section() method together with slice.to_planar() causes the resulting polygon to be centered around origin.
@@ -97,63 +129,79 @@ def dilate_polygon( x_coordinates, y_coordinates ):
     """
     Traverse the (closed, first and last nodes are the same) polygon defined by the input coordinates, calculate each edge normal, and use them to calculate each node normal. 
     Displace each node along the normal to dilate the polygon.
+    See 'dilate_polygons()' for the details.
+    
+    Returns
+    -------
+    dilated_x : Numpy.array
+        X coordinates of the dilated polygon nodes (closed)
+    dilated_y : Numpy.array
+        Y coordinates of the dilated polygon nodes (closed)
+    """
+    dilated_polygon = dilate_polygons( [np.column_stack([x_coordinates, y_coordinates])] )[0]
+    return dilated_polygon[:,0], dilated_polygon[:,1]
+
+
+def dilate_polygons( polygons ):
+    """
+    Dilate many (closed, first and last nodes are the same) polygons at once by 'dilation_amount'. All polygons are processed together as a single array of nodes.
     For a 2D vector, if dx = x2 - x1 and dy = y2 - y1, then the possible normals are (-dy, dx) and (dy, -dx)
     Cross-product decides, which is the correct one (always stick to the same side of the line, as the polygon is traversed)
-    cp = ((x2-x1)(y3-y1))-((y2-y1)(x3-x1)), where (x3, y3) is a point being tested (just add candidate normal to either polygon node coordinates).
+    cp = ((x2-x1)(y3-y1))-((y2-y1)(x3-x1)), where (x3, y3) is a point being tested (just add candidate normal to the edge halfway point).
+    Each node is then displaced along its normalized node normal, the sum of the normals of the two edges meeting at the node.
+    
+    Parameters
+    ----------
+    polygons : List<Numpy.array>
+        Nodes ([N,2]) of each closed polygon
+    
+    Returns
+    -------
+    dilated_polygons : List<Numpy.array>
+        Nodes ([N,2]) of each dilated polygon, closed like the input polygons
     """
-    normals = []
-    edge_halfway_points = []
-    dilated_x = []
-    dilated_y = []
-            
-    # Calculate polygon edge normals. First normal will be between then first and last node of the polygon.    
-    for i in range(len(x_coordinates)-1): # Ignoring the last node, which is the same as the first node
-        x1 = x_coordinates[i]
-        y1 = y_coordinates[i]
-        x2 = x_coordinates[i+1]
-        y2 = y_coordinates[i+1]
-        
-        halfway_x = x1 + 0.5*(x2-x1)
-        halfway_y = y1 + 0.5*(y2-y1)
-        edge_halfway_points.append([halfway_x, halfway_y])
-        
-        dx = x2 - x1
-        dy = y2 - y1
-        n1x = -dy
-        n1y = dx
-        n2x = dy
-        n2y = -dx
-        test_point_x = halfway_x + n1x
-        test_point_y = halfway_y + n1y
-        cross_product = ((x2-x1)*(test_point_y-y1))-((y2-y1)*(test_point_x-x1))
-        if cross_product < 0:
-            chosen_normal = [n1x,n1y]
-        elif cross_product == 0:
-            # Should never end up here, unless the angle between polygon components is 180 degrees.
-            print("Found a 180-degree angle in the footprint polygon!")
-            chosen_normal = [n1x, n1y] # Just to avoid an error, should add error handling...
-        else:
-            chosen_normal = [n2x, n2y]
-        normals.append(chosen_normal)
-            
-    # Calculate normalized vertex normals, and dilate node positions along it by a set amount
-    for i in range(len(x_coordinates)-1):
-        n1x = normals[i-1][0]
-        n1y = normals[i-1][1]
-        n2x = normals[i][0]
-        n2y = normals[i][1]
-        vn = np.array([n1x+n2x, n1y+n2y])
-        normalized_vn = vn / np.sqrt(np.sum(vn**2))
-        new_x = x_coordinates[i] + normalized_vn[0] * dilation_amount
-        new_y = y_coordinates[i] + normalized_vn[1] * dilation_amount
-        dilated_x.append(new_x)
-        dilated_y.append(new_y)
-        
-    # Move the final node identically to the first one, since they are the same vertex
-    dilated_x.append(dilated_x[0])
-    dilated_y.append(dilated_y[0])
-        
-    return dilated_x, dilated_y
+    # Edges of all polygons; the last node of each polygon is the same as the first one, so every other node starts an edge
+    node_counts = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+    nodes = np.concatenate([np.asarray(polygon, dtype=np.float64).reshape((-1,2)) for polygon in polygons])
+    polygon_ends = np.cumsum(node_counts)
+    is_edge_start = np.ones(len(nodes), dtype=bool)
+    is_edge_start[polygon_ends[node_counts > 0] - 1] = False
+    edge_starts = np.flatnonzero(is_edge_start)
+    x1 = nodes[edge_starts, 0]
+    y1 = nodes[edge_starts, 1]
+    x2 = nodes[edge_starts+1, 0]
+    y2 = nodes[edge_starts+1, 1]
+    
+    # Calculate polygon edge normals
+    halfway_x = x1 + 0.5*(x2-x1)
+    halfway_y = y1 + 0.5*(y2-y1)
+    dx = x2 - x1
+    dy = y2 - y1
+    test_point_x = halfway_x - dy
+    test_point_y = halfway_y + dx
+    cross_product = ((x2-x1)*(test_point_y-y1))-((y2-y1)*(test_point_x-x1))
+    if np.any(cross_product == 0) == True:
+        # Should never end up here, unless the angle between polygon components is 180 degrees.
+        print("Found a 180-degree angle in the footprint polygon!")
+    # Normal (-dy, dx) for negative (and zero) cross products, (dy, -dx) otherwise
+    normal_sign = np.where(cross_product <= 0, 1.0, -1.0)
+    normals = np.column_stack([-dy*normal_sign, dx*normal_sign])
+    
+    # Calculate normalized vertex normals from the normals of the previous and the current edge. The previous edge of the first node is the last edge of the same polygon.
+    edge_counts = np.maximum(node_counts - 1, 0)
+    first_edges = np.cumsum(edge_counts) - edge_counts
+    previous_edges = np.arange(len(edge_starts)) - 1
+    has_edges = edge_counts > 0
+    previous_edges[first_edges[has_edges]] = first_edges[has_edges] + edge_counts[has_edges] - 1
+    vn = normals[previous_edges] + normals
+    normalized_vn = vn / np.sqrt(np.sum(vn**2, axis=1))[:,np.newaxis]
+    
+    # Dilate node positions along the normals by a set amount, and move the final node of each polygon identically to the first one, since they are the same vertex
+    dilated_nodes = nodes.copy()
+    dilated_nodes[edge_starts] = nodes[edge_starts] + normalized_vn * dilation_amount
+    polygon_ends = polygon_ends[node_counts > 0]
+    dilated_nodes[polygon_ends - 1] = dilated_nodes[polygon_ends - node_counts[node_counts > 0]]
+    return np.split(dilated_nodes, np.cumsum(node_counts)[:-1])
     
     
 if __name__ == '__main__':
@@ -1,7 +1,11 @@
+import os
 import sys
+import concurrent.futures
 import matplotlib.pyplot as plt
 import numpy as np
 from shapely.geometry import Point, LineString
+from rtree import index as rtreeindex
+import footprint_table as footprinttable
 
 """
 Read polygons created by the script "create_footprint_polygons.py".
@@ -11,98 +15,89 @@ Edges that would touch the neighboring polygon's edges, will not expand over the
 
 process_all_buildings       = True # if 'True' process all buildings in input file. If 'false', process only a single building defined by 'target_building'
 target_building             = "building_349.obj"
-input_filename              = "S:/OSS/Data/Footprints/test_footprint_0m_dilation.txt"
+input_filename              = "S:/OSS/Data/Footprints/test_footprint_0m_dilation.txt" # Text or .npz footprint file (see 'footprint_table.py')
 output_filename             = "S:/OSS/Data/Footprints/test_footprint_2_0m_dilation.txt"
 neighbor_distance_threshold = 2.0
 dilation_amount             = 2.0
 visualize_results           = True
 output_results_to_file      = True
+output_npz                  = True # If True (and 'output_results_to_file' is True), the dilated polygons are also saved into a NumPy archive next to the output file (same name, '.npz' extension), which the later scripts load faster than the text (see 'footprint_table.py')
+worker_count                = 1 # Number of processes to dilate the polygons in. If larger than 1, the buildings are distributed across the processes, and the results are still written in input order.
+dilation_chunk_size         = 16 # Number of buildings sent to a worker process at a time
+incremental_update          = False # If True, only the changed buildings and their neighbors are dilated again, and the results are patched into the existing output file. Other buildings keep their lines from the existing output. If the output file does not exist yet, all buildings are dilated.
+previous_input_filename     = "S:/OSS/Data/Footprints/test_footprint_0m_dilation_previous.txt" # The input file the existing output file was created from (used with 'incremental_update')
+changed_buildings           = [] # LOD2 object names of the buildings that changed since the previous run (used with 'incremental_update'). Buildings whose polygons differ between the previous and the current input file are added automatically.
+
+shared_footprints      = None # Footprint table of the input polygons, shared read-only by the dilation functions (see 'init_dilation_worker()')
+shared_footprint_index = None # Spatial index of 'shared_footprints'
 
 
 def main():
 
-    original_polygons = []
     output_visualization_x = []
     output_visualization_y = []
     original_visualization_x = []
     original_visualization_y = []
-                  
-    with open(output_filename, 'w') as output_file:
-        # First, read all the lines from the input file into a list
-        with open(input_filename, 'r') as input_file:
-            original_polygons = input_file.readlines()
+    
+    previous_output_lines = {}
+    update_incrementally = incremental_update
+    if update_incrementally == True and os.path.exists(output_filename) == False:
+        print("Output file %s does not exist yet, dilating all polygons instead of an incremental update." % output_filename)
+        update_incrementally = False
+    if update_incrementally == True:
+        # Read the existing output before it gets replaced
+        previous_output_lines = read_polygon_lines_by_name(output_filename)
+    
+    # The output is written into a temporary file first, and replaces the existing output only when complete
+    temporary_output_filename = output_filename + ".tmp"
+    output_lines = []
+    with open(temporary_output_filename, 'w') as output_file:
+        # First, read the polygons from the input file into a footprint table
+        original_footprints = simplify_polygons(footprinttable.load_footprint_table(input_filename))
+        polygon_names = original_footprints['names']
+        polygon_pc_names = original_footprints['point_cloud_names']
+        
+        polygon_numbers_to_output = []
+        for dilating_polygon_number in range(len(polygon_names)):
+            if process_all_buildings == False and polygon_names[dilating_polygon_number] != target_building: 
+                continue
+            polygon_numbers_to_output.append(dilating_polygon_number)
+        
+        if update_incrementally == True:
+            polygon_numbers_to_dilate = find_polygons_to_update(original_footprints, polygon_numbers_to_output, previous_output_lines)
+        else:
+            polygon_numbers_to_dilate = polygon_numbers_to_output
+        
+        # Second, dilate each polygon while taking care not to intersect the polygons that come sufficiently close to it.
+        # The buildings are independent of each other, as each one only depends on the original polygons of its neighbors.
+        if worker_count > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker_count, initializer=init_dilation_worker, initargs=(original_footprints,))
+            dilation_results = executor.map(dilate_building, polygon_numbers_to_dilate, chunksize=dilation_chunk_size)
+        else:
+            executor = None
+            init_dilation_worker(original_footprints)
+            dilation_results = map(dilate_building, polygon_numbers_to_dilate)
+        
+        polygon_numbers_to_dilate = set(polygon_numbers_to_dilate)
+        for dilating_polygon_number in polygon_numbers_to_output:
+            dilating_polygon_obj_name = polygon_names[dilating_polygon_number]
+            dilating_polygon_pc_name = polygon_pc_names[dilating_polygon_number]
             
-        original_polygons = simplify_polygons(original_polygons)
+            if dilating_polygon_number not in polygon_numbers_to_dilate:
+                # Unaffected building in incremental update, keep the existing result
+                polygon_string = previous_output_lines[dilating_polygon_obj_name]
+                if output_results_to_file == True:
+                    output_file.write(polygon_string)
+                    output_lines.append(polygon_string)
+                if visualize_results == True:
+                    words = polygon_string.split()
+                    output_visualization_x.append(np.asarray(words[2::2], dtype=np.float64))
+                    output_visualization_y.append(np.asarray(words[3::2], dtype=np.float64))
+                continue
             
-        # Second, iterate over the lines, and for each polygon, iterate over them again, looking for polygons that come sufficiently close to each other        
-        for dilating_polygon_number in range(len(original_polygons)):
-                
-            words_1 = original_polygons[dilating_polygon_number].split()
-            dilating_polygon_obj_name = words_1[0]
-            if process_all_buildings == False and dilating_polygon_obj_name != target_building: 
-                continue            
-
-            dilating_polygon = []
-            neighbor_indices = []
-            neighbor_names = []
-            dilating_polygon_pc_name = words_1[1]
-            for point_number in range(2,len(words_1), 2):
-                # Get node coordinates...
-                dilating_polygon.append( [float(words_1[point_number]), float(words_1[point_number+1])] )
-
-            # Find all nearby buildings that the dilating polygon should be careful about
-            for potential_neighbor_number in range(len(original_polygons)):
-                # Get all the other polygons...
-                if potential_neighbor_number == dilating_polygon_number:
-                    continue
-                potential_neighbor_polygon = []
-                words_2 = original_polygons[potential_neighbor_number].split()
-                potential_neighbor_obj_name = words_2[0]
-                for point_number in range(2,len(words_2), 2):
-                    potential_neighbor_polygon.append( [float(words_2[point_number]), float(words_2[point_number+1])] )
-                # Compare the two polygons. Pick one edge from the first, compare it to every edge in the second, then move to the next edge in the first, and so on.
-                neighborness_confirmed = False
-                for point_iterator in range(len(dilating_polygon)):
-                    # For each dilating polygon point...
-                    # Since the line segments do not cross, the closest point on either edge to the other edge has to be one of the end-points.
-                    A = dilating_polygon[point_iterator]
-                    for edge_iterator in range(0, len(potential_neighbor_polygon)-1):
-                        # Compare the dilating polygon node (and its follow-up node) to every edge of the potential neighbor polygon to find out if it is an actual neighbor...
-                        edge = [potential_neighbor_polygon[edge_iterator], potential_neighbor_polygon[edge_iterator+1]]
-                        B = edge[0]
-                        C = edge[1]
-                        # Compare each of the 4 points against the other edge, calculating the nearest distance.                    
-                        dist_A_to_BC = shortest_distance_from_point_to_line_segment(B[0], B[1], C[0], C[1], A[0], A[1])
-                        if dist_A_to_BC < neighbor_distance_threshold:
-                            neighborness_confirmed = True
-                            break
-                    if neighborness_confirmed == True:
-                        break
-                if neighborness_confirmed == False:
-                    for point_iterator in range(len(potential_neighbor_polygon)):
-                        # For each dilating polygon point...
-                        # Since the line segments do not cross, the closest point on either edge to the other edge has to be one of the end-points.
-                        A = potential_neighbor_polygon[point_iterator]
-                        for edge_iterator in range(0, len(dilating_polygon)-1):
-                            # Compare the dilating polygon node (and its follow-up node) to every edge of the potential neighbor polygon to find out if it is an actual neighbor...
-                            edge = [dilating_polygon[edge_iterator], dilating_polygon[edge_iterator+1]]
-                            B = edge[0]
-                            C = edge[1]
-                            # Compare each of the 4 points against the other edge, calculating the nearest distance.                    
-                            dist_A_to_BC = shortest_distance_from_point_to_line_segment(B[0], B[1], C[0], C[1], A[0], A[1])
-                            if dist_A_to_BC < neighbor_distance_threshold:
-                                neighborness_confirmed = True
-                                break
-                        if neighborness_confirmed == True:
-                            break
-                if neighborness_confirmed == True:
-                    neighbor_names.append(potential_neighbor_obj_name)
-                    neighbor_indices.append(potential_neighbor_number)
+            neighbor_names, dilated_x, dilated_y = next(dilation_results)
 
             print("Neighbors for", dilating_polygon_obj_name, "- ", neighbor_names)
-           
-            # Dilate the polygon while taking care not to intersect the neighbors
-            dilated_x, dilated_y = dilate_polygon_with_neighbors(dilating_polygon, original_polygons, neighbor_indices)
          
             # Output results
             if visualize_results == True:
@@ -121,19 +116,17 @@ def main():
             
             if output_results_to_file == True:
                 output_file.write(polygon_string)
+                output_lines.append(polygon_string)
+        
+        if executor is not None:
+            executor.shutdown()
                                 
         if visualize_results == True:            
-            for dilating_polygon_number in range(len(original_polygons)):
-                dilating_polygon_x = []
-                dilating_polygon_y = []
-                words_1 = original_polygons[dilating_polygon_number].split()
-                for point_number in range(2,len(words_1), 2):
-                    dilating_polygon_x.append( float(words_1[point_number]) )
-                    dilating_polygon_y.append( float(words_1[point_number+1]) )
-                dilating_polygon_x.append( float(words_1[2]) )
-                dilating_polygon_y.append( float(words_1[3]) )
-                original_visualization_x.append(np.asarray(dilating_polygon_x))
-                original_visualization_y.append(np.asarray(dilating_polygon_y))
+            for dilating_polygon_number in range(len(polygon_names)):
+                # Close the polygon by repeating the first node
+                dilating_polygon = footprinttable.get_polygon(original_footprints, dilating_polygon_number)
+                original_visualization_x.append(np.append(dilating_polygon[:,0], dilating_polygon[0,0]))
+                original_visualization_y.append(np.append(dilating_polygon[:,1], dilating_polygon[0,1]))
                 
             plt.title("Polygons")
             plt.xlabel("X axis")
@@ -143,32 +136,31 @@ def main():
             for i in range(len(original_visualization_x)):
                 plt.plot(original_visualization_x[i], original_visualization_y[i], color="black")
             plt.show()        
+    os.replace(temporary_output_filename, output_filename)
+    if output_results_to_file == True and output_npz == True:
+        footprinttable.save_footprint_table(footprinttable.parse_footprint_lines(output_lines), footprinttable.get_archive_filename(output_filename))
 
 
-def simplify_polygons(polygons):
+def simplify_polygons(footprints):
     """
-    Go through each polygon in the input list (Each element is a polygon defined by x/y coordinate pairs, and the two first elements of each are file names).
+    Go through each polygon in the input footprint table.
     If any node is too close to each other, combine them to a mid-point node.
     
     Parameters
     ----------
-    polygons : string
-        All of the text read from the input polygon file. Each line defines a single buildings.
+    footprints : dict
+        Footprint table (see 'footprint_table.py') of the input polygons. Each entry defines a single building.
         
     Returns
     -------
-    output_polygons : string
-        Version of the input string, with nodes that are too close to each other combined
+    simplified_footprints : dict
+        Version of the input footprint table, with nodes that are too close to each other combined
     """
     polygon_simplification_distance_threshold = 0.5 # Squared distance between two successive nodes in a polygon, below which they get combined to a single node in their mid-point
-    output_polygons = []
-    for polygon_line in polygons:
+    simplified_polygons = []
+    for building_number in range(len(footprints['names'])):
         simplified_polygon = []
-        words = polygon_line.split()
-        output_line = words[0] + " " + words[1] # Object and point cloud filenames
-        polygon = []
-        for point_number in range(2,len(words), 2):
-            polygon.append( [float(words[point_number]), float(words[point_number+1])] )
+        polygon = footprinttable.get_polygon(footprints, building_number).tolist()
         last_position = [0,0]
         for node_number in range(len(polygon)):
             position = [polygon[node_number][0], polygon[node_number][1]]
@@ -186,11 +178,250 @@ def simplify_polygons(polygons):
             last_position = position
             
         #print("from %d to %d" % (len(polygon), len(simplified_polygon)) )
-        for node in simplified_polygon:
-            output_line = output_line + " " + str(node[0]) + " " + str(node[1])
-        output_polygons.append(output_line)
-    return output_polygons
+        simplified_polygons.append(simplified_polygon)
+    return footprinttable.create_footprint_table(footprints['names'], footprints['point_cloud_names'], simplified_polygons)
+    
+
+def read_polygon_lines_by_name(polygon_filename):
+    """
+    Read the lines of a polygon file into a dictionary, keyed by the LOD2 object name (the first word on each line).
+    """
+    polygon_lines = {}
+    with open(polygon_filename, 'r') as polygon_file:
+        for polygon_line in polygon_file:
+            words = polygon_line.split()
+            if len(words) == 0:
+                continue
+            if polygon_line.endswith("\n") == False:
+                polygon_line += "\n"
+            polygon_lines[words[0]] = polygon_line
+    return polygon_lines
+
+
+def find_polygons_to_update(footprints, polygon_numbers_to_output, previous_output_lines):
+    """
+    Find the polygons that need to be dilated again in an incremental update: the changed buildings, and every building that neighbors
+    a changed building either in the current input file or in the previous input file (as the changed building may have moved away from it).
+    Buildings missing from the existing output are dilated as well.
+    
+    Parameters
+    ----------
+    footprints : dict
+        Footprint table of the current input file, as returned by 'simplify_polygons()'
+    polygon_numbers_to_output : List<int>
+        Positions of the polygons written into the output
+    previous_output_lines : dict
+        Lines of the existing output file, keyed by the LOD2 object name
+    
+    Returns
+    -------
+    polygon_numbers_to_dilate : List<int>
+        Positions of the polygons to dilate, in ascending order
+    """
+    previous_footprints = simplify_polygons(footprinttable.load_footprint_table(previous_input_filename))
+    previous_numbers_by_name = footprinttable.get_building_numbers_by_name(previous_footprints)
+    
+    names = footprints['names']
+    changed_names = set(changed_buildings)
+    for polygon_number in range(len(names)):
+        previous_number = previous_numbers_by_name.get(names[polygon_number])
+        if previous_number is None or np.array_equal(footprinttable.get_polygon(previous_footprints, previous_number), footprinttable.get_polygon(footprints, polygon_number)) == False:
+            changed_names.add(names[polygon_number])
+    changed_names.update(set(previous_footprints['names']) - set(names))
+    
+    # Look up the neighbors of the changed buildings, with both their current and previous polygons, from the current polygon index
+    footprint_index = create_polygon_index(footprints)
+    polygon_numbers_by_name = footprinttable.get_building_numbers_by_name(footprints)
+    affected_numbers = set()
+    for changed_name in changed_names:
+        changed_polygons = []
+        if changed_name in polygon_numbers_by_name:
+            affected_numbers.add(polygon_numbers_by_name[changed_name])
+            changed_polygons.append(footprinttable.get_polygon(footprints, polygon_numbers_by_name[changed_name]))
+        if changed_name in previous_numbers_by_name:
+            changed_polygons.append(footprinttable.get_polygon(previous_footprints, previous_numbers_by_name[changed_name]))
+        for changed_polygon in changed_polygons:
+            affected_numbers.update(find_polygon_neighbors(changed_polygon, footprints, footprint_index))
+    
+    polygon_numbers_to_dilate = []
+    for polygon_number in polygon_numbers_to_output:
+        if polygon_number in affected_numbers or names[polygon_number] not in previous_output_lines:
+            polygon_numbers_to_dilate.append(polygon_number)
+    print("Incremental update: %d changed buildings, dilating %d of %d buildings" % (len(changed_names), len(polygon_numbers_to_dilate), len(polygon_numbers_to_output)) )
+    return polygon_numbers_to_dilate
+
+
+def init_dilation_worker(footprints):
+    """
+    Set the footprint table used by 'dilate_building()', and build its spatial index. Called once in each worker process (and in the main process, if no workers are used).
+    
+    Parameters
+    ----------
+    footprints : dict
+        Footprint table of the input polygons, as returned by 'simplify_polygons()'
+    """
+    global shared_footprints, shared_footprint_index
+    shared_footprints = footprints
+    shared_footprint_index = create_polygon_index(footprints)
+
+
+def dilate_building(polygon_number):
+    """
+    Find the neighbors of a polygon in the shared footprint table, and dilate the polygon while taking care not to intersect them.
+    
+    Parameters
+    ----------
+    polygon_number : int
+        Position of the polygon in the footprint table
+    
+    Returns
+    -------
+    neighbor_names : List<string>
+        LOD2 object filenames of the neighboring polygons
+    dilated_x : List<float>
+        X coordinates of the dilated polygon nodes
+    dilated_y : List<float>
+        Y coordinates of the dilated polygon nodes
+    """
+    dilating_polygon = footprinttable.get_polygon(shared_footprints, polygon_number).tolist()
+
+    # Find all nearby buildings that the dilating polygon should be careful about
+    neighbor_indices = find_neighbors(polygon_number, shared_footprints, shared_footprint_index)
+    neighbor_names = [shared_footprints['names'][neighbor_index] for neighbor_index in neighbor_indices]
+
+    dilated_x, dilated_y = dilate_polygon_with_neighbors(dilating_polygon, shared_footprints, neighbor_indices)
+    return neighbor_names, dilated_x, dilated_y
+
+
+def create_polygon_index(footprints):
+    """
+    Create an R-tree of the polygon bounding boxes in a footprint table, buffered by 'neighbor_distance_threshold'. Polygons whose buffered bounding boxes do not overlap can not be neighbors.
+    The position of the polygon in the footprint table is used as its id.
+    """
+    buffered_bounding_boxes = []
+    for polygon_number in range(len(footprints['names'])):
+        min_x, min_y, max_x, max_y = footprints['bboxes'][polygon_number]
+        if np.isnan(min_x) == True:
+            # Polygon without nodes
+            continue
+        bounding_box = (min_x - neighbor_distance_threshold, min_y - neighbor_distance_threshold, max_x + neighbor_distance_threshold, max_y + neighbor_distance_threshold)
+        buffered_bounding_boxes.append( (polygon_number, bounding_box, None) )
+    if len(buffered_bounding_boxes) == 0:
+        return rtreeindex.Index()
+    # Bulk load the index, which is much faster than inserting the boxes one by one
+    return rtreeindex.Index(buffered_bounding_boxes)
+
+
+def find_neighbors(polygon_number, footprints, footprint_index):
+    """
+    Find the polygons that come closer than 'neighbor_distance_threshold' to the given polygon.
     
+    Returns
+    -------
+    neighbor_indices : List<int>
+        Positions of the neighboring polygons, in ascending order
+    """
+    neighbor_indices = find_polygon_neighbors(footprinttable.get_polygon(footprints, polygon_number), footprints, footprint_index)
+    return [neighbor_index for neighbor_index in neighbor_indices if neighbor_index != polygon_number]
+
+
+def find_polygon_neighbors(polygon, footprints, footprint_index):
+    """
+    Find the polygons of a footprint table that come closer than 'neighbor_distance_threshold' to a polygon, which does not need to be one of them.
+    Candidates are looked up from the bounding box index, and their exact distances are computed in a single batch with 'get_polygon_distances()'.
+    
+    Parameters
+    ----------
+    polygon : Numpy.array
+        Nodes ([N,2]) of the polygon
+    footprints : dict
+        Footprint table of the indexed polygons
+    footprint_index : rtree.index.Index
+        Index of the footprint table, as returned by 'create_polygon_index()'
+    
+    Returns
+    -------
+    neighbor_indices : List<int>
+        Positions of the neighboring polygons in the footprint table, in ascending order
+    """
+    if len(polygon) == 0:
+        return []
+    min_x, min_y = np.min(polygon, axis=0)
+    max_x, max_y = np.max(polygon, axis=0)
+    candidate_indices = sorted(footprint_index.intersection((min_x, min_y, max_x, max_y)))
+    if len(candidate_indices) == 0:
+        return []
+    distances = get_polygon_distances(polygon, [footprinttable.get_polygon(footprints, candidate_index) for candidate_index in candidate_indices])
+    return [candidate_indices[i] for i in np.flatnonzero(distances < neighbor_distance_threshold)]
+
+
+def get_polygon_distances(polygon, other_polygons):
+    """
+    Compute the shortest distance between a polygon and each of the other polygons, measured from the nodes of either polygon to the edges of the other.
+    Since the polygon edges do not cross, the closest point on either edge to the other edge has to be one of the end-points.
+    Edges are taken between consecutive nodes only, i.e. the edge closing the polygon is not included.
+    
+    Parameters
+    ----------
+    polygon : Numpy.array
+        Nodes ([N,2]) of the polygon
+    other_polygons : List<Numpy.array>
+        Nodes ([M,2]) of each of the other polygons
+    
+    Returns
+    -------
+    distances : Numpy.array
+        Shortest distance ([K]) to each of the other polygons. Infinity, if neither polygon has any edges.
+    """
+    node_counts = np.array([len(other_polygon) for other_polygon in other_polygons])
+    other_nodes = np.concatenate(other_polygons)
+    other_polygon_of_node = np.repeat(np.arange(len(other_polygons)), node_counts)
+    # Edges of the other polygons start from every node, except the last node of each polygon
+    is_edge_start = np.ones(len(other_nodes), dtype=bool)
+    is_edge_start[np.cumsum(node_counts)[node_counts > 0] - 1] = False
+    
+    distances = np.full(len(other_polygons), np.inf)
+    # Nodes of the polygon to the edges of the other polygons
+    edge_start_indices = np.flatnonzero(is_edge_start)
+    if len(edge_start_indices) > 0:
+        edge_distances = get_point_to_segment_distances(polygon, other_nodes[edge_start_indices], other_nodes[edge_start_indices+1]).min(axis=0)
+        np.minimum.at(distances, other_polygon_of_node[edge_start_indices], edge_distances)
+    # Nodes of the other polygons to the edges of the polygon
+    if len(polygon) > 1:
+        node_distances = get_point_to_segment_distances(other_nodes, polygon[:-1], polygon[1:]).min(axis=1)
+        np.minimum.at(distances, other_polygon_of_node, node_distances)
+    return distances
+
+
+def get_point_to_segment_distances(points, segment_starts, segment_ends):
+    """
+    Vectorized version of 'shortest_distance_from_point_to_line_segment()', computing the distance from every point to every line segment.
+    Zero-length segments are treated as points.
+    
+    Parameters
+    ----------
+    points : Numpy.array
+        Points ([P,2])
+    segment_starts : Numpy.array
+        First end-points ([S,2]) of the line segments
+    segment_ends : Numpy.array
+        Second end-points ([S,2]) of the line segments
+    
+    Returns
+    -------
+    distances : Numpy.array
+        Distances ([P,S]) from the points to the line segments
+    """
+    px = segment_ends[:,0] - segment_starts[:,0]
+    py = segment_ends[:,1] - segment_starts[:,1]
+    norm = px*px + py*py
+    safe_norm = np.where(norm > 0, norm, 1.0)
+    u = ((points[:,0,None] - segment_starts[:,0]) * px + (points[:,1,None] - segment_starts[:,1]) * py) / safe_norm
+    u = np.clip(u, 0, 1)
+    dx = segment_starts[:,0] + u * px - points[:,0,None]
+    dy = segment_starts[:,1] + u * py - points[:,1,None]
+    return np.sqrt(dx*dx + dy*dy)
+
 
 def shortest_distance_from_point_to_line_segment(x1, y1, x2, y2, x3, y3):
     """
@@ -226,33 +457,118 @@ def project_point_to_line(point, line):
     return projection
 
 
-def check_intersection_with_neighbor(p0, p1, polygon_list, neighbor_indices):
+def create_neighbor_edges(footprints, neighbor_indices):
+    """
+    Collect the edges of the neighboring polygons into arrays once per dilated building, for 'check_intersection_with_neighbor()'.
+    The edges are ordered neighbor by neighbor, and for each neighbor polygon the edge ending at node k for k = 0...N-1 (i.e. the closing edge first).
+    
+    Parameters
+    ----------
+    footprints : dict
+        Footprint table of the polygons
+    neighbor_indices : List<int>
+        Positions of the neighboring polygons in the footprint table
+    
+    Returns
+    -------
+    neighbor_edges : dict
+        'starts' and 'ends' : Numpy.arrays ([E,2]) of the edge end-points
+        'mins' and 'maxs'   : Numpy.arrays ([E,2]) of the edge bounding boxes
+        'lines'             : List of Shapely LineStrings of the edges, created when first needed
+    """
+    starts = []
+    ends = []
+    for neighbor_index in neighbor_indices:
+        neighbor_polygon = footprinttable.get_polygon(footprints, neighbor_index)
+        starts.append(np.roll(neighbor_polygon, 1, axis=0))
+        ends.append(neighbor_polygon)
+    if len(starts) > 0:
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+    else:
+        starts = np.empty((0,2))
+        ends = np.empty((0,2))
+    return {
+        'starts': starts,
+        'ends': ends,
+        'mins': np.minimum(starts, ends),
+        'maxs': np.maximum(starts, ends),
+        'lines': [None] * len(starts)
+    }
+
+
+def may_segments_intersect(starts_0, ends_0, starts_1, ends_1):
+    """
+    Vectorized test of whether the line segments starts_0->ends_0 and starts_1->ends_1 may intersect or touch, used to skip the exact Shapely tests for segments that clearly do not.
+    The segments are compared by their bounding boxes and by the sides their end-points are on each other, with a tolerance,
+    so that segments that intersect are never rejected (while some segments that just miss each other may be accepted).
+    
+    Parameters
+    ----------
+    starts_0, ends_0, starts_1, ends_1 : Numpy.array
+        End-points ([...,2]) of the segments, broadcast against each other
+    
+    Returns
+    -------
+    may_intersect : Numpy.array
+        Boolean ([...]) of each segment pair
+    """
+    def cross(a, b):
+        return a[...,0]*b[...,1] - a[...,1]*b[...,0]
+    overlapping_bounding_boxes = np.all(np.minimum(starts_0, ends_0) <= np.maximum(starts_1, ends_1), axis=-1) & np.all(np.maximum(starts_0, ends_0) >= np.minimum(starts_1, ends_1), axis=-1)
+    directions_0 = ends_0 - starts_0
+    directions_1 = ends_1 - starts_1
+    orientations = [
+        cross(directions_0, starts_1 - starts_0),
+        cross(directions_0, ends_1 - starts_0),
+        cross(directions_1, starts_0 - starts_1),
+        cross(directions_1, ends_0 - starts_1)
+    ]
+    # The rounding error of the orientations grows with the segment lengths and the magnitude of the coordinates
+    segment_lengths = np.linalg.norm(directions_0, axis=-1) + np.linalg.norm(directions_1, axis=-1)
+    coordinate_scale = max(np.max(np.abs(starts_0), initial=0.0), np.max(np.abs(starts_1), initial=0.0)) + 1.0
+    tolerance = 1e-9 * segment_lengths * (segment_lengths + coordinate_scale)
+    sides = [np.where(np.abs(orientation) <= tolerance, 0.0, np.sign(orientation)) for orientation in orientations]
+    return overlapping_bounding_boxes & (sides[0] * sides[1] <= 0) & (sides[2] * sides[3] <= 0)
+
+
+def check_intersection_with_neighbor(p0, p1, neighbor_edges):
     """
     Check using Shapely if the line segment p0p1 crosses any of the neighboring polygon edges, and return the crossing point if so.
+    The edges are first filtered with NumPy by their bounding boxes, and then with 'may_segments_intersect()',
+    and only the remaining candidates are checked with Shapely. The crossings are returned in the order of 'neighbor_edges'.
     """
-    dilation_line = LineString([p0, p1])
-    #print("Checking intersection for", p0, "-", p1, "against neighbors")
     intersection_found = False
     intersection_data = []
-    for neighbor_index in range(len(neighbor_indices)):
-        words = polygon_list[neighbor_indices[neighbor_index]].split()
-        neighbor_polygon = []
-        for node_number in range(2,len(words), 2):
-            neighbor_polygon.append( [float(words[node_number]), float(words[node_number+1])] )
-        for node_number in range(0,len(neighbor_polygon)):
-            node_0 = neighbor_polygon[node_number-1]
-            node_1 = neighbor_polygon[node_number]
-            neighbor_line = LineString([(node_0[0], node_0[1]), (node_1[0], node_1[1])])
-            if dilation_line.intersects(neighbor_line) == True:
-                intersection_found = True
-                intersection_point = dilation_line.intersection(neighbor_line)
-                intersection_point = np.array([intersection_point.x, intersection_point.y])
-                intersection_data.append([intersection_point, neighbor_line])
+    start = np.array(p0, dtype=np.float64)
+    end = np.array(p1, dtype=np.float64)
+    candidates = np.flatnonzero(np.all(neighbor_edges['mins'] <= np.maximum(start, end), axis=1) & np.all(neighbor_edges['maxs'] >= np.minimum(start, end), axis=1))
+    if len(candidates) == 0:
+        return intersection_found, intersection_data
+    
+    candidates = candidates[may_segments_intersect(start, end, neighbor_edges['starts'][candidates], neighbor_edges['ends'][candidates])]
+    if len(candidates) == 0:
+        return intersection_found, intersection_data
+    
+    dilation_line = LineString([p0, p1])
+    #print("Checking intersection for", p0, "-", p1, "against neighbors")
+    for edge_number in candidates:
+        neighbor_line = neighbor_edges['lines'][edge_number]
+        if neighbor_line is None:
+            node_0 = neighbor_edges['starts'][edge_number]
+            node_1 = neighbor_edges['ends'][edge_number]
+            neighbor_line = LineString([(float(node_0[0]), float(node_0[1])), (float(node_1[0]), float(node_1[1]))])
+            neighbor_edges['lines'][edge_number] = neighbor_line
+        if dilation_line.intersects(neighbor_line) == True:
+            intersection_found = True
+            intersection_point = dilation_line.intersection(neighbor_line)
+            intersection_point = np.array([intersection_point.x, intersection_point.y])
+            intersection_data.append([intersection_point, neighbor_line])
     
     return intersection_found, intersection_data
 
 
-def add_midway_nodes(next_dilated_x, next_dilated_y, current_undilated_node_number, undilated_list_x, undilated_list_y, dilated_list_x, dilated_list_y, polygon_list, neighbor_indices):
+def add_midway_nodes(next_dilated_x, next_dilated_y, current_undilated_node_number, undilated_list_x, undilated_list_y, dilated_list_x, dilated_list_y, neighbor_edges):
     """
     Check, if an intersection with a neighbor polygon is created, if (to_be_added_x,to_be_added_y) is added to the list of dilated points.
     If so, create a new node before it in such a position that the resulting polygon line will not have that intersection.
@@ -270,7 +586,7 @@ def add_midway_nodes(next_dilated_x, next_dilated_y, current_undilated_node_numb
         # Starting coordinates
         previous_dilated_x = dilated_list_x[-1]
         previous_dilated_y = dilated_list_y[-1]
-        intersection_found, intersections_data = check_intersection_with_neighbor([previous_dilated_x, previous_dilated_y], [next_dilated_x, next_dilated_y], polygon_list, neighbor_indices)
+        intersection_found, intersections_data = check_intersection_with_neighbor([previous_dilated_x, previous_dilated_y], [next_dilated_x, next_dilated_y], neighbor_edges)
         if intersection_found == True:
             # Intersection found. 
             # Find the point on the intersected neighbor edge that is closest to the undilated polygon edge.
@@ -301,8 +617,8 @@ def add_midway_nodes(next_dilated_x, next_dilated_y, current_undilated_node_numb
             midway_y_1 = projected_point[1] + ((nearest_point[1]-projected_point[1])/2.0)
         
             # Draw a new line from the goal coordinates to the new midway point, and see if that line intersects the neighbor polygon.
-            #intersection_found, intersections_data = check_intersection_with_neighbor([next_dilated_x, next_dilated_y], [midway_x_1, midway_y_1], polygon_list, neighbor_indices)
-            intersection_found, intersections_data = check_intersection_with_neighbor([previous_dilated_x, previous_dilated_y], [midway_x_1, midway_y_1], polygon_list, neighbor_indices)
+            #intersection_found, intersections_data = check_intersection_with_neighbor([next_dilated_x, next_dilated_y], [midway_x_1, midway_y_1], neighbor_edges)
+            intersection_found, intersections_data = check_intersection_with_neighbor([previous_dilated_x, previous_dilated_y], [midway_x_1, midway_y_1], neighbor_edges)
             if intersection_found == True:
                 print("  >Need to add a second midway point")
                 #intersection_point = intersections_data[0][0]
@@ -333,7 +649,7 @@ def add_midway_nodes(next_dilated_x, next_dilated_y, current_undilated_node_numb
 
 
 
-def add_midway_nodes_2(goal_x, goal_y, current_undilated_node_number, undilated_list_x, undilated_list_y, dilated_list_x, dilated_list_y, polygon_list, neighbor_indices):
+def add_midway_nodes_2(goal_x, goal_y, current_undilated_node_number, undilated_list_x, undilated_list_y, dilated_list_x, dilated_list_y, neighbor_edges):
     """
     Check, if an intersection with a neighbor polygon is created, if (to_be_added_x,to_be_added_y) is added to the list of dilated points.
     If so, create a new node before it in such a position that the resulting polygon line will not have that intersection.
@@ -351,7 +667,7 @@ def add_midway_nodes_2(goal_x, goal_y, current_undilated_node_number, undilated_
         # First, look for intersections, when a line is drawn from start point to goal point
         start_x = dilated_list_x[-1]
         start_y = dilated_list_y[-1]
-        intersection_found, intersections_data = check_intersection_with_neighbor([start_x, start_y], [goal_x, goal_y], polygon_list, neighbor_indices)
+        intersection_found, intersections_data = check_intersection_with_neighbor([start_x, start_y], [goal_x, goal_y], neighbor_edges)
         if intersection_found == True:
             # Intersection found. Move from the intersection point towards the dilating polygon line so that the intersection disappears.
             points_added = 0
@@ -415,7 +731,7 @@ def add_midway_nodes_2(goal_x, goal_y, current_undilated_node_number, undilated_
                     intersection_found = False
                     intersection_found, intersections_data = check_intersection_with_neighbor( [midway_nodes_backward[0][0], midway_nodes_backward[0][1]], 
                                                                                                [new_extra_point_x, new_extra_point_y], 
-                                                                                               polygon_list, neighbor_indices )
+                                                                                               neighbor_edges )
                 else:
                     # Moving backward from goal point towards start point
                     #print("  >Looking to add backward-direction midway point #%d" % points_added)
@@ -471,7 +787,7 @@ def add_midway_nodes_2(goal_x, goal_y, current_undilated_node_number, undilated_
                     intersection_found = False
                     intersection_found, intersections_data = check_intersection_with_neighbor( [midway_nodes_forward[-1][0], midway_nodes_forward[-1][1]], 
                                                                                                [new_extra_point_x, new_extra_point_y], 
-                                                                                               polygon_list, neighbor_indices )
+                                                                                               neighbor_edges )
                     
                     
         midway_nodes = midway_nodes_forward[1:] + midway_nodes_backward[:-1]
@@ -504,124 +820,60 @@ def remove_self_intersections(input_x, input_y):
     Go through the input polygon, and see if any of the edges get intersected by the other edges.
     If intersections are found, create a new node in the intersection point, and erase all nodes in between.
     NOTE: if the check starts inside a loop, e.g. a building exterior corners that are under 180 degrees, the loop might be preserved, while the rest of the building is erased!
+    The intersecting edges are found with a sort-and-sweep over the edge bounding boxes ('find_first_self_intersection()'), so that only edges near each other are checked with Shapely.
+    The loops are clipped in the same order, and with the same results, as when checking every edge pair in order (see 'tests/test_polygon_expansion.py').
     """
-    
     input_x, input_y = remove_duplicate_nodes(input_x, input_y)    
     
-    #print("input length: %d" % len(input_x))
     if len(input_x) > 8:
         # Move the starting point of the polygon until 5 successive edges can be found without 3-edge intersections, and set the middle one as the first edge.
-        # Looking at the actual polygons, there are several corners that are more than 3 edges long, leading to that long list of tests below...
-        for node_number in range(4, len(input_x)-4):
-            edge_0 = LineString( [(input_x[node_number-4], input_y[node_number-4]), (input_x[node_number-3], input_y[node_number-3])] )
-            edge_1 = LineString( [(input_x[node_number-3], input_y[node_number-3]), (input_x[node_number-2], input_y[node_number-2])] )
-            edge_2 = LineString( [(input_x[node_number-2], input_y[node_number-2]), (input_x[node_number-1], input_y[node_number-1])] )
-            edge_3 = LineString( [(input_x[node_number-1], input_y[node_number-1]), (input_x[node_number],   input_y[node_number])] )
-            edge_4 = LineString( [(input_x[node_number],   input_y[node_number]),   (input_x[node_number+1], input_y[node_number+1])] )
-            edge_5 = LineString( [(input_x[node_number+1], input_y[node_number+1]), (input_x[node_number+2], input_y[node_number+2])] )
-            edge_6 = LineString( [(input_x[node_number+2], input_y[node_number+2]), (input_x[node_number+3], input_y[node_number+3])] )
-            if edge_0.intersects(edge_2) == True:
-                continue
-            if edge_0.intersects(edge_3) == True:
-                continue
-            if edge_0.intersects(edge_4) == True:
-                continue
-            if edge_0.intersects(edge_5) == True:
-                continue
-            if edge_0.intersects(edge_6) == True:
-                continue
-            
-            if edge_1.intersects(edge_3) == True:
-                continue
-            if edge_1.intersects(edge_4) == True:
-                continue
-            if edge_1.intersects(edge_5) == True:
-                continue
-            if edge_1.intersects(edge_6) == True:
-                continue
-            
-            if edge_2.intersects(edge_4) == True:
-                continue
-            if edge_2.intersects(edge_5) == True:
-                continue
-            if edge_2.intersects(edge_6) == True:
-                continue
-            
-            if edge_3.intersects(edge_5) == True:
-                continue
-            if edge_3.intersects(edge_6) == True:
-                continue
-            
-            if edge_4.intersects(edge_6) == True:
-                continue
-            
-            # No intersection was found, select node[node_number] as the starting node, and modify the coordinate lists accordingly
-            #print("Moving polygon start point to node_number %d" % node_number)
+        node_number = find_polygon_start_node(input_x, input_y)
+        if node_number is not None:
             tmp_x = input_x[:node_number]
             input_x = input_x[node_number:] + tmp_x
             tmp_y = input_y[:node_number]
             input_y = input_y[node_number:] + tmp_y
-            break
 
     # Loop through the polygon, simplifying it        
-    found_intersection = True
-    intersection_point = []
-    first_clip_node_number = -1
-    last_clip_node_number = -1
-    while found_intersection == True:
-        #print("loop_start: 'found_intersection':", found_intersection)
-        found_intersection = False
-        for node_number in range(len(input_x)-1):
-            if found_intersection == True:
-                break
-            current_edge = LineString( [(input_x[node_number], input_y[node_number]), (input_x[node_number+1], input_y[node_number+1])] )
-            for test_node_number in range(len(input_x)-1):
-                if test_node_number >= node_number-1 and test_node_number <= node_number+1:
-                    continue
-                #print("Testing %d" % test_node_number)
-                test_edge = LineString( [(input_x[test_node_number], input_y[test_node_number]), (input_x[test_node_number+1], input_y[test_node_number+1])] )
-                if test_edge.intersects(current_edge) == True:
-                    # Create a new node at intersection point, and erase the nodes between them (in whichever direction there are less of them)
-                    found_intersection = True
-                    intersection_point = test_edge.intersection(current_edge)
-                    #print("  Found a new loop, trying to remove. node_number=%d, test_node_number=%d" % (node_number, test_node_number) )
-                    diff = abs(test_node_number-node_number)
-                    #print("    Diff: %d, total nodes: %d" % (diff, len(input_x)) )
-                    if diff < (len(input_x)/2.0):
-                        # Most polygon nodes are outside the two nodes (loop is between them)
-                        if node_number < test_node_number:
-                            first_clip_node_number = node_number+1
-                            last_clip_node_number = test_node_number
-                        else:
-                            first_clip_node_number = test_node_number+1
-                            last_clip_node_number = node_number
-                        #print("    --> Erasing between. First clip number=%d,last clip number=%d" % (first_clip_node_number, last_clip_node_number) )
-                        # Create the new node right before the node[first_clip_node_number] (and update the clip numbers)
-                        new_x = intersection_point.x
-                        new_y = intersection_point.y
-                        input_x.insert(first_clip_node_number, new_x)
-                        input_y.insert(first_clip_node_number, new_y)
-                        first_clip_node_number += 1
-                        last_clip_node_number += 1               
-                        input_x = input_x[:first_clip_node_number] + input_x[last_clip_node_number+1:]
-                        input_y = input_y[:first_clip_node_number] + input_y[last_clip_node_number+1:]
-                    else:
-                        # Most polygon nodes are between the two nodes, erasure wraps around
-                        if node_number < test_node_number:
-                            first_clip_node_number = test_node_number # In the end of polygon chain, but first to be deleted
-                            last_clip_node_number = node_number
-                        else:
-                            first_clip_node_number = node_number
-                            last_clip_node_number = test_node_number
-                        #print("    --> Erasing outside. First clip number=%d,last clip number=%d" % (first_clip_node_number, last_clip_node_number) )
-                        # Some issue with the new node creation, fix later. For now, combine loose ends right before returning from the function
-                        first_clip_node_number += 1
-                        input_x = input_x[:first_clip_node_number]
-                        input_x = input_x[last_clip_node_number:] 
-                        input_y = input_y[:first_clip_node_number]
-                        input_y = input_y[last_clip_node_number:]
-                        
-                    break
+    while True:
+        intersection = find_first_self_intersection(input_x, input_y)
+        if intersection is None:
+            break
+        node_number, test_node_number, intersection_point = intersection
+        # Create a new node at intersection point, and erase the nodes between them (in whichever direction there are less of them)
+        diff = abs(test_node_number-node_number)
+        if diff < (len(input_x)/2.0):
+            # Most polygon nodes are outside the two nodes (loop is between them)
+            if node_number < test_node_number:
+                first_clip_node_number = node_number+1
+                last_clip_node_number = test_node_number
+            else:
+                first_clip_node_number = test_node_number+1
+                last_clip_node_number = node_number
+            # Create the new node right before the node[first_clip_node_number] (and update the clip numbers)
+            new_x = intersection_point.x
+            new_y = intersection_point.y
+            input_x.insert(first_clip_node_number, new_x)
+            input_y.insert(first_clip_node_number, new_y)
+            first_clip_node_number += 1
+            last_clip_node_number += 1               
+            input_x = input_x[:first_clip_node_number] + input_x[last_clip_node_number+1:]
+            input_y = input_y[:first_clip_node_number] + input_y[last_clip_node_number+1:]
+        else:
+            # Most polygon nodes are between the two nodes, erasure wraps around
+            if node_number < test_node_number:
+                first_clip_node_number = test_node_number # In the end of polygon chain, but first to be deleted
+                last_clip_node_number = node_number
+            else:
+                first_clip_node_number = node_number
+                last_clip_node_number = test_node_number
+            # Some issue with the new node creation, fix later. For now, combine loose ends right before returning from the function
+            first_clip_node_number += 1
+            input_x = input_x[:first_clip_node_number]
+            input_x = input_x[last_clip_node_number:] 
+            input_y = input_y[:first_clip_node_number]
+            input_y = input_y[last_clip_node_number:]
+            
     if input_x[0] != input_x[len(input_x)-1]:
         # Fix for when looping around the polygon
         input_x.append(input_x[0])
@@ -630,12 +882,104 @@ def remove_self_intersections(input_x, input_y):
     return input_x, input_y
 
 
+def find_polygon_start_node(input_x, input_y):
+    """
+    Find the first node (from the fifth node on), around which 7 successive edges do not intersect each other (other than at the shared nodes of successive edges).
+    The edge pairs are prefiltered with 'may_segments_intersect()' all at once, and only the remaining pairs are checked with Shapely.
+    
+    Returns
+    -------
+    node_number : int
+        The node to start the polygon from, or None if no such node was found
+    """
+    nodes = np.column_stack([input_x, input_y])
+    edge_starts = nodes[:-1]
+    edge_ends = nodes[1:]
+    edge_count = len(edge_starts)
+    # Candidate pairs of edges 2...6 edges apart from each other
+    candidates = {}
+    for edge_difference in range(2, 7):
+        candidates[edge_difference] = may_segments_intersect(edge_starts[:edge_count-edge_difference], edge_ends[:edge_count-edge_difference], edge_starts[edge_difference:], edge_ends[edge_difference:])
+    edge_lines = {}
+    edge_intersections = {}
+    def get_edge_line(edge_number):
+        if edge_number not in edge_lines:
+            edge_lines[edge_number] = LineString( [(input_x[edge_number], input_y[edge_number]), (input_x[edge_number+1], input_y[edge_number+1])] )
+        return edge_lines[edge_number]
+    
+    for node_number in range(4, len(input_x)-4):
+        window_intersects = False
+        for first_edge in range(node_number-4, node_number+1):
+            for second_edge in range(first_edge+2, node_number+3):
+                if candidates[second_edge-first_edge][first_edge] == False:
+                    continue
+                if (first_edge, second_edge) not in edge_intersections:
+                    edge_intersections[(first_edge, second_edge)] = get_edge_line(first_edge).intersects(get_edge_line(second_edge))
+                if edge_intersections[(first_edge, second_edge)] == True:
+                    window_intersects = True
+                    break
+            if window_intersects == True:
+                break
+        if window_intersects == False:
+            return node_number
+    return None
+
+
+def find_first_self_intersection(input_x, input_y):
+    """
+    Find the first pair of non-successive polygon edges that intersect, in the order of checking every edge pair
+    (the edge with the smallest node number, and its intersecting edge with the smallest node number). The edge closing the polygon is not included.
+    Edge pairs whose bounding boxes overlap are found with a sort-and-sweep along the X axis, prefiltered with 'may_segments_intersect()', and checked with Shapely in order.
+    
+    Returns
+    -------
+    intersection : [int, int, shapely.geometry.Point]
+        Node numbers of the first nodes of the two edges, and their intersection point. None if the edges do not intersect.
+    """
+    edge_count = len(input_x) - 1
+    if edge_count < 3:
+        return None
+    nodes = np.column_stack([input_x, input_y])
+    edge_starts = nodes[:-1]
+    edge_ends = nodes[1:]
+    edge_min_x = np.minimum(edge_starts[:,0], edge_ends[:,0])
+    edge_max_x = np.maximum(edge_starts[:,0], edge_ends[:,0])
+    
+    # Sweep along the X axis: each edge is paired with the edges starting (in X) before it ends
+    sweep_order = np.argsort(edge_min_x, kind='stable')
+    sweep_ends = np.searchsorted(edge_min_x[sweep_order], edge_max_x[sweep_order], side='right')
+    pair_counts = np.maximum(sweep_ends - np.arange(1, edge_count+1), 0)
+    pair_first_positions = np.repeat(np.arange(edge_count), pair_counts)
+    pair_second_positions = np.arange(np.sum(pair_counts)) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts) + pair_first_positions + 1
+    edges_0 = sweep_order[pair_first_positions]
+    edges_1 = sweep_order[pair_second_positions]
+    node_numbers = np.minimum(edges_0, edges_1)
+    test_node_numbers = np.maximum(edges_0, edges_1)
+    
+    # Successive edges always touch each other
+    is_candidate = test_node_numbers - node_numbers > 1
+    node_numbers = node_numbers[is_candidate]
+    test_node_numbers = test_node_numbers[is_candidate]
+    is_candidate = may_segments_intersect(edge_starts[node_numbers], edge_ends[node_numbers], edge_starts[test_node_numbers], edge_ends[test_node_numbers])
+    node_numbers = node_numbers[is_candidate]
+    test_node_numbers = test_node_numbers[is_candidate]
+    
+    check_order = np.lexsort((test_node_numbers, node_numbers))
+    for node_number, test_node_number in zip(node_numbers[check_order].tolist(), test_node_numbers[check_order].tolist()):
+        current_edge = LineString( [(input_x[node_number], input_y[node_number]), (input_x[node_number+1], input_y[node_number+1])] )
+        test_edge = LineString( [(input_x[test_node_number], input_y[test_node_number]), (input_x[test_node_number+1], input_y[test_node_number+1])] )
+        if test_edge.intersects(current_edge) == True:
+            return [node_number, test_node_number, test_edge.intersection(current_edge)]
+    return None
+
 
-def dilate_polygon_with_neighbors(polygon, polygon_list, neighbor_indices):
+def dilate_polygon_with_neighbors(polygon, footprints, neighbor_indices):
     """
     dilate the input polygon as with the function 'dilate_polygon()', but control the dilation amount for the edges that are near other polygons.
     The first element in "neighbor_indices" is the input polygon itself.
     """
+    # The neighbor edges are collected once, as every dilated segment is checked against all of them
+    neighbor_edges = create_neighbor_edges(footprints, neighbor_indices)
     normals = []
     dilated_list_x = []
     dilated_list_y = []
@@ -700,7 +1044,7 @@ def dilate_polygon_with_neighbors(polygon, polygon_list, neighbor_indices):
         # Also, before adding the first node, check if the line drawn to it from the previous corner of the polygon would cross a neighbor, and if so, add an extra node to avoid that.
         intersection_found, intersections_data = check_intersection_with_neighbor( [undilated_list_x[undilated_corner_number], undilated_list_y[undilated_corner_number]], 
                                                                                    [new_x_1, new_y_1], 
-                                                                                   polygon_list, neighbor_indices )
+                                                                                   neighbor_edges )
         if intersection_found == True:
             print("  First new node from the corner is shortened.")
             # Adjust the dilated node so that it is positioned halfway between the two polygons
@@ -717,7 +1061,7 @@ def dilate_polygon_with_neighbors(polygon, polygon_list, neighbor_indices):
                                                undilated_corner_number, 
                                                undilated_list_x, undilated_list_y, 
                                                dilated_list_x, dilated_list_y, 
-                                               polygon_list, neighbor_indices )                
+                                               neighbor_edges )                
             for extra_node_number in range(len(midway_nodes)):
                 dilated_list_x.append(midway_nodes[extra_node_number][0])
                 dilated_list_y.append(midway_nodes[extra_node_number][1])
@@ -733,7 +1077,7 @@ def dilate_polygon_with_neighbors(polygon, polygon_list, neighbor_indices):
         new_y_2 = undilated_list_y[undilated_corner_number] + normalized_vn_2[1] * dilation_amount
         intersection_found, intersections_data = check_intersection_with_neighbor( [undilated_list_x[undilated_corner_number], undilated_list_y[undilated_corner_number]], 
                                                                                    [new_x_2, new_y_2], 
-                                                                                   polygon_list, neighbor_indices )
+                                                                                   neighbor_edges )
         if intersection_found == True:
             print("  Second new node from the corner is shortened.")
             intersection_point = intersections_data[0][0]
@@ -747,7 +1091,7 @@ def dilate_polygon_with_neighbors(polygon, polygon_list, neighbor_indices):
                                           undilated_corner_number, 
                                           undilated_list_x, undilated_list_y, 
                                           dilated_list_x, dilated_list_y, 
-                                          polygon_list, neighbor_indices )                
+                                          neighbor_edges )                
         for extra_node_number in range(len(midway_nodes)):
             dilated_list_x.append(midway_nodes[extra_node_number][0])
             dilated_list_y.append(midway_nodes[extra_node_number][1])    
@@ -761,7 +1105,7 @@ def dilate_polygon_with_neighbors(polygon, polygon_list, neighbor_indices):
                                        len(undilated_list_x)-1, 
                                        undilated_list_x, undilated_list_y, 
                                        dilated_list_x, dilated_list_y, 
-                                       polygon_list, neighbor_indices )                
+                                       neighbor_edges )                
     for extra_node_number in range(len(midway_nodes)):
         dilated_list_x.append(midway_nodes[extra_node_number][0])
         dilated_list_y.append(midway_nodes[extra_node_number][1])
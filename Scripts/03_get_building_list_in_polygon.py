@@ -1,4 +1,6 @@
+import numpy as np
 import matplotlib.path as matplotlibpath
+import footprint_table as footprinttable
 
 """
 Get all buildings inside a polygon.
@@ -7,7 +9,7 @@ The polygon should be set in such a way that it contains all target buildings co
 The polygon coordinates can be created by picking latitude/longitude coordinates of the target points, and using the script 'epsg_converter.py' to convert them into the coordinate system used.
 """
 
-footprints_file = "S:/OSS/Data/Footprints/test_footprint_0m_dilation.txt" # 0-dilation polygon is used here.
+footprints_file = "S:/OSS/Data/Footprints/test_footprint_0m_dilation.txt" # 0-dilation polygon is used here. Text or .npz footprint file (see 'footprint_table.py')
 output_file = "S:/OSS/Data/buildings.txt"
 polygon_points = [[3770.369092, -193340.996670],
                   [3785.942776, -193332.554141],
@@ -20,19 +22,18 @@ def main():
     path = matplotlibpath.Path(polygon_points)
     accepted_buildings = []
     checked_num = 0
-    with open(footprints_file, 'r') as polygons_file:
-        input_data = polygons_file.readlines()
-        for line in input_data:
-            words = line.split()
-            object_name = str(words[0])
-            building_name = object_name[0:-4]
-            x = float(words[2])
-            y = float(words[3])
-            building_point = [[x, y]]
-            is_inside = path.contains_points(building_point)
-            if is_inside[0] == True:
-                accepted_buildings.append("\"" + object_name + "\",")
-            checked_num += 1
+    footprints = footprinttable.load_footprint_table(footprints_file)
+    # Test the first node of every building at once
+    has_nodes = footprints['offsets'][1:] > footprints['offsets'][:-1]
+    first_nodes = footprints['coordinates'][footprints['offsets'][:-1][has_nodes]]
+    is_inside = np.zeros(len(footprints['names']), dtype=bool)
+    if len(first_nodes) > 0:
+        is_inside[has_nodes] = path.contains_points(first_nodes)
+    for building_number in range(len(footprints['names'])):
+        object_name = footprints['names'][building_number]
+        if is_inside[building_number] == True:
+            accepted_buildings.append("\"" + object_name + "\",")
+        checked_num += 1
     print( "Checked {num} buildings, found {num2} inside the polygon:".format(num=checked_num, num2=len(accepted_buildings)) )
     print( accepted_buildings )
     print("-->Writing to {filename}".format(filename=output_file))
@@ -3,8 +3,13 @@ import open3d as o3d
 import laspy
 import numpy as np
 import matplotlib.path as matplotlibpath
+import matplotlib.transforms as matplotlibtransforms
 import time
-import copy
+import concurrent.futures
+from rtree import index as rtreeindex
+import create_dataset_tile_cache as tilecache
+import job_manifest as jobmanifest
+import footprint_table as footprinttable
 
 """
 NOTE: To use this script, a segmented and aligned point cloud dataset is required for input.
@@ -20,7 +25,7 @@ Both the aligned and unaligned versions of the building point clouds are outputt
 """
 
 
-building_polygons_file    = "S:/OSS/Data/Footprints/test_footprint_2_0m_dilation.txt"
+building_polygons_file    = "S:/OSS/Data/Footprints/test_footprint_2_0m_dilation.txt" # Text or .npz footprint file (see 'footprint_table.py')
 bounds_file               = "S:/OSS/Data/las_bounds.txt"
 input_dataset_path        = "S:/OSS/Data/Test_segmented_data/"
 aligned_output_path       = "S:/OSS/Data/Aligned_point_clouds/"
@@ -30,6 +35,21 @@ visualize_alignment_steps = False
 radius_normal             = 0.4
 matching_resolution       = 0.02
 force_las_output          = True
+compress_output           = False # If True, LAS outputs are written as compressed LAZ files (used together with 'force_las_output')
+las_chunk_size            = 2000000 # Number of points read from a point cloud file at a time. Limits the peak memory use regardless of the file size.
+prefilter_grid_cell_size  = 2.0 # Cell size (in meters) of a coarse grid laid over each building polygon. Points in cells completely inside or outside the polygon skip the exact polygon test. Set to 0.0 to only use the bounding box prefilter.
+tile_major_extraction     = False # If True, read each point cloud file only once and assign its points to every building overlapping it. Much faster when processing many neighboring buildings.
+worker_count              = 1     # Number of processes to process buildings in. If larger than 1, buildings are grouped by the point cloud files they share, and the groups are processed in parallel (tile-major within each group).
+worker_memory_budget_gb   = 32.0  # Memory available to all workers together. Each group is limited so that the total size of its point cloud files fits into one worker's share of this.
+alignment_method          = "leave_one_out" # 'leave_one_out': align each scan against the combination of all other scans. 'pose_graph': register each overlapping scan pair once, and solve all scan poses together (much faster for buildings with many scans).
+pairwise_registration_workers = 4 # Number of threads registering scan pairs in the 'pose_graph' alignment method
+pose_graph_neighbor_count = 4     # In the 'pose_graph' alignment method, each scan is registered only against this many scans overlapping it the most
+use_icp_pyramid           = False # If True, scans are registered with a coarse-to-fine ICP defined by 'icp_pyramid_levels', instead of a single ICP at 0.2 m resolution
+icp_pyramid_levels        = [[1.0, 5.0, 30], [0.4, 1.5, 30], [0.2, 0.5, 30]] # Voxel size, matching distance and maximum iterations of each level, coarsest first. The last level uses point-to-plane ICP with normals estimated within 'radius_normal'.
+icp_pyramid_coarse_tolerance = 1e-4 # Relative fitness and RMS error change below which the ICP of a coarse pyramid level stops, as the finer levels refine the result anyway. The finest level uses Open3D's default tolerances (1e-6).
+tile_cache_path           = None  # Folder of the tile cache written by 'create_dataset_tile_cache.py'. If set, points are read from the memory-mapped cache instead of decoding the point cloud files, and only the cached grid cells overlapping the building are touched.
+preserve_point_records    = True  # If True, LAS outputs keep the full point records of the source files (intensity, GPS time, return numbers, RGB, ...) in the source point format and scales. Only the coordinates are changed by the alignment. If False, only positions, point cloud IDs and labels are written, in point format 3.
+job_manifest_file         = None  # JSON-lines manifest (see 'job_manifest.py') recording the status, input hash, parameters, timings and point count of each building. If set, a building is skipped only if it was completed with the same input files, polygon and parameters. If None, a building is skipped if its aligned output file exists.
 
 input_building_list       = ["building_349.obj"] # Insert comma-separated building object files.
 
@@ -41,95 +61,166 @@ def main():
     print(input_building_list)
     print("\n")
     
+    # Load the dataset bounds into a spatial index once, so that candidate point clouds can be found quickly for every building
+    las_bounds = load_las_bounds(bounds_file)
+    manifest = {}
+    if job_manifest_file is not None:
+        manifest = jobmanifest.load_manifest(job_manifest_file)
+    
     # Go through each building and search the input dataset for points inside their large-dilation footprint polygons
-    with open(building_polygons_file, 'r') as polygon_file:
-        process_start_time = time.time()
-        
-        polygon_file_data = polygon_file.readlines()
-        total_building_count_in_dataset = len(polygon_file_data)
-        processed_buildings = 0
-        buildings_to_process = len(input_building_list)
-
-        for data_number in range(0,total_building_count_in_dataset):
-
-            # Check polygon file data against the list of buildings to process
-            building_data = polygon_file_data[data_number]
-            words = building_data.split()
-            lod2_filename = str(words[0])
-            if lod2_filename not in input_building_list:
-                continue
+    footprints = footprinttable.load_footprint_table(building_polygons_file)
+    process_start_time = time.time()
+    
+    total_building_count_in_dataset = len(footprints['names'])
+    processed_buildings = 0
+    buildings_to_process = len(input_building_list)
+    building_names_to_process = set(input_building_list)
+    collected_buildings = []
+
+    for data_number in range(0,total_building_count_in_dataset):
 
-            # Get output name
-            print("Processing LOD2 file '%s' (%d/%d)..." % (lod2_filename, (processed_buildings+1), buildings_to_process) )
-            output_point_cloud_filename = str(words[1])
-            if force_las_output == True:
+        # Check polygon file data against the list of buildings to process
+        lod2_filename = footprints['names'][data_number]
+        if lod2_filename not in building_names_to_process:
+            continue
+
+        # Get output name
+        print("Processing LOD2 file '%s' (%d/%d)..." % (lod2_filename, (processed_buildings+1), buildings_to_process) )
+        output_point_cloud_filename = footprints['point_cloud_names'][data_number]
+        if force_las_output == True:
+            if compress_output == True:
+                output_point_cloud_filename = output_point_cloud_filename[:-4] + ".laz"
+            else:
                 output_point_cloud_filename = output_point_cloud_filename[:-4] + ".las"
-                
-            # Check if output exists already
-            complete_output_filename = os.path.join( aligned_output_path, output_point_cloud_filename )
-            if os.path.exists(complete_output_filename) == True:
-                print("  output file already exists. Skipping this building...")
-                continue
 
-            # Get point clouds from the LiDAR dataset that might contain building data
-            building_start_time = time.time()
-            nodes = []
-            for node_number in range(2, len(words), 2):
-                node_position = [ float(words[node_number]), float(words[node_number+1]) ]
-                nodes.append(node_position)
-            point_cloud_file_list = search_las_dataset(nodes)
+        # Get point clouds from the LiDAR dataset that might contain building data
+        building_start_time = time.time()
+        nodes = footprinttable.get_polygon(footprints, data_number).tolist()
+        point_cloud_file_list = search_las_dataset(nodes, las_bounds)
+        building = {
+            'name': lod2_filename,
+            'output_name': output_point_cloud_filename,
+            'polygon': nodes,
+            'file_list': point_cloud_file_list,
+            'job_hash': None
+        }
+        
+        # Check if the building has been processed already
+        if job_manifest_file is not None:
+            building['job_hash'] = get_building_job_hash(building)
+            if jobmanifest.is_job_done(manifest, lod2_filename, building['job_hash']) == True:
+                print("  building already processed with the same inputs and parameters. Skipping this building...")
+                continue
+        elif os.path.exists(get_output_filenames(output_point_cloud_filename)[0]) == True:
+            print("  output file already exists. Skipping this building...")
+            continue
+        
+        # Get all the target building points from the chosen point clouds and process
+        if len(point_cloud_file_list) > 0 and (tile_major_extraction == True or worker_count > 1):
+            # Points are collected later, when every building is known, so that each point cloud file is read only once
+            collected_buildings.append(building)
+        elif len(point_cloud_file_list) > 0:
+            record_building_job(building, jobmanifest.JOB_STATUS_STARTED)
+            try:
+                point_count = combine_points_in_target_polygon(point_cloud_file_list, nodes, output_point_cloud_filename)
+            except Exception as error:
+                print("  Processing the building failed: %s" % error)
+                record_building_job(building, jobmanifest.JOB_STATUS_FAILED, processing_time=time.time()-building_start_time, error=str(error))
+                processed_buildings += 1
+                continue
+            elapsed_building_time = time.time() - building_start_time
+            record_building_job(building, jobmanifest.JOB_STATUS_DONE, point_count, elapsed_building_time)
+            print("All input data for this building processed. Total elapsed time: {num} seconds".format(num=elapsed_building_time))                
+        else:
+            print(" No points found for this building...")
+            record_building_job(building, jobmanifest.JOB_STATUS_DONE, 0, 0.0)
             
-            # Get all the target building points from the chosen point clouds and process
-            if len(point_cloud_file_list) > 0:
-                combine_points_in_target_polygon(point_cloud_file_list, nodes, output_point_cloud_filename)
-                elapsed_building_time = time.time() - building_start_time
-                print("All input data for this building processed. Total elapsed time: {num} seconds".format(num=elapsed_building_time))                
-            else:
-                print(" No points found for this building...")
-                
-            processed_buildings += 1
-        elapsed_process_time = time.time() - process_start_time
-        print("All input data for this building processed. Total elapsed time: {num} seconds".format(num=elapsed_process_time))
+        processed_buildings += 1
+    if len(collected_buildings) > 0:
+        if worker_count > 1:
+            building_results = schedule_buildings(collected_buildings)
+        else:
+            building_results = process_buildings_tile_major(collected_buildings)
+        print_building_timings(building_results)
+    elapsed_process_time = time.time() - process_start_time
+    print("All input data for this building processed. Total elapsed time: {num} seconds".format(num=elapsed_process_time))
     print("Done")
     
     
-def search_las_dataset(target_polygon):
+def load_las_bounds(bounds_filename):
+    """
+    Read the bounds file created by 'create_dataset_bounding_box_list.py', and bulk-load the 2D bounding boxes of the point clouds into an R-tree.
+    
+    Parameters
+    ----------
+    bounds_filename : string
+        Full path and filename of the bounds file
+    
+    Returns
+    -------
+    las_bounds : dict
+        'filenames' : List<string> of point cloud filenames, in the order they are listed in the bounds file
+        'bounds'    : Numpy.array ([N,4]) of min_x, min_y, max_x, max_y of each point cloud
+        'index'     : R-tree index of the bounding boxes, with the position in 'filenames' as the id
+    """
+    start_time = time.time()
+    filenames = []
+    bounds = []
+    with open(bounds_filename, 'r') as f:
+        for line in f:
+            words = line.split()
+            if len(words) < 7:
+                continue
+            filenames.append(str(words[0]))
+            bounds.append([float(words[1]), float(words[2]), float(words[4]), float(words[5])])
+    bounds = np.asarray(bounds, dtype=np.float64).reshape((-1, 4))
+    if len(filenames) > 0:
+        # Bulk loading from a stream packs the tree (Sort-Tile-Recursive), which is faster to build and to query than inserting one by one
+        spatial_index = rtreeindex.Index( (i, tuple(bounds[i]), None) for i in range(len(filenames)) )
+    else:
+        spatial_index = rtreeindex.Index()
+    elapsed_time = time.time() - start_time
+    print( "Loaded bounds of %d point cloud files, elapsed time: %f seconds" % (len(filenames), elapsed_time) )
+    las_bounds = {
+        'filenames': filenames,
+        'bounds': bounds,
+        'index': spatial_index
+    }
+    return las_bounds
+
+
+def search_las_dataset(target_polygon, las_bounds):
     """
     Get a list of las files that contain data in the target polygon coordinates.
-    Note: It is possible that the target polygon's points won't be inside the .las file's bounding box, but some of its edges still cross it. Ignoring this case as an outlier for now.
+    Candidates are found by querying the R-tree with the polygon bounding box, and then each candidate bounding box is tested against the polygon itself,
+    so that point clouds are found also when only the polygon edges cross the bounding box, or the bounding box is completely inside the polygon.
     
     Parameters
     ----------
     target_polygon : List<[Numpy.array]>
         List of 2D points that define a closed polygon in the horizontal plane, enclosing the target building
+    las_bounds : dict
+        Point cloud bounds and their spatial index, as returned by 'load_las_bounds()'
     
     Returns
     -------
-    aligned_lidar_point_clouds : List<Open3D.geometry.PointCloud>
-        Building point clouds, aligned against each other
-    unaligned_lidar_point_clouds : List<Open3D.geometry.PointCloud>
-        Building point clouds, unaligned, as they were scanned.
+    file_list : List<string>
+        Filenames of the point clouds whose bounding boxes intersect the target polygon
     """
     start_time = time.time()
     file_list = []
     print( "Searching for candidate point clouds..." )
-    with open(bounds_file, 'r') as f:
-        data = f.readlines()
-        for line in data:
-            words = line.split()
-            filename = str(words[0])
-            min_x = float(words[1])
-            min_y = float(words[2])            
-            max_x = float(words[4])
-            max_y = float(words[5])            
-            polygon_point_count = len(target_polygon) # How many coordinate pairs
-            for i in range(polygon_point_count):    
-                coordinates = target_polygon[i]
-                if coordinates[0] > min_x and coordinates[0] < max_x:
-                    if coordinates[1] > min_y and coordinates[1] < max_y:
-                        print("  Found file: %s" % filename )
-                        file_list.append(filename)
-                        break
+    polygon = np.asarray(target_polygon, dtype=np.float64)
+    polygon_bbox = (np.min(polygon[:,0]), np.min(polygon[:,1]), np.max(polygon[:,0]), np.max(polygon[:,1]))
+    path = matplotlibpath.Path(polygon)
+    candidates = sorted(las_bounds['index'].intersection(polygon_bbox))
+    for candidate in candidates:
+        min_x, min_y, max_x, max_y = las_bounds['bounds'][candidate]
+        bbox = matplotlibtransforms.Bbox([[min_x, min_y], [max_x, max_y]])
+        if path.intersects_bbox(bbox, filled=True) == True:
+            filename = las_bounds['filenames'][candidate]
+            print("  Found file: %s" % filename )
+            file_list.append(filename)
                     
     elapsed_time = time.time() - start_time
     print( "Collected %d files, elapsed time: %f seconds" % (len(file_list), elapsed_time) )
@@ -148,9 +239,15 @@ def combine_points_in_target_polygon(file_list, target_polygon, output_name):
         List of 2D points that define a closed polygon in the horizontal plane, enclosing the target building
     output_name : string
         Filename to output results into
+    
+    Returns
+    -------
+    point_count : int
+        Number of points written
     """
     
     inside_points_list = []
+    polygon_filter = create_polygon_filter(target_polygon)
     print( "Masking points in each candidate file with the target polygon..." )
     for i in range(len(file_list)):
         
@@ -158,87 +255,696 @@ def combine_points_in_target_polygon(file_list, target_polygon, output_name):
         input_file = os.path.join( input_dataset_path, file_list[i] )
         print( "  point cloud #{num}: {name}...".format(num=i, name=input_file) )
         
-        las = laspy.read(input_file)
-        xyz = np.vstack([las.x, las.y, las.z]).transpose()
-        xy = np.vstack([las.x, las.y]).transpose()
-        point_cloud_ids = las.user_data
-        point_cloud_ids = np.asarray(point_cloud_ids)
-        point_cloud_ids = np.reshape(point_cloud_ids, (-1,1))
-        labels = las.classification
-        labels = np.asarray(labels)
-        labels = np.reshape(labels, (-1, 1))
-        
-        path = matplotlibpath.Path(target_polygon)
-        in_out_points = path.contains_points(xy)
+        inside_chunks = []
+        for xyz, point_cloud_ids, labels, point_records in read_las_chunks(input_file, polygon_filter['bbox']):
+            inside_chunks.append( get_points_in_polygon(xyz, point_cloud_ids, labels, point_records, polygon_filter) )
+        inside_points = concatenate_points(inside_chunks)
         print("    calculated in/out mask...")
-        inside_points = []
-        inside_point_cloud_ids = []
-        inside_labels = []
         
-        inside_points = np.asarray(xyz[in_out_points])
-        inside_point_cloud_ids = np.asarray(point_cloud_ids[in_out_points])
-        inside_labels = np.asarray(labels[in_out_points])
+        print( "    found %d points" % len(inside_points[0]) )
+        if len(inside_points[0]) > 0:
+            inside_points_list.append(inside_points)
+        
+        elapsed_time = time.time() - start_time
+        print("      elapsed time:", elapsed_time)
         
-        print( "    found %d points" % len(inside_points) )
-        if len(inside_points) > 0:
-            inside_points_list.append([inside_points, inside_point_cloud_ids, inside_labels])            
+    return align_and_write_points(inside_points_list, output_name)
+
+
+def get_output_filenames(output_name):
+    """
+    Get the full paths of the aligned and unaligned output files of a building.
+    """
+    aligned_output_filename = os.path.join( aligned_output_path, "aligned_" + output_name )
+    unaligned_output_filename = os.path.join( unaligned_output_path, "unaligned_" + output_name )
+    return [aligned_output_filename, unaligned_output_filename]
+
+
+def get_building_job_hash(building):
+    """
+    Hash the candidate point cloud files, polygon and output-affecting parameters of a building, to detect whether it needs to be processed again (see 'job_manifest.py').
+    """
+    input_files = [os.path.join(input_dataset_path, filename) for filename in building['file_list']]
+    return jobmanifest.compute_input_hash(input_files, {'polygon': building['polygon'], 'parameters': get_job_parameters()})
+
+
+def get_job_parameters():
+    """
+    Get the parameters affecting the outputs of a building, recorded into the job manifest.
+    """
+    return {
+        'alignment_method': alignment_method,
+        'pose_graph_neighbor_count': pose_graph_neighbor_count,
+        'use_icp_pyramid': use_icp_pyramid,
+        'icp_pyramid_levels': icp_pyramid_levels,
+        'icp_pyramid_coarse_tolerance': icp_pyramid_coarse_tolerance,
+        'preserve_point_records': preserve_point_records,
+        'force_las_output': force_las_output,
+        'compress_output': compress_output
+    }
+
+
+def record_building_job(building, status, point_count=None, processing_time=None, error=None):
+    """
+    Append the status of a building into the job manifest, if 'job_manifest_file' is set. The outputs are only recorded for buildings that got points written.
+    """
+    if job_manifest_file is None:
+        return
+    outputs = []
+    if status == jobmanifest.JOB_STATUS_DONE and point_count is not None and point_count > 0:
+        outputs = get_output_filenames(building['output_name'])
+    jobmanifest.append_manifest_entry(job_manifest_file, {
+        'job': building['name'],
+        'status': status,
+        'input_hash': building['job_hash'],
+        'parameters': get_job_parameters(),
+        'outputs': outputs,
+        'point_count': point_count,
+        'processing_time': processing_time,
+        'error': error
+    })
+
+
+def process_buildings_tile_major(buildings):
+    """
+    Collect the points of many buildings while reading each candidate point cloud file only once.
+    Every file is read, its points are labelled with all building footprints containing them (see 'label_points_with_footprints()'), and the results are appended to per-building buffers.
+    As soon as all candidate files of a building have been read, the building is aligned and written out, and its buffer is released.
+    
+    Parameters
+    ----------
+    buildings : List<dict>
+        Buildings to process. Each contains 'name', 'output_name', 'polygon' (list of 2D points), 'file_list' (candidate point cloud files from 'search_las_dataset()')
+        and 'job_hash' (see 'get_building_job_hash()', None if the job manifest is not used)
+    
+    Returns
+    -------
+    building_results : List<dict>
+        For each processed building, its 'name', written 'point_count', 'processing_time' (alignment and output) and 'completion_time' (seconds since the start of this call)
+    """
+    # Invert the building -> files mapping. Files are ordered by the first building needing them, so that buildings get completed (and their buffers freed) early.
+    file_to_buildings = {}
+    remaining_file_counts = []
+    for building_number in range(len(buildings)):
+        file_list = buildings[building_number]['file_list']
+        for filename in file_list:
+            if filename not in file_to_buildings:
+                file_to_buildings[filename] = []
+            file_to_buildings[filename].append(building_number)
+        remaining_file_counts.append(len(file_list))
+    
+    footprint_index = create_footprint_index([building['polygon'] for building in buildings])
+    building_buffers = [[] for building in buildings]
+    completed_buildings = 0
+    building_results = []
+    group_start_time = time.time()
+    print( "Reading %d point cloud files for %d buildings..." % (len(file_to_buildings), len(buildings)) )
+    for file_number, filename in enumerate(file_to_buildings):
+        start_time = time.time()
+        input_file = os.path.join( input_dataset_path, filename )
+        building_numbers = file_to_buildings[filename]
+        print( "  point cloud #{num}: {name}, {count} buildings...".format(num=file_number, name=input_file, count=len(building_numbers)) )
         
+        inside_chunks = {}
+        for building_number in building_numbers:
+            inside_chunks[building_number] = []
+        building_bboxes = np.array([footprint_index['filters'][building_number]['bbox'] for building_number in building_numbers])
+        query_bbox = [np.min(building_bboxes[:,0]), np.min(building_bboxes[:,1]), np.max(building_bboxes[:,2]), np.max(building_bboxes[:,3])]
+        for xyz, point_cloud_ids, labels, point_records in read_las_chunks(input_file, query_bbox):
+            building_point_indices = label_points_with_footprints(xyz[:,0], xyz[:,1], footprint_index, building_numbers)
+            for building_number in building_point_indices:
+                point_indices = building_point_indices[building_number]
+                inside_chunks[building_number].append([xyz[point_indices], point_cloud_ids[point_indices], labels[point_indices], select_point_records(point_records, point_indices)])
+        for building_number in building_numbers:
+            inside_points = concatenate_points(inside_chunks[building_number])
+            if len(inside_points[0]) > 0:
+                building_buffers[building_number].append(inside_points)
+            remaining_file_counts[building_number] -= 1
         elapsed_time = time.time() - start_time
         print("      elapsed time:", elapsed_time)
         
+        # Finish the buildings that have no more files left to read
+        for building_number in building_numbers:
+            if remaining_file_counts[building_number] > 0:
+                continue
+            completed_buildings += 1
+            building = buildings[building_number]
+            print( "Processing building '%s' (%d/%d)..." % (building['name'], completed_buildings, len(buildings)) )
+            building_start_time = time.time()
+            record_building_job(building, jobmanifest.JOB_STATUS_STARTED)
+            try:
+                point_count = align_and_write_points(building_buffers[building_number], building['output_name'])
+                record_building_job(building, jobmanifest.JOB_STATUS_DONE, point_count, time.time() - building_start_time)
+            except Exception as error:
+                print( "  Processing building '%s' failed: %s" % (building['name'], error) )
+                record_building_job(building, jobmanifest.JOB_STATUS_FAILED, processing_time=time.time() - building_start_time, error=str(error))
+                point_count = None
+            building_buffers[building_number] = None
+            building_results.append({
+                'name': building['name'],
+                'point_count': point_count,
+                'processing_time': time.time() - building_start_time,
+                'completion_time': time.time() - group_start_time
+            })
+    return building_results
+
+
+def schedule_buildings(buildings):
+    """
+    Process buildings in parallel in 'worker_count' processes.
+    Buildings are split into groups of buildings sharing point cloud files (see 'group_buildings_by_files()'), and each group is processed in tile-major order by one worker,
+    so that a point cloud file is read as few times as possible.
+    
+    Parameters
+    ----------
+    buildings : List<dict>
+        Buildings to process, as in 'process_buildings_tile_major()'
+    
+    Returns
+    -------
+    building_results : List<dict>
+        Point count and timings of each processed building, as returned by 'process_buildings_tile_major()'
+    """
+    building_groups = group_buildings_by_files(buildings)
+    print( "Processing %d buildings in %d groups with %d workers..." % (len(buildings), len(building_groups), worker_count) )
+    building_results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) as executor:
+        futures = {}
+        for group_number in range(len(building_groups)):
+            future = executor.submit(process_buildings_tile_major, building_groups[group_number])
+            futures[future] = group_number
+        for future in concurrent.futures.as_completed(futures):
+            group_number = futures[future]
+            try:
+                group_results = future.result()
+            except Exception as error:
+                print( "Group #%d failed: %s" % (group_number, error) )
+                for building in building_groups[group_number]:
+                    building_results.append({'name': building['name'], 'point_count': None, 'processing_time': None, 'completion_time': None})
+                continue
+            print( "Group #%d done (%d buildings)" % (group_number, len(group_results)) )
+            building_results += group_results
+    return building_results
+
+
+def group_buildings_by_files(buildings):
+    """
+    Split the buildings into groups, so that buildings sharing point cloud files end up in the same group.
+    Buildings are connected through the files they share, and each connected set is walked through file by file, so that neighboring buildings are next to each other.
+    The walk is then cut into groups whose total size of point cloud files fits into one worker's share of 'worker_memory_budget_gb', and that are small enough
+    to give every worker several groups (so that the work stays balanced, even if all buildings are connected).
+    
+    Parameters
+    ----------
+    buildings : List<dict>
+        Buildings to process, as in 'process_buildings_tile_major()'
+    
+    Returns
+    -------
+    building_groups : List<List<dict>>
+        Groups of buildings, largest groups first
+    """
+    group_size_limit = worker_memory_budget_gb * 1024**3 / worker_count
+    group_building_limit = max(1, int(np.ceil(len(buildings) / (worker_count * 4.0))))
+    file_sizes = {}
+    file_to_buildings = {}
+    for building_number in range(len(buildings)):
+        for filename in buildings[building_number]['file_list']:
+            if filename not in file_to_buildings:
+                file_to_buildings[filename] = []
+                file_sizes[filename] = os.path.getsize( os.path.join(input_dataset_path, filename) )
+            file_to_buildings[filename].append(building_number)
+    
+    building_groups = []
+    visited = [False] * len(buildings)
+    for first_building_number in range(len(buildings)):
+        if visited[first_building_number] == True:
+            continue
+        # Breadth-first walk over the buildings connected to this one through shared files
+        visited[first_building_number] = True
+        queue = [first_building_number]
+        queue_position = 0
+        current_group = []
+        current_group_files = set()
+        current_group_size = 0
+        while queue_position < len(queue):
+            building_number = queue[queue_position]
+            queue_position += 1
+            building = buildings[building_number]
+            new_files = [filename for filename in building['file_list'] if filename not in current_group_files]
+            new_size = sum(file_sizes[filename] for filename in new_files)
+            if len(current_group) > 0 and (current_group_size + new_size > group_size_limit or len(current_group) >= group_building_limit):
+                building_groups.append(current_group)
+                current_group = []
+                current_group_files = set()
+                current_group_size = 0
+                new_files = building['file_list']
+                new_size = sum(file_sizes[filename] for filename in new_files)
+            current_group.append(building)
+            current_group_files.update(new_files)
+            current_group_size += new_size
+            for filename in building['file_list']:
+                for neighbor_number in file_to_buildings[filename]:
+                    if visited[neighbor_number] == False:
+                        visited[neighbor_number] = True
+                        queue.append(neighbor_number)
+        if len(current_group) > 0:
+            building_groups.append(current_group)
+    
+    # Start the largest groups first, so that a long group does not end up running alone at the end
+    building_groups.sort(key=len, reverse=True)
+    return building_groups
+
+
+def print_building_timings(building_results):
+    """
+    Print the point count and processing times of each building, and a summary of them.
+    """
+    print( "\nBuilding timings:" )
+    print( "  %-40s %12s %16s %16s" % ("building", "points", "processing (s)", "completed (s)") )
+    failed_count = 0
+    total_processing_time = 0.0
+    for result in sorted(building_results, key=lambda result: result['name']):
+        if result['point_count'] is None:
+            failed_count += 1
+            print( "  %-40s %12s" % (result['name'], "FAILED") )
+            continue
+        total_processing_time += result['processing_time']
+        print( "  %-40s %12d %16.2f %16.2f" % (result['name'], result['point_count'], result['processing_time'], result['completion_time']) )
+    print( "%d buildings processed, %d failed, total processing time %.2f seconds" % (len(building_results)-failed_count, failed_count, total_processing_time) )
+
+
+def read_las_chunks(input_file, query_bbox=None):
+    """
+    Read the point positions, point cloud IDs (user_data) and labels (classification) of a LAS/LAZ file, 'las_chunk_size' points at a time.
+    For a cloud-optimized (COPC, '.copc.laz') file, only the octree nodes overlapping 'query_bbox' are decoded, and returned as a single chunk.
+    If 'tile_cache_path' is set and the file has a valid cache, the points are read from the cache instead (see 'read_cached_tile_chunks()').
+    
+    Parameters
+    ----------
+    input_file : string
+        Full path and filename of the point cloud
+    query_bbox : List<float>
+        min_x, min_y, max_x, max_y of the area of interest, or None to read the whole file. Points outside the area can still be returned.
+    
+    Yields
+    ------
+    xyz : Numpy.array
+        Point positions ([N,3])
+    point_cloud_ids : Numpy.array
+        Point cloud IDs ([N,1])
+    labels : Numpy.array
+        Point labels ([N,1])
+    point_records : laspy.ScaleAwarePointRecord
+        The complete point records of the chunk, or None if 'preserve_point_records' is False
+    """
+    if tile_cache_path is not None:
+        cache_folder = tilecache.get_tile_cache_folder(tile_cache_path, input_file)
+        if tilecache.is_tile_cache_valid(input_file, cache_folder) == True:
+            yield from read_cached_tile_chunks(cache_folder, query_bbox)
+            return
+        print("    no valid tile cache found, reading the point cloud file instead...")
+    if query_bbox is not None and input_file.endswith(".copc.laz"):
+        with laspy.CopcReader.open(input_file) as reader:
+            mins = np.array([query_bbox[0], query_bbox[1], reader.header.mins[2]])
+            maxs = np.array([query_bbox[2], query_bbox[3], reader.header.maxs[2]])
+            point_chunks = [reader.query(bounds=laspy.copc.Bounds(mins, maxs))]
+            yield from iterate_point_chunks(point_chunks)
+        return
+    with laspy.open(input_file) as reader:
+        yield from iterate_point_chunks(reader.chunk_iterator(las_chunk_size))
+
+
+def read_cached_tile_chunks(cache_folder, query_bbox=None):
+    """
+    Read the points of a cached tile (see 'create_dataset_tile_cache.py') in chunks of at most 'las_chunk_size' points, yielding the same arrays as 'read_las_chunks()'.
+    The cached arrays are memory-mapped and sorted by grid cell, and only the cells overlapping 'query_bbox' are read from the disk.
+    """
+    tile_cache = tilecache.load_tile_cache(cache_folder)
+    scales = np.array(tile_cache['meta']['scales'])
+    offsets = np.array(tile_cache['meta']['offsets'])
+    point_ranges = tilecache.get_tile_cache_point_ranges(tile_cache, query_bbox)
+    for chunk_ranges in tilecache.split_point_ranges(point_ranges, las_chunk_size):
+        chunk_columns = {}
+        for column_name in ["x", "y", "z", "user_data", "classification", "records"]:
+            if column_name == "records" and preserve_point_records == False:
+                continue
+            column = tile_cache[column_name]
+            if len(chunk_ranges) == 1:
+                chunk_columns[column_name] = column[chunk_ranges[0][0]:chunk_ranges[0][1]]
+            else:
+                chunk_columns[column_name] = np.concatenate([column[first_point:last_point] for first_point, last_point in chunk_ranges])
+        xyz = np.vstack([chunk_columns['x'], chunk_columns['y'], chunk_columns['z']]).transpose()
+        point_cloud_ids = np.reshape(chunk_columns['user_data'], (-1,1))
+        labels = np.reshape(chunk_columns['classification'], (-1,1))
+        point_records = None
+        if preserve_point_records == True:
+            point_records = laspy.ScaleAwarePointRecord(chunk_columns['records'], tile_cache['point_format'], scales, offsets)
+        yield xyz, point_cloud_ids, labels, point_records
+
+
+def iterate_point_chunks(point_chunks):
+    """
+    Split the chunks of LAS point records into the arrays yielded by 'read_las_chunks()'.
+    """
+    for points in point_chunks:
+        if len(points) == 0:
+            continue
+        xyz = np.vstack([points.x, points.y, points.z]).transpose()
+        point_cloud_ids = np.asarray(points.user_data)
+        point_cloud_ids = np.reshape(point_cloud_ids, (-1,1))
+        labels = np.asarray(points.classification)
+        labels = np.reshape(labels, (-1, 1))
+        if preserve_point_records == False:
+            points = None
+        yield xyz, point_cloud_ids, labels, points
+
+
+def concatenate_points(points_list):
+    """
+    Combine a list of [points, point cloud IDs, labels, point records] (e.g. results of several chunks of the same file) into a single one.
+    """
+    if len(points_list) == 0:
+        return [np.empty((0,3)), np.empty((0,1), dtype=np.uint8), np.empty((0,1), dtype=np.uint8), None]
+    if len(points_list) == 1:
+        return points_list[0]
+    points = np.concatenate([data[0] for data in points_list], axis=0)
+    point_cloud_ids = np.concatenate([data[1] for data in points_list], axis=0)
+    labels = np.concatenate([data[2] for data in points_list], axis=0)
+    point_records = concatenate_point_records([data[3] for data in points_list])
+    return [points, point_cloud_ids, labels, point_records]
+
+
+def select_point_records(point_records, indices):
+    """
+    Select a subset of LAS point records with an index or boolean mask array. Returns None if 'point_records' is None.
+    """
+    if point_records is None:
+        return None
+    return laspy.ScaleAwarePointRecord(point_records.array[indices], point_records.point_format, point_records.scales, point_records.offsets)
+
+
+def concatenate_point_records(point_records_list):
+    """
+    Combine LAS point records, possibly from files of different point formats, into a single record array.
+    The result uses the point format, scales and offsets of the first element. Dimensions missing from the point format of a later element are left to zero.
+    Coordinates are only meaningful where all elements share the same scales and offsets, so they should be set again (see 'write_point_records()') before writing.
+    
+    Parameters
+    ----------
+    point_records_list : List<laspy.ScaleAwarePointRecord>
+        Point records to combine. If any of them is None, None is returned.
+    
+    Returns
+    -------
+    point_records : laspy.ScaleAwarePointRecord
+        Combined point records
+    """
+    if any(point_records is None for point_records in point_records_list):
+        return None
+    first_records = point_records_list[0]
+    output_dtype = first_records.array.dtype
+    if all(point_records.array.dtype == output_dtype for point_records in point_records_list):
+        array = np.concatenate([point_records.array for point_records in point_records_list])
+    else:
+        array = np.zeros(sum(len(point_records) for point_records in point_records_list), dtype=output_dtype)
+        first_point = 0
+        for point_records in point_records_list:
+            last_point = first_point + len(point_records)
+            for dimension_name in output_dtype.names:
+                if dimension_name in point_records.array.dtype.names:
+                    array[dimension_name][first_point:last_point] = point_records.array[dimension_name]
+            first_point = last_point
+    return laspy.ScaleAwarePointRecord(array, first_records.point_format, first_records.scales, first_records.offsets)
+
+
+POLYGON_GRID_CELL_OUTSIDE  = 0
+POLYGON_GRID_CELL_INSIDE   = 1
+POLYGON_GRID_CELL_BOUNDARY = 2
+
+def create_polygon_filter(target_polygon):
+    """
+    Prepare the data needed to quickly mask points with a polygon: the polygon path, its bounding box, and a coarse grid over the bounding box.
+    Each grid cell is classified as completely outside the polygon, completely inside it, or crossed by the polygon boundary, so that only points in the boundary cells need the exact point-in-polygon test.
+    
+    Parameters
+    ----------
+    target_polygon : List<[Numpy.array]>
+        List of 2D points that define a closed polygon in the horizontal plane
+    
+    Returns
+    -------
+    polygon_filter : dict
+        'path'       : matplotlib.path.Path of the polygon
+        'bbox'       : min_x, min_y, max_x, max_y of the polygon
+        'cell_size'  : Grid cell size, 0.0 if the grid is not used
+        'cell_state' : Numpy.array ([X,Y]) of POLYGON_GRID_CELL_* values, or None if the grid is not used
+    """
+    polygon = np.asarray(target_polygon, dtype=np.float64)
+    path = matplotlibpath.Path(polygon)
+    min_x = np.min(polygon[:,0])
+    min_y = np.min(polygon[:,1])
+    max_x = np.max(polygon[:,0])
+    max_y = np.max(polygon[:,1])
+    cell_state = None
+    if prefilter_grid_cell_size > 0.0:
+        cell_count_x = max(1, int(np.ceil((max_x - min_x) / prefilter_grid_cell_size)))
+        cell_count_y = max(1, int(np.ceil((max_y - min_y) / prefilter_grid_cell_size)))
+        cell_state = np.full((cell_count_x, cell_count_y), POLYGON_GRID_CELL_BOUNDARY, dtype=np.int8)
+        for cell_x in range(cell_count_x):
+            for cell_y in range(cell_count_y):
+                cell_min_x = min_x + cell_x * prefilter_grid_cell_size
+                cell_min_y = min_y + cell_y * prefilter_grid_cell_size
+                cell_bbox = matplotlibtransforms.Bbox([[cell_min_x, cell_min_y], [cell_min_x + prefilter_grid_cell_size, cell_min_y + prefilter_grid_cell_size]])
+                if path.intersects_bbox(cell_bbox, filled=False) == True:
+                    continue
+                # The boundary does not touch the cell, so the whole cell is on the same side of it as its center point
+                cell_center = [cell_min_x + 0.5*prefilter_grid_cell_size, cell_min_y + 0.5*prefilter_grid_cell_size]
+                if path.contains_point(cell_center) == True:
+                    cell_state[cell_x, cell_y] = POLYGON_GRID_CELL_INSIDE
+                else:
+                    cell_state[cell_x, cell_y] = POLYGON_GRID_CELL_OUTSIDE
+    polygon_filter = {
+        'path': path,
+        'bbox': [min_x, min_y, max_x, max_y],
+        'cell_size': prefilter_grid_cell_size,
+        'cell_state': cell_state
+    }
+    return polygon_filter
+
+
+def get_points_in_polygon(xyz, point_cloud_ids, labels, point_records, polygon_filter):
+    """
+    Mask the input points with a 2D polygon.
+    
+    Parameters
+    ----------
+    xyz : Numpy.array
+        Point positions ([N,3])
+    point_cloud_ids : Numpy.array
+        Point cloud IDs ([N,1])
+    labels : Numpy.array
+        Point labels ([N,1])
+    point_records : laspy.ScaleAwarePointRecord
+        Complete point records, or None
+    polygon_filter : dict
+        Closed polygon in the horizontal plane, as returned by 'create_polygon_filter()'
+    
+    Returns
+    -------
+    inside_points : List<numpy.array, numpy.array, numpy.array, laspy.ScaleAwarePointRecord>
+        Positions, point cloud IDs, labels and point records of the points inside the polygon
+    """
+    inside_indices = get_indices_in_polygon(xyz[:,0], xyz[:,1], polygon_filter)
+    inside_points = np.asarray(xyz[inside_indices])
+    inside_point_cloud_ids = np.asarray(point_cloud_ids[inside_indices])
+    inside_labels = np.asarray(labels[inside_indices])
+    inside_point_records = select_point_records(point_records, inside_indices)
+    return [inside_points, inside_point_cloud_ids, inside_labels, inside_point_records]
+
+
+def get_indices_in_polygon(x, y, polygon_filter, candidate_indices=None):
+    """
+    Get the indices of the points inside a 2D polygon.
+    Points outside the polygon bounding box are discarded first, then points in grid cells completely inside or outside the polygon are decided by their cell, 
+    and only the remaining points near the polygon boundary are tested against the polygon itself.
+    
+    Parameters
+    ----------
+    x, y : Numpy.array
+        Point coordinates ([N])
+    polygon_filter : dict
+        Closed polygon in the horizontal plane, as returned by 'create_polygon_filter()'
+    candidate_indices : Numpy.array
+        If given, only these points are tested. They must already be inside the polygon bounding box.
+    
+    Returns
+    -------
+    inside_indices : Numpy.array
+        Sorted indices of the points inside the polygon
+    """
+    min_x, min_y, max_x, max_y = polygon_filter['bbox']
+    if candidate_indices is None:
+        candidate_indices = np.flatnonzero( (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y) )
+    
+    cell_state = polygon_filter['cell_state']
+    if cell_state is not None and len(candidate_indices) > 0:
+        cell_size = polygon_filter['cell_size']
+        cell_x = np.minimum( ((x[candidate_indices] - min_x) / cell_size).astype(np.int64), cell_state.shape[0]-1 )
+        cell_y = np.minimum( ((y[candidate_indices] - min_y) / cell_size).astype(np.int64), cell_state.shape[1]-1 )
+        candidate_states = cell_state[cell_x, cell_y]
+        inside_indices = candidate_indices[candidate_states == POLYGON_GRID_CELL_INSIDE]
+        boundary_indices = candidate_indices[candidate_states == POLYGON_GRID_CELL_BOUNDARY]
+    else:
+        inside_indices = np.empty(0, dtype=np.int64)
+        boundary_indices = candidate_indices
+        
+    if len(boundary_indices) > 0:
+        boundary_points = np.stack((x[boundary_indices], y[boundary_indices]), axis=1)
+        in_out_points = polygon_filter['path'].contains_points(boundary_points)
+        inside_indices = np.sort( np.concatenate((inside_indices, boundary_indices[in_out_points])) )
+    return inside_indices
+
+
+def create_footprint_index(polygons):
+    """
+    Prepare a set of building footprint polygons for labelling points: a polygon filter for each footprint (see 'create_polygon_filter()'), and an R-tree of their bounding boxes.
+    
+    Parameters
+    ----------
+    polygons : List<List<[Numpy.array]>>
+        Closed 2D polygons of the buildings
+    
+    Returns
+    -------
+    footprint_index : dict
+        'filters' : List<dict> of polygon filters, in the same order as the input polygons
+        'index'   : R-tree index of the polygon bounding boxes, with the position in 'filters' as the id
+    """
+    polygon_filters = [create_polygon_filter(polygon) for polygon in polygons]
+    if len(polygon_filters) > 0:
+        spatial_index = rtreeindex.Index( (i, tuple(polygon_filters[i]['bbox']), None) for i in range(len(polygon_filters)) )
+    else:
+        spatial_index = rtreeindex.Index()
+    footprint_index = {
+        'filters': polygon_filters,
+        'index': spatial_index
+    }
+    return footprint_index
+
+
+def label_points_with_footprints(x, y, footprint_index, building_numbers=None):
+    """
+    Find, for every building footprint in the index, the points inside it. A point can belong to several footprints, if the footprints overlap.
+    The footprints near the points are found through the R-tree. The points are sorted by their x coordinate once, so that the points inside each footprint's 
+    bounding box are found by binary search and a y test on that slice only, instead of testing all points against every footprint.
+    
+    Parameters
+    ----------
+    x, y : Numpy.array
+        Point coordinates ([N])
+    footprint_index : dict
+        Footprints, as returned by 'create_footprint_index()'
+    building_numbers : List<int>
+        If given, only these footprints are considered
+    
+    Returns
+    -------
+    building_point_indices : dict
+        Sorted indices of the points inside each footprint, keyed by the footprint position in the index. Footprints containing no points are left out.
+    """
+    building_point_indices = {}
+    if len(x) == 0:
+        return building_point_indices
+    points_bbox = (np.min(x), np.min(y), np.max(x), np.max(y))
+    candidate_buildings = footprint_index['index'].intersection(points_bbox)
+    if building_numbers is not None:
+        allowed_buildings = set(building_numbers)
+        candidate_buildings = [building_number for building_number in candidate_buildings if building_number in allowed_buildings]
+    candidate_buildings = sorted(candidate_buildings)
+    if len(candidate_buildings) == 0:
+        return building_point_indices
+    
+    x_order = np.argsort(x, kind='stable')
+    sorted_x = x[x_order]
+    for building_number in candidate_buildings:
+        polygon_filter = footprint_index['filters'][building_number]
+        min_x, min_y, max_x, max_y = polygon_filter['bbox']
+        first = np.searchsorted(sorted_x, min_x, side='left')
+        last = np.searchsorted(sorted_x, max_x, side='right')
+        slice_indices = x_order[first:last]
+        slice_y = y[slice_indices]
+        candidate_indices = np.sort( slice_indices[(slice_y >= min_y) & (slice_y <= max_y)] )
+        if len(candidate_indices) == 0:
+            continue
+        inside_indices = get_indices_in_polygon(x, y, polygon_filter, candidate_indices)
+        if len(inside_indices) > 0:
+            building_point_indices[building_number] = inside_indices
+    return building_point_indices
+
+
+def align_and_write_points(inside_points_list, output_name):
+    """
+    Align the points collected from different point clouds against each other, and write both the aligned and unaligned results into files.
+    
+    Parameters
+    ----------
+    inside_points_list : List<List<numpy.array, numpy.array, numpy.array, laspy.ScaleAwarePointRecord>>
+        Points, point cloud IDs, labels and point records (or None) of the building, one element per input point cloud
+    output_name : string
+        Filename to output results into
+    
+    Returns
+    -------
+    point_count : int
+        Number of points written
+    """
+        
     if len(inside_points_list) == 0:
         print("  No points found that belong to the target building. Moving on to the next one...")
-        return
+        return 0
     
-    # Align points
+    # Align points. Only the pose of each point cloud is computed here, and applied once, when the output arrays are filled.
     if len(inside_points_list) > 1:
         print("  Aligning point clouds...")
-        aligned_point_clouds, unaligned_point_clouds = align_point_clouds( inside_points_list )
+        transformations = align_point_clouds( inside_points_list )
     else:
         print("  A single file contained points belonging to the target building. No alignment necessary.")
-        point_cloud_data = inside_points_list[0]
-        point_cloud = o3d.geometry.PointCloud()
-        point_cloud.points = o3d.utility.Vector3dVector( np.asarray(point_cloud_data[0]) )
-        aligned_point_clouds = []
-        aligned_point_clouds.append(point_cloud)
+        transformations = [ np.identity(4) ]
         
     # Combine data
-    aligned_combined_point_cloud = None
-    unaligned_combined_point_cloud = None
-    combined_ids = None
-    combined_labels = None
-    for point_cloud_num in range(len(aligned_point_clouds)):
-        aligned_point_cloud = aligned_point_clouds[point_cloud_num]
-        unaligned_point_cloud = unaligned_point_clouds[point_cloud_num]
-        if aligned_combined_point_cloud == None:
-            aligned_combined_point_cloud = aligned_point_cloud
-            unaligned_combined_point_cloud = unaligned_point_cloud
-            combined_ids = inside_points_list[point_cloud_num][1]
-            combined_labels = inside_points_list[point_cloud_num][2]
-        else:
-            aligned_combined_point_cloud = aligned_combined_point_cloud + aligned_point_cloud
-            unaligned_combined_point_cloud = unaligned_combined_point_cloud + unaligned_point_cloud
-            combined_ids = np.append(combined_ids, inside_points_list[point_cloud_num][1], axis=0)
-            combined_labels = np.append(combined_labels, inside_points_list[point_cloud_num][2], axis=0)
-
-    aligned_points   = np.asarray(aligned_combined_point_cloud.points)
-    unaligned_points = np.asarray(unaligned_combined_point_cloud.points)
-    ids              = np.asarray(combined_ids)
-    labels           = np.asarray(combined_labels)
-    
-    aligned_points   = aligned_points.reshape((-1, 3))
-    unaligned_points = unaligned_points.reshape((-1, 3))
-    ids              = ids.reshape((-1))
-    labels           = labels.reshape((-1))
-    
-    # Output data to file
+    point_counts = [len(point_cloud_data[0]) for point_cloud_data in inside_points_list]
+    total_point_count = sum(point_counts)
+    aligned_points   = np.empty((total_point_count, 3), dtype=np.float64)
+    unaligned_points = np.empty((total_point_count, 3), dtype=np.float64)
+    first_point = 0
+    for point_cloud_num in range(len(inside_points_list)):
+        points = inside_points_list[point_cloud_num][0]
+        last_point = first_point + point_counts[point_cloud_num]
+        transformation = transformations[point_cloud_num]
+        unaligned_points[first_point:last_point] = points
+        np.matmul(points, transformation[:3,:3].transpose(), out=aligned_points[first_point:last_point])
+        aligned_points[first_point:last_point] += transformation[:3,3]
+        first_point = last_point
+    
+    # Output data to file. The files are written under temporary names, and renamed only when both are complete, so that an interrupted run never leaves a truncated output behind.
     print( "All point clouds processed, with %d points collected." % len(aligned_points))
-    aligned_output_name = "aligned_" + output_name
-    full_output_filename = os.path.join( aligned_output_path, aligned_output_name )
-    write_point_cloud(full_output_filename, aligned_points, ids, labels)
-    unaligned_output_name = "unaligned_" + output_name
-    full_output_filename = os.path.join( unaligned_output_path, unaligned_output_name )
-    write_point_cloud(full_output_filename, unaligned_points, ids, labels)
+    aligned_output_filename, unaligned_output_filename = get_output_filenames(output_name)
+    aligned_temporary_filename = jobmanifest.get_temporary_filename(aligned_output_filename)
+    unaligned_temporary_filename = jobmanifest.get_temporary_filename(unaligned_output_filename)
+    point_records = concatenate_point_records([point_cloud_data[3] for point_cloud_data in inside_points_list])
+    if point_records is not None and output_name.endswith((".las", ".laz")):
+        # The source records are written as they are, only their coordinates are replaced
+        write_point_records(aligned_temporary_filename, aligned_points, point_records)
+        write_point_records(unaligned_temporary_filename, unaligned_points, point_records)
+    else:
+        ids = np.concatenate([point_cloud_data[1].reshape((-1)) for point_cloud_data in inside_points_list])
+        labels = np.concatenate([point_cloud_data[2].reshape((-1)) for point_cloud_data in inside_points_list])
+        write_point_cloud(aligned_temporary_filename, aligned_points, ids, labels)
+        write_point_cloud(unaligned_temporary_filename, unaligned_points, ids, labels)
+    jobmanifest.commit_output_file(unaligned_temporary_filename, unaligned_output_filename)
+    jobmanifest.commit_output_file(aligned_temporary_filename, aligned_output_filename)
+    return len(aligned_points)
     
     
     
@@ -260,7 +966,7 @@ def write_point_cloud(output_name, points, ids, labels):
         point_cloud = o3d.geometry.PointCloud()
         point_cloud.points = o3d.utility.Vector3dVector(points)
         o3d.io.write_point_cloud(output_name, point_cloud, write_ascii=False, compressed=False, print_progress=True)
-    elif output_name.endswith(".las"):
+    elif output_name.endswith((".las", ".laz")):
         print( "Writing data to point cloud: '%s'" % (output_name) )
         header = laspy.LasHeader(point_format=3, version="1.4")
         header.scale = [0.001, 0.001, 0.001]
@@ -276,6 +982,39 @@ def write_point_cloud(output_name, points, ids, labels):
         las.write(output_name)
     else:
         print( "Unsupported output file type! (%s)" % output_name)
+
+
+def write_point_records(output_name, points, point_records):
+    """
+    Write complete LAS point records into a LAS/LAZ file, in their own point format and scales, with their coordinates replaced by 'points'.
+    The offsets are set from the minimum of 'points', as the offsets of the records were chosen for a single source file, and the merged or aligned points may be out of their range.
+    The coordinates are written into the record array in place, so the same records can be written again with other coordinates without copying them.
+    Raises ValueError, if the points do not fit into the 32-bit integer coordinates of the LAS format with the scales of the records.
+    
+    Parameters
+    ----------
+    output_name : string
+        Name of the output file, including full path.
+    points : Numpy.array
+        Array of points ([N,3]) to be outputted.
+    point_records : laspy.ScaleAwarePointRecord
+        Point records ([N]) holding all other point attributes
+    """
+    print( "Writing data to point cloud: '%s'" % (output_name) )
+    scales = np.asarray(point_records.scales, dtype=np.float64)
+    if len(points) > 0:
+        offsets = np.floor(np.min(points, axis=0))
+        scaled_ranges = np.round((np.max(points, axis=0) - offsets) / scales)
+        if np.any(scaled_ranges > np.iinfo(np.int32).max):
+            raise ValueError("Points of '%s' span %s, which does not fit into 32-bit LAS coordinates with scales %s" % (output_name, np.max(points, axis=0) - offsets, scales))
+        point_records.offsets = offsets
+    header = laspy.LasHeader(point_format=point_records.point_format, version="1.4")
+    header.scales = point_records.scales
+    header.offsets = point_records.offsets
+    for axis, dimension_name in enumerate(["X", "Y", "Z"]):
+        point_records.array[dimension_name] = np.round((points[:,axis] - point_records.offsets[axis]) / point_records.scales[axis])
+    las = laspy.LasData(header, points=point_records)
+    las.write(output_name)
         
 
 def align_point_clouds( inside_points_list ):
@@ -290,25 +1029,20 @@ def align_point_clouds( inside_points_list ):
     
     Returns
     -------
-    aligned_lidar_point_clouds : List<Open3D.geometry.PointCloud>
-        Building point clouds, aligned against each other
-    unaligned_lidar_point_clouds : List<Open3D.geometry.PointCloud>
-        Building point clouds, unaligned, as they were scanned.
+    transformations : List<Numpy.array>
+        4x4 transformation of each point cloud that aligns it against the others
     """
+    if alignment_method == "pose_graph":
+        return align_point_clouds_pose_graph( inside_points_list )
     
-    unaligned_lidar_point_clouds = []
-    aligned_lidar_point_clouds = []
+    transformations = []
     downsampled_lidar_point_clouds = []
     
     for point_cloud_num in range(len(inside_points_list)):
         point_cloud_data = inside_points_list[point_cloud_num]
         points = point_cloud_data[0]
-        point_cloud = o3d.geometry.PointCloud()
-        point_cloud.points = o3d.utility.Vector3dVector(points)
-        downsampled_point_cloud = o3d.geometry.PointCloud.voxel_down_sample(point_cloud, 0.2)
-        aligned_lidar_point_clouds.append(point_cloud)
-        unaligned_lidar_point_clouds.append( copy.deepcopy(point_cloud) )
-        downsampled_lidar_point_clouds.append(downsampled_point_cloud)
+        transformations.append( np.identity(4) )
+        downsampled_lidar_point_clouds.append( create_registration_levels(points) )
         
     lidar_matching_max_distance = 5.0 # Very large matching distance allows for fixing large position errors, pretty safe to use, when combined with low maximum error for accepting the result
     transformation_init_guess = np.identity(4)    
@@ -316,27 +1050,231 @@ def align_point_clouds( inside_points_list ):
     # Next, combine every point cloud other than one, and adjust that one cloud towards the whole of the rest, if the error of adjusted point cloud is small enough
     print("Seeing if any of the point clouds can or should be adjusted...")
     for moving_num in range(len(downsampled_lidar_point_clouds)):
-        downsampled_moving_point_cloud = downsampled_lidar_point_clouds[moving_num]
-        static_point_cloud = None
-        for static_num in range(len(downsampled_lidar_point_clouds)):
-            if static_num == moving_num:
-                continue
-            if static_point_cloud == None:
-                static_point_cloud = downsampled_lidar_point_clouds[static_num]
-            else:
-                static_point_cloud = static_point_cloud + downsampled_lidar_point_clouds[static_num]
-        alignment_result = refine_registration_point_to_point(downsampled_moving_point_cloud, static_point_cloud, transformation_init_guess, lidar_matching_max_distance, 200)
-        if alignment_result.inlier_rmse < 0.25:
+        downsampled_moving_levels = downsampled_lidar_point_clouds[moving_num]
+        static_levels = []
+        for level in range(len(downsampled_moving_levels)):
+            static_point_cloud = None
+            for static_num in range(len(downsampled_lidar_point_clouds)):
+                if static_num == moving_num:
+                    continue
+                if static_point_cloud == None:
+                    static_point_cloud = downsampled_lidar_point_clouds[static_num][level]
+                else:
+                    static_point_cloud = static_point_cloud + downsampled_lidar_point_clouds[static_num][level]
+            static_levels.append(static_point_cloud)
+        alignment_result = register_point_clouds(downsampled_moving_levels, static_levels, transformation_init_guess, lidar_matching_max_distance)
+        if alignment_result.fitness > 0.0 and alignment_result.inlier_rmse < 0.25:
             #if alignment_result.inlier_rmse < 0.0001:
             print("  Point cloud #{num1}, error={num2}, adjusting pose".format(num1=moving_num, num2=alignment_result.inlier_rmse))
-            aligned_lidar_point_clouds[moving_num].transform(alignment_result.transformation)
-            downsampled_lidar_point_clouds[moving_num].transform(alignment_result.transformation)
+            transformations[moving_num] = np.matmul(alignment_result.transformation, transformations[moving_num])
+            for downsampled_point_cloud in downsampled_moving_levels:
+                downsampled_point_cloud.transform(alignment_result.transformation)
         else:
             print("  Point cloud #{num1}, error={num2}, skipping.".format(num1=moving_num, num2=alignment_result.inlier_rmse))
       
     print("Matching process completed.")
-    return aligned_lidar_point_clouds, unaligned_lidar_point_clouds
+    return transformations
+
+
+
+def align_point_clouds_pose_graph( inside_points_list ):
+    """
+    Align the point clouds in the input list against each other using multiway registration: each point cloud is registered once against the (at most 'pose_graph_neighbor_count')
+    point clouds overlapping it the most, and the pairwise results are combined in a pose graph, which is optimized to get a consistent pose for every point cloud (the first point cloud stays in place).
+    Each point cloud is downsampled (and gets its normals, if needed) only once, and the pairs are registered in parallel, so the cost grows linearly with the number of scans,
+    instead of registering every scan against the combination of all the others.
+    Pairwise results with an RMS error above the same limit as in 'align_point_clouds()' are left out of the graph.
+    As in Open3D's multiway registration, the best pairwise results form a spanning tree, which sets the initial poses and is kept as certain edges,
+    while the rest of the pairwise results are uncertain edges (loop closures) that the optimization may prune.
+    
+    Parameters
+    ----------
+    inside_points_list : List<List<numpy.array, numpy.array, numpy.array>>
+        List of list of arrays containing data drawn from various LiDAR scans. First element contains the point cloud points, and is the only one relevant to this function.
+    
+    Returns
+    -------
+    transformations : List<Numpy.array>
+        4x4 transformation of each point cloud that aligns it against the others
+    """
+    lidar_matching_max_distance = 5.0
+    maximum_inlier_rmse = 0.25
+    pose_graph_max_correspondence_distance = 1.0 # Used for the edge information matrices and the graph optimization, smaller than the ICP matching distance to only count good correspondences.
+    
+    transformations = []
+    downsampled_lidar_point_clouds = []
+    bounding_boxes = []
+    for point_cloud_num in range(len(inside_points_list)):
+        points = inside_points_list[point_cloud_num][0]
+        transformations.append( np.identity(4) )
+        downsampled_lidar_point_clouds.append( create_registration_levels(points) )
+        bounding_boxes.append( [np.min(points, axis=0), np.max(points, axis=0)] )
+    
+    # Register each point cloud against the ones its bounding box overlaps the most. This keeps the graph connected, while the number of pairs grows only linearly.
+    point_cloud_pairs = set()
+    for source_num in range(len(downsampled_lidar_point_clouds)):
+        source_min, source_max = bounding_boxes[source_num]
+        overlaps = []
+        for target_num in range(len(downsampled_lidar_point_clouds)):
+            if target_num == source_num:
+                continue
+            target_min, target_max = bounding_boxes[target_num]
+            overlap_size = np.minimum(source_max, target_max) - np.maximum(source_min, target_min) + lidar_matching_max_distance
+            if np.all(overlap_size > 0.0):
+                overlaps.append([np.prod(overlap_size), target_num])
+        overlaps.sort(reverse=True)
+        for overlap_volume, target_num in overlaps[:pose_graph_neighbor_count]:
+            point_cloud_pairs.add( (min(source_num, target_num), max(source_num, target_num)) )
+    point_cloud_pairs = sorted(point_cloud_pairs)
+    
+    def register_pair(pair):
+        source_levels = downsampled_lidar_point_clouds[pair[0]]
+        target_levels = downsampled_lidar_point_clouds[pair[1]]
+        result = register_point_clouds(source_levels, target_levels, np.identity(4), lidar_matching_max_distance)
+        information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(source_levels[-1], target_levels[-1], pose_graph_max_correspondence_distance, result.transformation)
+        return result, information
+    
+    print("Registering %d overlapping point cloud pairs..." % len(point_cloud_pairs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pairwise_registration_workers) as executor:
+        pair_results = list(executor.map(register_pair, point_cloud_pairs))
+    
+    accepted_pairs = []
+    for pair_num in range(len(point_cloud_pairs)):
+        source_num, target_num = point_cloud_pairs[pair_num]
+        result, information = pair_results[pair_num]
+        if result.fitness > 0.0 and result.inlier_rmse < maximum_inlier_rmse:
+            print("  Point clouds #{num1}-#{num2}, error={num3}, adding to the pose graph".format(num1=source_num, num2=target_num, num3=result.inlier_rmse))
+            accepted_pairs.append( [source_num, target_num, result, information] )
+        else:
+            print("  Point clouds #{num1}-#{num2}, error={num3}, skipping.".format(num1=source_num, num2=target_num, num3=result.inlier_rmse))
+    
+    initial_poses, spanning_pair_nums = find_initial_poses(len(downsampled_lidar_point_clouds), accepted_pairs)
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for point_cloud_num in range(len(downsampled_lidar_point_clouds)):
+        pose_graph.nodes.append( o3d.pipelines.registration.PoseGraphNode(initial_poses[point_cloud_num]) )
+    for pair_num in range(len(accepted_pairs)):
+        source_num, target_num, result, information = accepted_pairs[pair_num]
+        uncertain = pair_num not in spanning_pair_nums
+        pose_graph.edges.append( o3d.pipelines.registration.PoseGraphEdge(source_num, target_num, result.transformation, information, uncertain=uncertain) )
+    
+    if len(pose_graph.edges) > 0:
+        print("Optimizing the pose graph...")
+        option = o3d.pipelines.registration.GlobalOptimizationOption( max_correspondence_distance=pose_graph_max_correspondence_distance, edge_prune_threshold=0.25, reference_node=0 )
+        o3d.pipelines.registration.global_optimization( pose_graph, 
+                                                        o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt(), 
+                                                        o3d.pipelines.registration.GlobalOptimizationConvergenceCriteria(), 
+                                                        option )
+        for point_cloud_num in range(len(transformations)):
+            transformations[point_cloud_num] = np.asarray( pose_graph.nodes[point_cloud_num].pose )
+    
+    print("Matching process completed.")
+    return transformations
+
+
+
+def find_initial_poses(point_cloud_count, accepted_pairs):
+    """
+    Find a spanning tree of the pairwise registration results, preferring the pairs with the highest fitness, and chain its transformations into an initial pose for each point cloud.
+    The tree grows from the first point cloud, which stays in place. Point clouds not connected to it start a tree of their own.
+    
+    Parameters
+    ----------
+    point_cloud_count : int
+        Number of point clouds (pose graph nodes)
+    accepted_pairs : List<[int, int, Open3D.pipelines.registration.RegistrationResult, Numpy.array]>
+        Source point cloud, target point cloud, registration result (transforming the source onto the target) and information matrix of each accepted pair
+    
+    Returns
+    -------
+    poses : List<Numpy.array>
+        4x4 initial pose of each point cloud
+    spanning_pair_nums : Set<int>
+        Positions of the pairs in 'accepted_pairs' that form the spanning tree
+    """
+    poses = [None] * point_cloud_count
+    spanning_pair_nums = set()
+    for root_num in range(point_cloud_count):
+        if poses[root_num] is not None:
+            continue
+        poses[root_num] = np.identity(4)
+        while True:
+            # Add the best pair connecting a point cloud in the tree to a point cloud outside of it
+            best_pair_num = None
+            for pair_num in range(len(accepted_pairs)):
+                source_num, target_num, result, information = accepted_pairs[pair_num]
+                if (poses[source_num] is None) == (poses[target_num] is None):
+                    continue
+                if best_pair_num is None or result.fitness > accepted_pairs[best_pair_num][2].fitness:
+                    best_pair_num = pair_num
+            if best_pair_num is None:
+                break
+            source_num, target_num, result, information = accepted_pairs[best_pair_num]
+            if poses[target_num] is None:
+                poses[target_num] = np.matmul(poses[source_num], np.linalg.inv(result.transformation))
+            else:
+                poses[source_num] = np.matmul(poses[target_num], result.transformation)
+            spanning_pair_nums.add(best_pair_num)
+    return poses, spanning_pair_nums
+
 
+def create_registration_levels(points):
+    """
+    Downsample the points of a point cloud for registration. Without the ICP pyramid, this is a single 0.2 m voxel level.
+    With 'use_icp_pyramid', one level is created for each entry in 'icp_pyramid_levels', and the finest level gets normals for point-to-plane ICP.
+    
+    Returns
+    -------
+    levels : List<Open3D.geometry.PointCloud>
+        Downsampled point clouds, coarsest first
+    """
+    point_cloud = o3d.geometry.PointCloud()
+    point_cloud.points = o3d.utility.Vector3dVector(points)
+    if use_icp_pyramid == False:
+        return [ o3d.geometry.PointCloud.voxel_down_sample(point_cloud, 0.2) ]
+    levels = []
+    for voxel_size, distance_threshold, max_iteration in icp_pyramid_levels:
+        levels.append( o3d.geometry.PointCloud.voxel_down_sample(point_cloud, voxel_size) )
+    levels[-1].estimate_normals( o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30) )
+    return levels
+
+
+def register_point_clouds(moving_levels, reference_levels, initial_transformation, distance_threshold):
+    """
+    Register two point clouds downsampled with 'create_registration_levels()', either with a single point-to-point ICP or with the coarse-to-fine ICP pyramid.
+    'distance_threshold' is the matching distance of the single ICP, the pyramid uses the distances in 'icp_pyramid_levels'.
+    The final transformation of the pyramid is evaluated again on the finest level with 'distance_threshold', so that the fitness and RMS error
+    are comparable with the single ICP, and a coarse result is not accepted just because the finest level found no correspondences (fitness 0, RMS error 0).
+    """
+    if use_icp_pyramid == False:
+        return refine_registration_point_to_point(moving_levels[-1], reference_levels[-1], initial_transformation, distance_threshold, 200)
+    result = refine_registration_pyramid(moving_levels, reference_levels, initial_transformation)
+    return o3d.pipelines.registration.evaluate_registration(moving_levels[-1], reference_levels[-1], distance_threshold, result.transformation)
+
+
+def refine_registration_pyramid(moving_levels, reference_levels, initial_transformation):
+    """
+    Coarse-to-fine ICP: register the coarsest levels first with a large matching distance to fix large position errors, and refine the result on finer levels with shrinking matching distances.
+    The finest level uses point-to-plane ICP, which converges faster and slides less along flat walls than point-to-point ICP.
+    The coarse levels stop as soon as the fitness and RMS error change by less than 'icp_pyramid_coarse_tolerance' between iterations, and the finest level runs to Open3D's default tolerances.
+    
+    Returns
+    -------
+    result : Open3D.pipelines.registration.RegistrationResult
+        Result of the finest level, with the transformation accumulated over all the levels
+    """
+    transformation = initial_transformation
+    result = None
+    for level in range(len(icp_pyramid_levels)):
+        voxel_size, distance_threshold, max_iteration = icp_pyramid_levels[level]
+        if level == len(icp_pyramid_levels)-1:
+            estimation = o3d.pipelines.registration.TransformationEstimationPointToPlane()
+            criteria = o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_iteration)
+        else:
+            estimation = o3d.pipelines.registration.TransformationEstimationPointToPoint()
+            criteria = o3d.pipelines.registration.ICPConvergenceCriteria(relative_fitness=icp_pyramid_coarse_tolerance, relative_rmse=icp_pyramid_coarse_tolerance, max_iteration=max_iteration)
+        result = o3d.pipelines.registration.registration_icp( moving_levels[level], reference_levels[level], distance_threshold, transformation, estimation, criteria )
+        transformation = result.transformation
+    return result
 
 
 def refine_registration_point_to_point(moving, reference, initial_transformation, distance_threshold=1.0, max_iteration=100):
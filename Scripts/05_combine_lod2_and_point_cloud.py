@@ -7,6 +7,8 @@ import trimesh
 import laspy
 import matplotlib.pyplot as plt
 import time
+import job_manifest as jobmanifest
+import lod2_mesh_cache as lod2meshcache
 
 
 """
@@ -25,15 +27,18 @@ create_meshes                 = True  # If True, use Poisson Surface Reconstruct
 filter_low_density_from_mesh  = False # If True, the output Poisson mesh will have holes in places, where not enough points are available.
 skip_lod2_on_mesh_creation    = False # If True, mesh is created using only LiDAR data (generally results in very bad meshes)
 perform_window_detection      = True  # Requires 'create_meshes' to be set to True
+preserve_point_records        = True  # If True, LAS outputs use the point format and scales of the input LAS file, and each LiDAR point keeps the attributes (intensity, GPS time, RGB, ...) of the nearest input point
 
 ### Input/Output files and folders ###
 input_point_cloud_path        = "S:/OSS/Data/Aligned_point_clouds/"
 input_lod2_obj_path           = "S:/OSS/Data/LOD2/"
+lod2_mesh_cache_path          = None # Folder of the LOD2 mesh cache (see 'lod2_mesh_cache.py'), shared with '01_create_footprint_polygons.py'. If set, each OBJ file is parsed only once.
 output_point_cloud_path       = "S:/OSS/Data/Combined_point_clouds/"
 output_mesh_path              = "S:/OSS/Data/Meshes/"
 
 # Process single file
 process_entire_directory      = False # If False, only a single building, defined below, will be processed from the input paths
+job_manifest_file             = None  # JSON-lines manifest (see 'job_manifest.py') used when processing the entire directory. If set, a building is skipped only if it was completed with the same input files and parameters. If None, a building is skipped if its output mesh exists.
 building_number               = 349
 input_point_cloud_filename    = "aligned_building_"  + str(building_number) + "_points.las"
 input_lod2_obj_filename       = "building_"          + str(building_number) + ".obj"
@@ -97,7 +102,7 @@ window_detection_shape_minimum_distance_to_large_low_density_areas   = 1.5
 
 def convert_obj_to_point_cloud(input_file):
     """
-    Use Trimesh library to read the .obj mesh and sample its surface to create a point cloud presentation.
+    Use Trimesh library to read the .obj mesh (through the LOD2 mesh cache, if 'lod2_mesh_cache_path' is set) and sample its surface to create a point cloud presentation.
     
     Parameters
     ----------
@@ -111,7 +116,7 @@ def convert_obj_to_point_cloud(input_file):
     open3d_mesh : Open3d triangle mesh
         The input object, converted into Open3D mesh format
     """
-    mesh = trimesh.load( input_file, process=False, force="mesh", skip_materials=True, skip_texture=True )
+    mesh = lod2meshcache.load_lod2_mesh( input_file, lod2_mesh_cache_path )
     open3d_mesh = mesh.as_open3d
     samples, fid  = mesh.sample(1048576, return_index=True) # 'return_index == True' is needed for the normal vectors
     print("  Computing barycentric coordinates...")
@@ -129,7 +134,7 @@ def convert_obj_to_point_cloud(input_file):
 
 def load_point_cloud(input_file):
     """
-    Read a point cloud from either a PLY or LAS file, and downsample it.
+    Read a point cloud from either a PLY or LAS/LAZ file, and downsample it.
     
     Parameters
     ----------
@@ -146,7 +151,7 @@ def load_point_cloud(input_file):
         point_cloud = o3d.io.read_point_cloud(input_file)
         downsampled_point_cloud = o3d.geometry.PointCloud.voxel_down_sample(point_cloud, voxel_size)
         o3d.geometry.PointCloud.estimate_normals( downsampled_point_cloud, o3d.geometry.KDTreeSearchParamHybrid(radius=normal_estimation_radius, max_nn=30))
-    elif input_file.endswith(".las"):
+    elif input_file.endswith((".las", ".laz")):
         las = laspy.read(input_file)
         xyz = np.vstack([las.x, las.y, las.z]).transpose()
         point_cloud = o3d.geometry.PointCloud()
@@ -156,6 +161,25 @@ def load_point_cloud(input_file):
     return downsampled_point_cloud
 
 
+def load_source_point_records(input_file):
+    """
+    Read the complete point records of an input LAS file, to be carried into the output with 'write_las()'.
+    
+    Parameters
+    ----------
+    input_file : string
+        Full path and filename for the input point cloud
+    
+    Returns
+    -------
+    las : laspy.LasData
+        The input LAS data, or None if 'preserve_point_records' is False or the input is not a LAS file
+    """
+    if preserve_point_records == False or input_file.endswith((".las", ".laz")) == False:
+        return None
+    return laspy.read(input_file)
+
+
 def filter_noise(point_cloud, min_dist, min_points, visualize_result=False):
     """
     Process the input point cloud, filtering out points that are too far away from other points.
@@ -1622,10 +1646,6 @@ def combine_detected_windows_into_mesh(shape_based_window_bboxes, density_based_
 
 
 def main():
-    global input_point_cloud_filename
-    global input_lod2_obj_filename
-    global combined_point_cloud_filename
-    global output_mesh_filename
     output_windows_mesh_filename = None
     
     print("\n\n")
@@ -1636,70 +1656,40 @@ def main():
     complete_lod2_mesh = None
 
     if process_entire_directory == True:
+        manifest = {}
+        job_hash = None
+        if job_manifest_file is not None:
+            manifest = jobmanifest.load_manifest(job_manifest_file)
         # Process every file in input directory
         for root, dirs, files in os.walk( input_point_cloud_path ):
             for filename in files:
-                if filename.endswith(".las"):
+                if filename.endswith((".las", ".laz")):
                     print("Processing point cloud:", filename)
-                    input_point_cloud_filename    = os.path.join( input_point_cloud_path, filename )
-                    input_lod2_obj_filename       = filename[0:-11] + ".obj"
-                    input_lod2_obj_filename       = os.path.join( input_lod2_obj_path, input_lod2_obj_filename )
-                    combined_point_cloud_filename = filename[0:-4] + "_combined.ply"
-                    combined_point_cloud_filename = os.path.join( output_point_cloud_path, combined_point_cloud_filename )
-                    output_mesh_filename          = filename[0:-4] + ".ply"
-                    output_windows_mesh_filename  = "windows_" + output_mesh_filename
-                    output_mesh_filename          = os.path.join( output_mesh_path, output_mesh_filename )
-                    if os.path.exists(output_mesh_filename) == True:
+                    building_point_cloud_file     = os.path.join( input_point_cloud_path, filename )
+                    building_lod2_obj_file        = os.path.join( input_lod2_obj_path, filename[0:-11] + ".obj" )
+                    building_combined_file        = os.path.join( output_point_cloud_path, filename[0:-4] + "_combined.ply" )
+                    building_mesh_file            = os.path.join( output_mesh_path, filename[0:-4] + ".ply" )
+                    building_windows_mesh_file    = os.path.join( output_mesh_path, "windows_" + filename[0:-4] + ".ply" )
+                    job_name = filename
+                    if job_manifest_file is not None:
+                        job_hash = jobmanifest.compute_input_hash([building_point_cloud_file, building_lod2_obj_file], get_job_parameters())
+                        if jobmanifest.is_job_done(manifest, job_name, job_hash) == True:
+                            print("  building already processed with the same inputs and parameters. Skipping this building...")
+                            continue
+                    elif os.path.exists(building_mesh_file) == True:
                         print("  output files already exist. Skipping this building...")
                         continue
                     
-                    # Load data
-                    combined_point_cloud = None
-                    if use_preprocessed_data == True:
-                        print("  Loading preprocessed data...")
-                        combined_point_cloud = load_point_cloud(combined_point_cloud_filename)
-                    else:
-                        print("  Input LOD2 object:", input_lod2_obj_filename)
-                        print("  Loading data...")
-                        # Get the LiDAR point cloud
-                        lidar_point_cloud = load_point_cloud(input_point_cloud_filename)
-                        # Convert LOD2 mesh into a point cloud
-                        complete_lod2_point_cloud, complete_lod2_mesh = convert_obj_to_point_cloud(input_lod2_obj_filename)    
-                        # Compare point clouds and filter the LOD2 data
-                        print("  Processing data: %d LiDAR points and %d LOD2 points..." % (len(lidar_point_cloud.points), len(complete_lod2_point_cloud.points) ) )
-                        filtered_lod2_point_cloud, filtered_lidar_point_cloud = filter_point_clouds( complete_lod2_point_cloud, lidar_point_cloud )
-                    
-                        # Combine the two point clouds
-                        print("  Combining the point clouds...")
-                        lidar_points = np.asarray( filtered_lidar_point_cloud.points )
-                        lidar_normals = np.asarray( filtered_lidar_point_cloud.normals )
-                        lod2_points = np.asarray( filtered_lod2_point_cloud.points )
-                        lod2_normals = np.asarray( filtered_lod2_point_cloud.normals )
-                        combined_points = np.concatenate((lidar_points, lod2_points), axis=0)
-                        combined_normals = np.concatenate((lidar_normals, lod2_normals), axis=0)
-                        
-                        mms_ids = np.ones((len(lidar_points),1))
-                        lod2_ids = np.zeros((len(lod2_points),1))
-                        point_cloud_ids = np.concatenate((mms_ids, lod2_ids), axis=0)
-                        
-                        combined_point_cloud = o3d.geometry.PointCloud()
-                        combined_point_cloud.points = o3d.utility.Vector3dVector(combined_points)
-                        combined_point_cloud.normals = o3d.utility.Vector3dVector(combined_normals)
-
-                        print("  Writing output point cloud:", combined_point_cloud_filename)
-                        if combined_point_cloud_filename.endswith(".las"):
-                            write_las(combined_point_cloud_filename, combined_point_cloud, point_cloud_ids)
-                        else:
-                            o3d.io.write_point_cloud(combined_point_cloud_filename, combined_point_cloud, write_ascii=False, compressed=False, print_progress=True)
-                    
-                    if create_meshes == True:
-                        # Create mesh from the combined data
-                        print("  Writing output mesh:", output_mesh_filename)
-                        mesh, windows_mesh = create_mesh(combined_point_cloud, filtered_lod2_point_cloud, complete_lod2_point_cloud)
-                        o3d.io.write_triangle_mesh(output_mesh_filename, mesh)
-                        if perform_window_detection == True:
-                            output_windows_mesh_filename = "windows_" + output_mesh_filename
-                            o3d.io.write_triangle_mesh(output_windows_mesh_filename, windows_mesh)
+                    record_job(job_name, jobmanifest.JOB_STATUS_STARTED, job_hash)
+                    building_start_time = time.time()
+                    try:
+                        output_files, point_count = process_directory_building(building_point_cloud_file, building_lod2_obj_file, building_combined_file,
+                                                                               building_mesh_file, building_windows_mesh_file)
+                    except Exception as error:
+                        print("  Processing the building failed:", error)
+                        record_job(job_name, jobmanifest.JOB_STATUS_FAILED, job_hash, processing_time=time.time()-building_start_time, error=str(error))
+                        continue
+                    record_job(job_name, jobmanifest.JOB_STATUS_DONE, job_hash, output_files, point_count, time.time()-building_start_time)
 
                     
     else:
@@ -1717,7 +1707,7 @@ def main():
                 lod2_file                                     = os.path.join( input_lod2_obj_path, input_lod2_obj_filename )
                 complete_lod2_point_cloud, complete_lod2_mesh = convert_obj_to_point_cloud( lod2_file )    
             if create_meshes == True:
-                output_mesh_filename                          = os.path.join( output_mesh_path, output_mesh_filename )
+                output_mesh_file                              = os.path.join( output_mesh_path, output_mesh_filename )
         else:
             print("Processing point cloud:", input_point_cloud_filename)
             print("  Input LOD2 object:", input_lod2_obj_filename)
@@ -1732,7 +1722,7 @@ def main():
                 output_windows_mesh_filename                  = "windows_" + output_mesh_filename
                 output_windows_mesh_filename                  = os.path.join( output_mesh_path, output_windows_mesh_filename )
             if create_meshes == True:
-                output_mesh_filename                          = os.path.join( output_mesh_path, output_mesh_filename )
+                output_mesh_file                              = os.path.join( output_mesh_path, output_mesh_filename )
             
             # Compare point clouds and filter the LOD2 data
             print("  Processing data: %d LiDAR points and %d LOD2 points..." % (len(lidar_point_cloud.points), len(complete_lod2_point_cloud.points) ) )
@@ -1766,16 +1756,18 @@ def main():
 
             print("  Writing combined point cloud:", combined_point_cloud_filename)
             complete_output_filename = os.path.join( output_point_cloud_path, combined_point_cloud_filename )
-            if complete_output_filename.endswith(".las"):
-                write_las(complete_output_filename, combined_point_cloud, point_cloud_ids)
+            if complete_output_filename.endswith((".las", ".laz")):
+                # The point records of the input are needed only for LAS outputs
+                source_las = load_source_point_records( lidar_filename )
+                write_las(complete_output_filename, combined_point_cloud, point_cloud_ids, source_las)
             else:
                 o3d.io.write_point_cloud(complete_output_filename, combined_point_cloud, write_ascii=False, compressed=False, print_progress=True)
             
         if create_meshes == True:
             # Create mesh from the combined data        
             mesh, windows_mesh = create_mesh(combined_point_cloud, filtered_lod2_point_cloud, complete_lod2_point_cloud, complete_lod2_mesh)
-            print("  Writing output mesh:", output_mesh_filename)
-            o3d.io.write_triangle_mesh(output_mesh_filename, mesh)
+            print("  Writing output mesh:", output_mesh_file)
+            o3d.io.write_triangle_mesh(output_mesh_file, mesh)
             if perform_window_detection == True:
                 o3d.io.write_triangle_mesh(output_windows_mesh_filename, windows_mesh)
         
@@ -1784,6 +1776,146 @@ def main():
     
     
 
+def process_directory_building(input_point_cloud_filename, input_lod2_obj_filename, combined_point_cloud_filename, output_mesh_filename, output_windows_mesh_filename):
+    """
+    Combine the LiDAR and LOD2 data of a single building, when processing the entire input directory, and optionally create its mesh.
+    The outputs are written under temporary names, and renamed to their final names only when complete, so that an interrupted run never leaves a truncated output behind.
+    
+    Parameters
+    ----------
+    input_point_cloud_filename : string
+        Full path and filename for the input LiDAR point cloud
+    input_lod2_obj_filename : string
+        Full path and filename for the input LOD2 .obj file
+    combined_point_cloud_filename : string
+        Full path and filename for the combined point cloud. With 'use_preprocessed_data', the combined point cloud is read from this file instead.
+    output_mesh_filename : string
+        Full path and filename for the mesh
+    output_windows_mesh_filename : string
+        Full path and filename for the windows mesh
+    
+    Returns
+    -------
+    output_files : List<string>
+        Output files written
+    point_count : int
+        Number of points in the combined point cloud
+    """
+    output_files = []
+    complete_lod2_point_cloud = None
+    filtered_lod2_point_cloud = None
+    complete_lod2_mesh = None
+    
+    # Load data
+    combined_point_cloud = None
+    if use_preprocessed_data == True:
+        print("  Loading preprocessed data...")
+        combined_point_cloud = load_point_cloud(combined_point_cloud_filename)
+    else:
+        print("  Input LOD2 object:", input_lod2_obj_filename)
+        print("  Loading data...")
+        # Get the LiDAR point cloud
+        lidar_point_cloud = load_point_cloud(input_point_cloud_filename)
+        # Convert LOD2 mesh into a point cloud
+        complete_lod2_point_cloud, complete_lod2_mesh = convert_obj_to_point_cloud(input_lod2_obj_filename)    
+        # Compare point clouds and filter the LOD2 data
+        print("  Processing data: %d LiDAR points and %d LOD2 points..." % (len(lidar_point_cloud.points), len(complete_lod2_point_cloud.points) ) )
+        filtered_lod2_point_cloud, filtered_lidar_point_cloud = filter_point_clouds( complete_lod2_point_cloud, lidar_point_cloud )
+    
+        # Combine the two point clouds
+        print("  Combining the point clouds...")
+        lidar_points = np.asarray( filtered_lidar_point_cloud.points )
+        lidar_normals = np.asarray( filtered_lidar_point_cloud.normals )
+        lod2_points = np.asarray( filtered_lod2_point_cloud.points )
+        lod2_normals = np.asarray( filtered_lod2_point_cloud.normals )
+        combined_points = np.concatenate((lidar_points, lod2_points), axis=0)
+        combined_normals = np.concatenate((lidar_normals, lod2_normals), axis=0)
+        
+        mms_ids = np.ones((len(lidar_points),1))
+        lod2_ids = np.zeros((len(lod2_points),1))
+        point_cloud_ids = np.concatenate((mms_ids, lod2_ids), axis=0)
+        
+        combined_point_cloud = o3d.geometry.PointCloud()
+        combined_point_cloud.points = o3d.utility.Vector3dVector(combined_points)
+        combined_point_cloud.normals = o3d.utility.Vector3dVector(combined_normals)
+
+        print("  Writing output point cloud:", combined_point_cloud_filename)
+        temporary_filename = jobmanifest.get_temporary_filename(combined_point_cloud_filename)
+        if combined_point_cloud_filename.endswith((".las", ".laz")):
+            # The point records of the input are needed only for LAS outputs
+            source_las = load_source_point_records(input_point_cloud_filename)
+            write_las(temporary_filename, combined_point_cloud, point_cloud_ids, source_las)
+        else:
+            o3d.io.write_point_cloud(temporary_filename, combined_point_cloud, write_ascii=False, compressed=False, print_progress=True)
+        jobmanifest.commit_output_file(temporary_filename, combined_point_cloud_filename)
+        output_files.append(combined_point_cloud_filename)
+    
+    if create_meshes == True:
+        # Create mesh from the combined data
+        print("  Writing output mesh:", output_mesh_filename)
+        mesh, windows_mesh = create_mesh(combined_point_cloud, filtered_lod2_point_cloud, complete_lod2_point_cloud, complete_lod2_mesh)
+        temporary_filename = jobmanifest.get_temporary_filename(output_mesh_filename)
+        o3d.io.write_triangle_mesh(temporary_filename, mesh)
+        jobmanifest.commit_output_file(temporary_filename, output_mesh_filename)
+        output_files.append(output_mesh_filename)
+        if perform_window_detection == True:
+            temporary_filename = jobmanifest.get_temporary_filename(output_windows_mesh_filename)
+            o3d.io.write_triangle_mesh(temporary_filename, windows_mesh)
+            jobmanifest.commit_output_file(temporary_filename, output_windows_mesh_filename)
+            output_files.append(output_windows_mesh_filename)
+    return output_files, len(combined_point_cloud.points)
+
+
+def get_job_parameters():
+    """
+    Get the parameters affecting the outputs of a building, recorded into the job manifest.
+    """
+    job_parameters = {
+        'use_preprocessed_data': use_preprocessed_data,
+        'create_meshes': create_meshes,
+        'filter_low_density_from_mesh': filter_low_density_from_mesh,
+        'skip_lod2_on_mesh_creation': skip_lod2_on_mesh_creation,
+        'perform_window_detection': perform_window_detection,
+        'preserve_point_records': preserve_point_records,
+        'voxel_size': voxel_size,
+        'voxel_size_bottom': voxel_size_bottom,
+        'ground_level_height_threshold': ground_level_height_threshold,
+        'street_level_height_threshold': street_level_height_threshold,
+        'high_level_height_threshold': high_level_height_threshold,
+        'distance_squared_threshold_2D_points': distance_squared_threshold_2D_points,
+        'distance_threshold_street_level': distance_threshold_street_level,
+        'distance_threshold_high_level': distance_threshold_high_level,
+        'normal_estimation_radius': normal_estimation_radius,
+        'mesh_creation_depth': mesh_creation_depth,
+        'max_distance_from_lod2': max_distance_from_lod2,
+        'density_threshold': density_threshold
+    }
+    for name, value in globals().items():
+        if name.startswith("window_detection_"):
+            job_parameters[name] = value
+    return job_parameters
+
+
+def record_job(job_name, status, job_hash, output_files=None, point_count=None, processing_time=None, error=None):
+    """
+    Append the status of a building into the job manifest, if 'job_manifest_file' is set.
+    """
+    if job_manifest_file is None:
+        return
+    if output_files is None:
+        output_files = []
+    jobmanifest.append_manifest_entry(job_manifest_file, {
+        'job': job_name,
+        'status': status,
+        'input_hash': job_hash,
+        'parameters': get_job_parameters(),
+        'outputs': output_files,
+        'point_count': point_count,
+        'processing_time': processing_time,
+        'error': error
+    })
+
+
 def create_mesh(combined_point_cloud, filtered_lod2_point_cloud, complete_lod2_point_cloud, complete_lod2_mesh):
     """
     Create a mesh of the input point cloud using Poisson Surface Reconstruction algorithm, and then process the mesh to clean it and detect windows.
@@ -1815,13 +1947,44 @@ def create_mesh(combined_point_cloud, filtered_lod2_point_cloud, complete_lod2_p
     return mesh, windows_mesh 
 
 
-def write_las(filename, point_cloud, point_cloud_ids = None):
+def write_las(filename, point_cloud, point_cloud_ids = None, source_las = None):
+    """
+    Write a point cloud into a LAS file, or a compressed LAZ file if the filename ends with '.laz'.
     
+    Parameters
+    ----------
+    filename : string
+        Full path and filename for the output point cloud
+    point_cloud : Open3D point cloud
+        Point cloud to write
+    point_cloud_ids : Numpy.array
+        Point cloud IDs ([N,1]), 1 for LiDAR points and 0 for LOD2 points. Written into the 'user_data' field.
+    source_las : laspy.LasData
+        If given, the output uses its point format, scales and offsets, and each LiDAR point gets the attributes of the nearest source point.
+        The LiDAR points are downsampled and filtered, so they can not be matched to the source points exactly.
+    """
     points = np.asarray(point_cloud.points)
     
-    header = laspy.LasHeader(point_format=3, version="1.4")
-    header.scale = [0.001, 0.001, 0.001]
-    las = laspy.LasData(header)
+    if source_las is None:
+        header = laspy.LasHeader(point_format=3, version="1.4")
+        header.scale = [0.001, 0.001, 0.001]
+        las = laspy.LasData(header)
+    else:
+        header = laspy.LasHeader(point_format=source_las.header.point_format, version="1.4")
+        header.scales = source_las.header.scales
+        header.offsets = source_las.header.offsets
+        las = laspy.LasData(header)
+        if point_cloud_ids is not None:
+            lidar_mask = np.reshape(point_cloud_ids, (-1)) == 1
+        else:
+            lidar_mask = np.ones(len(points), dtype=bool)
+        source_points = np.vstack([source_las.x, source_las.y, source_las.z]).transpose()
+        nearest_neighbor_search = o3d.core.nns.NearestNeighborSearch( o3d.core.Tensor(source_points) )
+        nearest_neighbor_search.knn_index()
+        nearest_indices, _ = nearest_neighbor_search.knn_search( o3d.core.Tensor(points[lidar_mask]), 1 )
+        point_array = np.zeros(len(points), dtype=source_las.points.array.dtype)
+        point_array[lidar_mask] = source_las.points.array[nearest_indices.numpy().reshape((-1))]
+        las.points = laspy.ScaleAwarePointRecord(point_array, header.point_format, header.scales, header.offsets)
     all_x = points[:,0]
     all_y = points[:,1]
     all_z = points[:,2]
@@ -27,7 +27,7 @@ def main():
     if process_entire_folder == True:
         for root, dirs, files in os.walk( input_path ):
             for filename in files:
-                if filename.endswith(".las"):
+                if filename.endswith((".las", ".laz")):
                     print("Processing point cloud:", filename)
                     
                     # Check for existing files
@@ -73,7 +73,7 @@ def main():
         input_file = os.path.join( input_path, input_filename )
         if input_file.endswith(".ply"):
             point_cloud = o3d.io.read_point_cloud(input_file)
-        elif input_file.endswith(".las"):
+        elif input_file.endswith((".las", ".laz")):
             las = laspy.read(input_file)
             xyz = np.vstack([las.x, las.y, las.z]).transpose()
             point_cloud = o3d.geometry.PointCloud()
@@ -4,14 +4,26 @@ import open3d as o3d
 import os
 import laspy
 import pyproj
+import json
+import concurrent.futures
 
 """
-Read all .las files in the data_path, get the bounding boxes of their data, and list them in the output file
+Read all .las/.laz files in the data_path, get the bounding boxes of their data, and list them in the output file
+By default, the bounding box is read from the LAS header (min/max extents), which does not require reading any point data.
+If the header extents look invalid, or the file is listed in 'untrusted_header_files', the points are scanned in chunks instead.
+Files are read in parallel in a process pool. The bounds of every file are also stored into an index file together with the file size, modification time
+and how the bounds were obtained, and on later runs, only new or modified files, or files whose bounds were obtained differently than the current settings require, are read again.
 """
 
 data_path = "S:/Sendai/MMS_20220819/las/"
 output_file = "S:/Sendai/MMS_20220819/las_bounds.txt"
 
+use_header_bounds      = True    # If True, use the header extents when they look valid. If False, always scan the point data.
+untrusted_header_files = []      # Filenames whose header extents are known to be wrong. Points of these files are always scanned.
+scan_chunk_size        = 5000000 # Number of points read at a time, when the bounds are computed from the point data
+bounds_index_file      = "S:/Sendai/MMS_20220819/las_bounds_index.json" # Persisted bounds of each file. Set to None to read every file on every run.
+worker_count           = os.cpu_count() # Number of processes used to read the files
+
 
 def main():
     output_data = process_dataset()
@@ -20,35 +32,180 @@ def main():
     
     
 def process_dataset():
-    output_data = []
+    # Collect the files, and see which of them are already in the index with the same size and modification time, and with bounds obtained as the settings require
+    bounds_index = load_bounds_index()
+    updated_index = {}
+    files_to_read = []
+    dataset_files = []
     for root, dirs, files in os.walk( data_path ):
         for filename in files:
-            if filename.endswith(".las"):
-                print("Reading file: %s..." % filename )
+            if filename.endswith((".las", ".laz")):
                 complete_filename = os.path.join(data_path, filename)
-                las_file = laspy.read( complete_filename )
-                xyz = np.vstack([las_file.x, las_file.y, las_file.z]).transpose()
-                
-                all_x = xyz[:,0]
-                all_y = xyz[:,1]
-                all_z = xyz[:,2]
-                x_min = np.min(all_x)
-                y_min = np.min(all_y)
-                z_min = np.min(all_z)
-                x_max = np.max(all_x)
-                y_max = np.max(all_y)
-                z_max = np.max(all_z)
-                print("    Minimum coordinates: (%f,%f,%f)" % (x_min, y_min, z_min) )
-                print("    Maximum coordinates: (%f,%f,%f)" % (x_max, y_max, z_max) )
-                new_data = {
-                    'filename': filename,
-                    'min_coord': [x_min, y_min, z_min],
-                    'max_coord': [x_max, y_max, z_max]
-                }
-                output_data.append(new_data)
+                file_stat = os.stat(complete_filename)
+                dataset_files.append([filename, complete_filename])
+                entry = bounds_index.get(complete_filename)
+                if entry is not None and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime and is_bounds_source_valid(entry.get('bounds_source'), filename):
+                    updated_index[complete_filename] = entry
+                else:
+                    files_to_read.append([complete_filename, file_stat.st_size, file_stat.st_mtime])
             else:
                 print("Skipping file %s..." % filename )
+    print("Found %d files, %d of them new or modified." % (len(dataset_files), len(files_to_read)) )
+    
+    # Read the bounds of the new and modified files. A file that cannot be read is reported and left out, and the index is saved even if the run is interrupted,
+    # so that the files read so far do not need to be read again.
+    failed_files = []
+    try:
+        if len(files_to_read) > 0:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) as executor:
+                futures = {}
+                for file_data in files_to_read:
+                    future = executor.submit(get_las_bounds, file_data[0])
+                    futures[future] = file_data
+                for future in concurrent.futures.as_completed(futures):
+                    complete_filename, file_size, file_mtime = futures[future]
+                    try:
+                        min_coord, max_coord, bounds_source = future.result()
+                    except Exception as e:
+                        print("Failed to read file %s, skipping: %s" % (complete_filename, e) )
+                        failed_files.append(complete_filename)
+                        continue
+                    print("Read file: %s" % complete_filename )
+                    print("    Minimum coordinates: (%f,%f,%f)" % (min_coord[0], min_coord[1], min_coord[2]) )
+                    print("    Maximum coordinates: (%f,%f,%f)" % (max_coord[0], max_coord[1], max_coord[2]) )
+                    updated_index[complete_filename] = {
+                        'size': file_size,
+                        'mtime': file_mtime,
+                        'min_coord': min_coord,
+                        'max_coord': max_coord,
+                        'bounds_source': bounds_source
+                    }
+    finally:
+        save_bounds_index(updated_index)
+    if len(failed_files) > 0:
+        print("%d files could not be read, and are left out of the output." % len(failed_files) )
+    
+    output_data = []
+    for filename, complete_filename in dataset_files:
+        if complete_filename not in updated_index:
+            continue
+        entry = updated_index[complete_filename]
+        new_data = {
+            'filename': filename,
+            'min_coord': entry['min_coord'],
+            'max_coord': entry['max_coord']
+        }
+        output_data.append(new_data)
     return output_data
+
+
+def load_bounds_index():
+    """
+    Read the bounds index saved by an earlier run. Entries are keyed by the full filename, and contain the file size, modification time, bounds and bounds source (see 'get_las_bounds()').
+    """
+    if bounds_index_file is None or os.path.exists(bounds_index_file) == False:
+        return {}
+    with open(bounds_index_file, 'r') as f:
+        return json.load(f)
+
+
+def save_bounds_index(bounds_index):
+    """
+    Write the bounds index into a temporary file first, and then replace the old index with it, so that an interrupted run never leaves a broken index behind.
+    """
+    if bounds_index_file is None:
+        return
+    temporary_filename = bounds_index_file + ".tmp"
+    with open(temporary_filename, 'w') as f:
+        json.dump(bounds_index, f)
+    os.replace(temporary_filename, bounds_index_file)
+
+
+def get_las_bounds(filename):
+    """
+    Get the bounding box of the points in a LAS file, using the header extents if they can be trusted, and scanning the points otherwise.
+    
+    Parameters
+    ----------
+    filename : string
+        Full path and filename of the LAS file
+    
+    Returns
+    -------
+    min_coord : List<float>
+        Minimum x, y and z coordinates of the points
+    max_coord : List<float>
+        Maximum x, y and z coordinates of the points
+    bounds_source : string
+        How the bounds were obtained: "header" from the header extents, "scan" by scanning the points as required by the settings,
+        or "invalid_header" by scanning the points because the header extents were not valid
+    """
+    if is_header_bounds_allowed(os.path.basename(filename)) == True:
+        header_bounds = read_header_bounds(filename)
+        if header_bounds is not None:
+            return header_bounds[0], header_bounds[1], "header"
+        print("    Header extents are not valid, scanning the points instead...")
+        min_coord, max_coord = scan_point_bounds(filename)
+        return min_coord, max_coord, "invalid_header"
+    min_coord, max_coord = scan_point_bounds(filename)
+    return min_coord, max_coord, "scan"
+
+
+def is_header_bounds_allowed(filename):
+    """
+    Check if the settings ('use_header_bounds' and 'untrusted_header_files') allow using the header extents of a file.
+    """
+    return use_header_bounds == True and filename not in untrusted_header_files
+
+
+def is_bounds_source_valid(bounds_source, filename):
+    """
+    Check if bounds stored in the index were obtained as the current settings require. Header extents are not valid anymore, if the settings now require scanning the points,
+    and scanned bounds are not valid anymore, if the settings now allow the header extents (unless the header extents were not valid to begin with).
+    Entries written before the bounds source was stored are never valid.
+    """
+    if is_header_bounds_allowed(filename) == True:
+        return bounds_source in ["header", "invalid_header"]
+    return bounds_source in ["scan", "invalid_header"]
+
+
+def read_header_bounds(filename):
+    """
+    Read the min/max extents stored in the LAS header without reading any point data.
+    Returns None, if the header has no points, or the extents are not finite or are otherwise inconsistent (e.g. left unset by the writing software).
+    """
+    with laspy.open(filename) as reader:
+        header = reader.header
+        point_count = header.point_count
+        mins = np.asarray(header.mins, dtype=np.float64)
+        maxs = np.asarray(header.maxs, dtype=np.float64)
+    if point_count == 0:
+        return None
+    if not np.all(np.isfinite(mins)) or not np.all(np.isfinite(maxs)):
+        return None
+    if np.any(mins > maxs):
+        return None
+    if not np.any(mins) and not np.any(maxs):
+        # All zeros, extents were never written
+        return None
+    return mins.tolist(), maxs.tolist()
+
+
+def scan_point_bounds(filename):
+    """
+    Compute the min/max extents by reading the points in chunks of 'scan_chunk_size', so that the whole file never needs to be in memory at once.
+    """
+    min_coord = np.full(3, np.inf)
+    max_coord = np.full(3, -np.inf)
+    with laspy.open(filename) as reader:
+        for points in reader.chunk_iterator(scan_chunk_size):
+            if len(points) == 0:
+                continue
+            for axis, values in enumerate((points.x, points.y, points.z)):
+                values = np.asarray(values)
+                min_coord[axis] = min(min_coord[axis], np.min(values))
+                max_coord[axis] = max(max_coord[axis], np.max(values))
+    return min_coord.tolist(), max_coord.tolist()
     
 
 def write_output(data):
@@ -0,0 +1,305 @@
+import os
+import shutil
+import json
+import numpy as np
+import laspy
+import concurrent.futures
+
+"""
+Convert every .las/.laz file in the data_path into a tile cache of memory-mappable NumPy arrays, so that repeated runs of
+'04_split_dataset_points_to_buildings_with_realignment.py' do not need to decode the point cloud files again, and only touch the parts of each tile they need.
+The points are sorted by the cell of a 2D grid they fall into (row by row), so that the points of any area are found in a few contiguous ranges of the arrays.
+Each tile gets its own folder in the cache_path, named after the point cloud file, containing:
+    x.npy, y.npy, z.npy               : Point coordinates (float64)
+    user_data.npy, classification.npy : Point cloud IDs and labels
+    records.npy                       : The raw LAS point records, used when the full point records are written into the output
+    cell_offsets.npy                  : Index of the first point of each grid cell (row-major), plus the total point count at the end
+    meta.json                         : Size and modification time of the source file, point count, point format, scales, offsets and the grid definition
+Tiles whose source file has not changed since it was cached are skipped.
+"""
+
+data_path       = "S:/Sendai/MMS_20220819/las/"
+cache_path      = "S:/Sendai/MMS_20220819/tile_cache/"
+
+grid_cell_size  = 5.0     # Size (in meters) of the grid cells the points are sorted by. Readers fetch only the cells overlapping their area of interest.
+read_chunk_size = 5000000 # Number of points read from a point cloud file at a time
+worker_count    = os.cpu_count() # Number of processes used to convert the files
+
+CACHE_COLUMNS = ["x", "y", "z", "user_data", "classification", "records"]
+CACHE_VERSION = 2 # Caches written with an older layout are rebuilt
+
+
+def main():
+    files_to_cache = []
+    for root, dirs, files in os.walk( data_path ):
+        for filename in files:
+            if filename.endswith((".las", ".laz")):
+                input_file = os.path.join(data_path, filename)
+                cache_folder = get_tile_cache_folder(cache_path, filename)
+                if is_tile_cache_valid(input_file, cache_folder) == True:
+                    print("Skipping file %s..." % filename )
+                    continue
+                files_to_cache.append([input_file, cache_folder])
+    print("Found %d new or modified files to cache." % len(files_to_cache) )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) as executor:
+        futures = {}
+        for input_file, cache_folder in files_to_cache:
+            future = executor.submit(write_tile_cache, input_file, cache_folder)
+            futures[future] = input_file
+        for future in concurrent.futures.as_completed(futures):
+            point_count = future.result()
+            print("Cached file: %s (%d points)" % (futures[future], point_count) )
+    print("Done")
+
+
+def get_tile_cache_folder(tile_cache_path, filename):
+    """
+    Get the cache folder of a point cloud file.
+    """
+    return os.path.join(tile_cache_path, os.path.basename(filename))
+
+
+def is_tile_cache_valid(input_file, cache_folder):
+    """
+    Check if the cache folder exists and was written from the current version of the input file (same size and modification time).
+    """
+    meta_filename = os.path.join(cache_folder, "meta.json")
+    if os.path.exists(meta_filename) == False:
+        return False
+    with open(meta_filename, 'r') as f:
+        meta = json.load(f)
+    file_stat = os.stat(input_file)
+    return meta.get('cache_version') == CACHE_VERSION and meta['source_size'] == file_stat.st_size and meta['source_mtime'] == file_stat.st_mtime
+
+
+def write_tile_cache(input_file, cache_folder):
+    """
+    Convert a point cloud file into a cache folder. The file is decoded once, chunk by chunk, into unsorted memory-mapped arrays,
+    which are then scattered into the final arrays in grid cell order with a two-pass counting sort over the same chunks.
+    Memory use is limited to a chunk of points and the per-cell counts, so the whole tile never needs to fit into memory.
+    The cache is written into a temporary folder first, which then replaces the old cache folder, so that an interrupted run never leaves a broken cache behind.
+
+    Parameters
+    ----------
+    input_file : string
+        Full path and filename of the LAS/LAZ file
+    cache_folder : string
+        Folder to write the cache into
+
+    Returns
+    -------
+    point_count : int
+        Number of points cached
+    """
+    file_stat = os.stat(input_file)
+    temporary_folder = cache_folder + ".tmp"
+    if os.path.exists(temporary_folder) == True:
+        shutil.rmtree(temporary_folder)
+    os.makedirs(temporary_folder)
+
+    with laspy.open(input_file) as reader:
+        header = reader.header
+        point_count = header.point_count
+        point_format = header.point_format
+        column_dtypes = {
+            'x': np.float64,
+            'y': np.float64,
+            'z': np.float64,
+            'user_data': np.uint8,
+            'classification': np.uint8,
+            'records': point_format.dtype()
+        }
+        unsorted_columns = {}
+        for column_name in CACHE_COLUMNS:
+            unsorted_filename = os.path.join(temporary_folder, "unsorted_" + column_name + ".npy")
+            unsorted_columns[column_name] = np.lib.format.open_memmap(unsorted_filename, mode='w+', dtype=column_dtypes[column_name], shape=(point_count,))
+        first_point = 0
+        for points in reader.chunk_iterator(read_chunk_size):
+            last_point = first_point + len(points)
+            unsorted_columns['x'][first_point:last_point] = points.x
+            unsorted_columns['y'][first_point:last_point] = points.y
+            unsorted_columns['z'][first_point:last_point] = points.z
+            unsorted_columns['user_data'][first_point:last_point] = points.user_data
+            unsorted_columns['classification'][first_point:last_point] = points.classification
+            unsorted_columns['records'][first_point:last_point] = points.array
+            first_point = last_point
+
+    # Sort the points by grid cell with a counting sort, chunk by chunk. Points within a cell keep their original order.
+    if point_count > 0:
+        grid_origin = [float(np.min(unsorted_columns['x'])), float(np.min(unsorted_columns['y']))]
+        grid_shape = [0, 0]
+        for first_point in range(0, point_count, read_chunk_size):
+            last_point = min(first_point + read_chunk_size, point_count)
+            grid_shape[0] = max(grid_shape[0], int(np.max((unsorted_columns['x'][first_point:last_point] - grid_origin[0]) / grid_cell_size)) + 1)
+            grid_shape[1] = max(grid_shape[1], int(np.max((unsorted_columns['y'][first_point:last_point] - grid_origin[1]) / grid_cell_size)) + 1)
+    else:
+        grid_origin = [0.0, 0.0]
+        grid_shape = [0, 0]
+    def get_cell_keys(first_point, last_point):
+        cell_x = ((unsorted_columns['x'][first_point:last_point] - grid_origin[0]) / grid_cell_size).astype(np.int64)
+        cell_y = ((unsorted_columns['y'][first_point:last_point] - grid_origin[1]) / grid_cell_size).astype(np.int64)
+        return cell_y * grid_shape[0] + cell_x
+
+    # First pass: count the points in each cell
+    cell_counts = np.zeros(grid_shape[0]*grid_shape[1], dtype=np.int64)
+    for first_point in range(0, point_count, read_chunk_size):
+        last_point = min(first_point + read_chunk_size, point_count)
+        cell_counts += np.bincount(get_cell_keys(first_point, last_point), minlength=len(cell_counts))
+    cell_offsets = np.zeros(grid_shape[0]*grid_shape[1] + 1, dtype=np.int64)
+    np.cumsum(cell_counts, out=cell_offsets[1:])
+    np.save(os.path.join(temporary_folder, "cell_offsets.npy"), cell_offsets)
+
+    # Second pass: scatter each chunk into its cells, after the points of the earlier chunks
+    columns = {}
+    for column_name in CACHE_COLUMNS:
+        columns[column_name] = np.lib.format.open_memmap(os.path.join(temporary_folder, column_name + ".npy"), mode='w+', dtype=column_dtypes[column_name], shape=(point_count,))
+    cell_cursors = cell_offsets[:-1].copy()
+    for first_point in range(0, point_count, read_chunk_size):
+        last_point = min(first_point + read_chunk_size, point_count)
+        cell_keys = get_cell_keys(first_point, last_point)
+        chunk_order = np.argsort(cell_keys, kind='stable')
+        sorted_keys = cell_keys[chunk_order]
+        rank_in_cell = np.arange(len(sorted_keys)) - np.searchsorted(sorted_keys, sorted_keys, side='left')
+        destinations = cell_cursors[sorted_keys] + rank_in_cell
+        for column_name in CACHE_COLUMNS:
+            columns[column_name][destinations] = unsorted_columns[column_name][first_point:last_point][chunk_order]
+        cell_cursors += np.bincount(cell_keys, minlength=len(cell_cursors))
+    for column_name in CACHE_COLUMNS:
+        columns[column_name].flush()
+    del columns
+    del unsorted_columns
+    for column_name in CACHE_COLUMNS:
+        os.remove(os.path.join(temporary_folder, "unsorted_" + column_name + ".npy"))
+
+    meta = {
+        'cache_version': CACHE_VERSION,
+        'source_size': file_stat.st_size,
+        'source_mtime': file_stat.st_mtime,
+        'point_count': point_count,
+        'point_format': point_format.id,
+        'extra_dimensions': [[name, column_dtypes['records'][name].str] for name in point_format.extra_dimension_names],
+        'scales': [float(scale) for scale in header.scales],
+        'offsets': [float(offset) for offset in header.offsets],
+        'grid_origin': grid_origin,
+        'grid_cell_size': grid_cell_size,
+        'grid_shape': grid_shape
+    }
+    with open(os.path.join(temporary_folder, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(cache_folder) == True:
+        shutil.rmtree(cache_folder)
+    os.replace(temporary_folder, cache_folder)
+    return point_count
+
+
+def load_tile_cache(cache_folder):
+    """
+    Open the arrays of a cached tile as read-only memory maps. Nothing is read from the disk until the arrays are accessed.
+
+    Parameters
+    ----------
+    cache_folder : string
+        Cache folder written by 'write_tile_cache()'
+
+    Returns
+    -------
+    tile_cache : dict
+        'x', 'y', 'z', 'user_data', 'classification', 'records' : Memory-mapped Numpy.arrays ([N])
+        'cell_offsets' : Numpy.array ([X*Y+1]) of the first point of each grid cell
+        'meta'         : Contents of 'meta.json'
+        'point_format' : laspy.PointFormat of the records
+    """
+    with open(os.path.join(cache_folder, "meta.json"), 'r') as f:
+        meta = json.load(f)
+    tile_cache = {}
+    for column_name in CACHE_COLUMNS:
+        tile_cache[column_name] = np.load(os.path.join(cache_folder, column_name + ".npy"), mmap_mode='r')
+    tile_cache['cell_offsets'] = np.load(os.path.join(cache_folder, "cell_offsets.npy"))
+    tile_cache['meta'] = meta
+    point_format = laspy.PointFormat(meta['point_format'])
+    for name, dtype in meta['extra_dimensions']:
+        point_format.add_extra_dimension(laspy.ExtraBytesParams(name=name, type=np.dtype(dtype)))
+    tile_cache['point_format'] = point_format
+    return tile_cache
+
+
+def get_tile_cache_point_ranges(tile_cache, query_bbox=None):
+    """
+    Get the ranges of consecutive points in a cached tile, that cover the grid cells overlapping a bounding box.
+    Each row of cells overlapping the bounding box is a single range, and neighboring ranges are merged.
+
+    Parameters
+    ----------
+    tile_cache : dict
+        Cached tile, as returned by 'load_tile_cache()'
+    query_bbox : List<float>
+        min_x, min_y, max_x, max_y of the area of interest, or None to get all points
+
+    Returns
+    -------
+    point_ranges : List<[int, int]>
+        First and one-past-last point index of each range
+    """
+    meta = tile_cache['meta']
+    point_count = meta['point_count']
+    if point_count == 0:
+        return []
+    if query_bbox is None:
+        return [[0, point_count]]
+    cell_offsets = tile_cache['cell_offsets']
+    cell_count_x, cell_count_y = meta['grid_shape']
+    first_cell_x = int(np.floor((query_bbox[0] - meta['grid_origin'][0]) / meta['grid_cell_size']))
+    first_cell_y = int(np.floor((query_bbox[1] - meta['grid_origin'][1]) / meta['grid_cell_size']))
+    last_cell_x = int(np.floor((query_bbox[2] - meta['grid_origin'][0]) / meta['grid_cell_size']))
+    last_cell_y = int(np.floor((query_bbox[3] - meta['grid_origin'][1]) / meta['grid_cell_size']))
+    if last_cell_x < 0 or last_cell_y < 0 or first_cell_x >= cell_count_x or first_cell_y >= cell_count_y:
+        # The bounding box is completely outside the grid (the header extents of a tile can be larger than its points)
+        return []
+    first_cell_x = min(max(first_cell_x, 0), cell_count_x - 1)
+    first_cell_y = min(max(first_cell_y, 0), cell_count_y - 1)
+    last_cell_x = min(max(last_cell_x, 0), cell_count_x - 1)
+    last_cell_y = min(max(last_cell_y, 0), cell_count_y - 1)
+    if first_cell_x > last_cell_x or first_cell_y > last_cell_y:
+        return []
+    point_ranges = []
+    for cell_y in range(first_cell_y, last_cell_y + 1):
+        first_point = int(cell_offsets[cell_y * cell_count_x + first_cell_x])
+        last_point = int(cell_offsets[cell_y * cell_count_x + last_cell_x + 1])
+        if first_point == last_point:
+            continue
+        if len(point_ranges) > 0 and point_ranges[-1][1] == first_point:
+            point_ranges[-1][1] = last_point
+        else:
+            point_ranges.append([first_point, last_point])
+    return point_ranges
+
+
+def split_point_ranges(point_ranges, chunk_size):
+    """
+    Split a list of point ranges into chunks of at most 'chunk_size' points in total.
+
+    Yields
+    ------
+    chunk_ranges : List<[int, int]>
+        Point ranges of a single chunk
+    """
+    chunk_ranges = []
+    chunk_point_count = 0
+    for first_point, last_point in point_ranges:
+        while first_point < last_point:
+            range_end = min(last_point, first_point + chunk_size - chunk_point_count)
+            chunk_ranges.append([first_point, range_end])
+            chunk_point_count += range_end - first_point
+            first_point = range_end
+            if chunk_point_count == chunk_size:
+                yield chunk_ranges
+                chunk_ranges = []
+                chunk_point_count = 0
+    if len(chunk_ranges) > 0:
+        yield chunk_ranges
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import os
+import numpy as np
+
+"""
+Footprint polygon table shared by the scripts reading footprint polygon files ('02_polygon_expansion.py', '03_get_building_list_in_polygon.py' and
+'04_split_dataset_points_to_buildings_with_realignment.py'), so that the polygons are parsed only once into arrays.
+The table is a dict:
+    names             : List<string> of the LOD2 object filename of each building
+    point_cloud_names : List<string> of the point cloud filename of each building
+    coordinates       : Numpy.array ([N,2], float64) of the nodes of all polygons, one polygon after another
+    offsets           : Numpy.array ([B+1], int64) of the first node of each polygon in 'coordinates', plus the total node count at the end
+    bboxes            : Numpy.array ([B,4], float64) of min_x, min_y, max_x, max_y of each polygon (NaN for polygons without nodes)
+
+Two file formats are supported, chosen by the filename extension:
+    .txt (or any other) : The text format written by 'create_footprint_polygons.py'. Each line is a building: object filename, point cloud filename, and the x y pairs of the polygon nodes.
+    .npz                : The same arrays in a NumPy archive, which loads much faster than parsing the text. Names are stored as unicode arrays.
+'create_footprint_polygons.py' and '02_polygon_expansion.py' write the archive next to their text output (see 'get_archive_filename()'), so it can be given to the later scripts instead of the text file.
+"""
+
+
+def create_footprint_table(names, point_cloud_names, polygons):
+    """
+    Create a footprint table from per-building polygons.
+
+    Parameters
+    ----------
+    names : List<string>
+        LOD2 object filename of each building
+    point_cloud_names : List<string>
+        Point cloud filename of each building
+    polygons : List<Numpy.array or List<[float, float]>>
+        Nodes of each polygon
+
+    Returns
+    -------
+    footprints : dict
+        The footprint table
+    """
+    node_counts = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum(node_counts, out=offsets[1:])
+    coordinates = np.empty((offsets[-1], 2), dtype=np.float64)
+    for building_number in range(len(polygons)):
+        coordinates[offsets[building_number]:offsets[building_number+1]] = np.asarray(polygons[building_number], dtype=np.float64).reshape((-1,2))
+    return {
+        'names': list(names),
+        'point_cloud_names': list(point_cloud_names),
+        'coordinates': coordinates,
+        'offsets': offsets,
+        'bboxes': compute_bboxes(coordinates, offsets)
+    }
+
+
+def compute_bboxes(coordinates, offsets):
+    """
+    Compute the bounding box (min_x, min_y, max_x, max_y) of each polygon in a footprint table. Polygons without nodes get NaN bounding boxes.
+    """
+    bboxes = np.full((len(offsets) - 1, 4), np.nan)
+    has_nodes = offsets[1:] > offsets[:-1]
+    if np.any(has_nodes) == True:
+        first_nodes = offsets[:-1][has_nodes]
+        bboxes[has_nodes, 0:2] = np.minimum.reduceat(coordinates, first_nodes, axis=0)
+        bboxes[has_nodes, 2:4] = np.maximum.reduceat(coordinates, first_nodes, axis=0)
+    return bboxes
+
+
+def parse_footprint_lines(lines):
+    """
+    Parse lines of the text format into a footprint table. Empty lines are skipped.
+    """
+    names = []
+    point_cloud_names = []
+    polygons = []
+    for line in lines:
+        words = line.split()
+        if len(words) == 0:
+            continue
+        names.append(words[0])
+        point_cloud_names.append(words[1])
+        polygons.append(np.array(words[2:], dtype=np.float64).reshape((-1,2)))
+    return create_footprint_table(names, point_cloud_names, polygons)
+
+
+def format_footprint_line(footprints, building_number):
+    """
+    Format a building of a footprint table as a line of the text format (including the line break).
+    The coordinates are written with 'str()', so that they read back exactly.
+    """
+    words = [footprints['names'][building_number], footprints['point_cloud_names'][building_number]]
+    for x, y in get_polygon(footprints, building_number).tolist():
+        words.append(str(x))
+        words.append(str(y))
+    return " ".join(words) + "\n"
+
+
+def load_footprint_table(filename):
+    """
+    Load a footprint table from a text or .npz file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path and filename of the footprint file
+
+    Returns
+    -------
+    footprints : dict
+        The footprint table
+    """
+    if filename.endswith(".npz"):
+        with np.load(filename) as archive:
+            return {
+                'names': archive['names'].tolist(),
+                'point_cloud_names': archive['point_cloud_names'].tolist(),
+                'coordinates': archive['coordinates'],
+                'offsets': archive['offsets'],
+                'bboxes': archive['bboxes']
+            }
+    with open(filename, 'r') as footprint_file:
+        return parse_footprint_lines(footprint_file.readlines())
+
+
+def save_footprint_table(footprints, filename):
+    """
+    Save a footprint table into a text or .npz file.
+
+    Parameters
+    ----------
+    footprints : dict
+        The footprint table
+    filename : string
+        Full path and filename of the footprint file
+    """
+    if filename.endswith(".npz"):
+        np.savez(filename,
+                 names=np.array(footprints['names'], dtype=np.str_),
+                 point_cloud_names=np.array(footprints['point_cloud_names'], dtype=np.str_),
+                 coordinates=footprints['coordinates'],
+                 offsets=footprints['offsets'],
+                 bboxes=footprints['bboxes'])
+        return
+    with open(filename, 'w') as footprint_file:
+        for building_number in range(len(footprints['names'])):
+            footprint_file.write(format_footprint_line(footprints, building_number))
+
+
+def get_archive_filename(filename):
+    """
+    Get the filename of the .npz archive written next to a text footprint file: the same path and name, with the extension replaced by '.npz'.
+    """
+    return os.path.splitext(filename)[0] + ".npz"
+
+
+def get_polygon(footprints, building_number):
+    """
+    Get the nodes ([N,2]) of a polygon in a footprint table. The returned array is a view into the table.
+    """
+    return footprints['coordinates'][footprints['offsets'][building_number]:footprints['offsets'][building_number+1]]
+
+
+def get_building_numbers_by_name(footprints):
+    """
+    Get a dictionary from the LOD2 object filenames to the positions of the buildings in a footprint table.
+    """
+    return {footprints['names'][building_number]: building_number for building_number in range(len(footprints['names']))}
+
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import hashlib
+
+"""
+Job manifest shared by the batch processing scripts ('04_split_dataset_points_to_buildings_with_realignment.py' and '05_combine_lod2_and_point_cloud.py').
+The manifest is a JSON-lines file, where each line records a state change of a single job (usually a building):
+    job             : Name of the job
+    status          : 'started', 'done' or 'failed'
+    input_hash      : Hash of the input files (names, sizes and modification times) and of the parameters affecting the output
+    parameters      : The parameters included in the hash
+    outputs         : Output files written by the job
+    point_count     : Number of points written, if known
+    processing_time : Seconds spent on the job
+    error           : Error message of a failed job
+    time            : Time of the record (seconds since epoch)
+Lines are only ever appended, each with a single write in append mode, so an interrupted run can at worst leave a partial line behind.
+The next record is then appended right after the partial line, and is recovered from the end of that line when loading (see 'parse_manifest_line()').
+The last record of each job tells its current state. A job is done, if its last record is 'done' with the current input hash, and all its outputs exist.
+
+Outputs are written into temporary files first (see 'get_temporary_filename()'), and renamed to their final names only when complete,
+so that a run killed in the middle of writing never leaves a truncated output that looks finished.
+"""
+
+JOB_STATUS_STARTED = "started"
+JOB_STATUS_DONE    = "done"
+JOB_STATUS_FAILED  = "failed"
+
+
+def load_manifest(manifest_filename):
+    """
+    Read the latest record of each job from the manifest file.
+
+    Parameters
+    ----------
+    manifest_filename : string
+        Full path and filename of the manifest
+
+    Returns
+    -------
+    manifest : dict
+        The last record of each job, keyed by the job name
+    """
+    manifest = {}
+    if os.path.exists(manifest_filename) == False:
+        return manifest
+    with open(manifest_filename, 'r') as f:
+        for line in f:
+            entry = parse_manifest_line(line)
+            if entry is not None:
+                manifest[entry['job']] = entry
+    return manifest
+
+
+def parse_manifest_line(line):
+    """
+    Parse a line of the manifest file. If an interrupted run left a partial record behind, the line starts with the partial record,
+    possibly followed by a complete record appended by a later run, which is then returned.
+    Returns None, if the line contains no complete record.
+    """
+    line = line.strip()
+    decoder = json.JSONDecoder()
+    start = line.find("{")
+    while start >= 0:
+        try:
+            entry, end = decoder.raw_decode(line, start)
+        except ValueError:
+            entry, end = None, -1
+        if end == len(line) and isinstance(entry, dict) and 'job' in entry and 'status' in entry:
+            return entry
+        start = line.find("{", start + 1)
+    return None
+
+
+def append_manifest_entry(manifest_filename, entry):
+    """
+    Append a record into the manifest file. The record is written as one complete line with a single write call in append mode, and flushed to the disk before returning,
+    so that several processes can append records into the same manifest without interleaving them.
+
+    Parameters
+    ----------
+    manifest_filename : string
+        Full path and filename of the manifest
+    entry : dict
+        The record to add. Must contain 'job' and 'status'. The current time is added as 'time'.
+    """
+    entry = dict(entry)
+    entry['time'] = time.time()
+    with open(manifest_filename, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def compute_input_hash(input_files, parameters):
+    """
+    Hash the input files of a job and its parameters. The files are identified by their name, size and modification time, so that their contents do not need to be read.
+
+    Parameters
+    ----------
+    input_files : List<string>
+        Full paths and filenames of the input files. Missing files are hashed as missing.
+    parameters : dict
+        JSON-serializable parameters affecting the output
+
+    Returns
+    -------
+    input_hash : string
+        Hexadecimal SHA-1 hash
+    """
+    file_signatures = []
+    for filename in input_files:
+        if os.path.exists(filename) == True:
+            file_stat = os.stat(filename)
+            file_signatures.append([os.path.basename(filename), file_stat.st_size, file_stat.st_mtime])
+        else:
+            file_signatures.append([os.path.basename(filename), None, None])
+    hash_data = json.dumps({'files': file_signatures, 'parameters': parameters}, sort_keys=True)
+    return hashlib.sha1(hash_data.encode("utf-8")).hexdigest()
+
+
+def is_job_done(manifest, job_name, input_hash):
+    """
+    Check if a job has been completed with the same inputs and parameters, and the outputs it recorded still exist.
+    """
+    entry = manifest.get(job_name)
+    if entry is None or entry['status'] != JOB_STATUS_DONE or entry['input_hash'] != input_hash:
+        return False
+    return all(os.path.exists(filename) for filename in entry['outputs'])
+
+
+def get_temporary_filename(filename):
+    """
+    Get the name of the temporary file to write an output into. The extension is kept, as the writers choose the file format by it.
+    """
+    root, extension = os.path.splitext(filename)
+    return root + ".tmp" + extension
+
+
+def commit_output_file(temporary_filename, filename):
+    """
+    Replace the output file with its completely written temporary file.
+    """
+    os.replace(temporary_filename, filename)
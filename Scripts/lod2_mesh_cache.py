@@ -0,0 +1,81 @@
+import os
+import hashlib
+import numpy as np
+import trimesh
+
+"""
+Cache of LOD2 meshes shared by '01_create_footprint_polygons.py' and '05_combine_lod2_and_point_cloud.py', so that each text OBJ file is parsed only once per LOD2 release.
+Each OBJ file gets a NumPy archive in the cache folder, named after the OBJ file and a hash of its full path (so that OBJ files with the same name in different folders do not share an archive), containing:
+    vertices       : Vertex positions ([V,3], float64)
+    faces          : Vertex indices of the triangles ([F,3], int64)
+    vertex_normals : Vertex normals ([V,3], float64), as the normals read from the OBJ file are not recomputed from the faces
+    source         : Full path, size and modification time of the OBJ file
+A cached mesh is used only if the OBJ file still has the same path, size and modification time. Otherwise the OBJ file is parsed again, and the cache is updated.
+"""
+
+
+def get_mesh_cache_filename(cache_folder, obj_filename):
+    """
+    Get the cache file of an OBJ file: its name, followed by a hash of its full path.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(obj_filename).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_folder, os.path.basename(obj_filename) + "_" + path_hash + ".npz")
+
+
+def get_source_signature(obj_filename):
+    """
+    Get the path, size and modification time identifying the current version of an OBJ file.
+    """
+    file_stat = os.stat(obj_filename)
+    return np.array([os.path.abspath(obj_filename), repr(file_stat.st_size), repr(file_stat.st_mtime)])
+
+
+def load_lod2_mesh(obj_filename, cache_folder=None):
+    """
+    Load a LOD2 mesh, from the cache if it has been cached from the current version of the OBJ file.
+
+    Parameters
+    ----------
+    obj_filename : string
+        Full path and filename of the .obj file
+    cache_folder : string
+        Folder of the mesh cache, or None to always parse the OBJ file
+
+    Returns
+    -------
+    mesh : trimesh.Trimesh
+        The mesh, loaded without any processing (vertices are not merged)
+    """
+    if cache_folder is None:
+        return read_obj_mesh(obj_filename)
+    cache_filename = get_mesh_cache_filename(cache_folder, obj_filename)
+    source_signature = get_source_signature(obj_filename)
+    if os.path.exists(cache_filename) == True:
+        with np.load(cache_filename) as cached_mesh:
+            if np.array_equal(cached_mesh['source'], source_signature) == True:
+                return trimesh.Trimesh(vertices=cached_mesh['vertices'], faces=cached_mesh['faces'], vertex_normals=cached_mesh['vertex_normals'], process=False)
+    mesh = read_obj_mesh(obj_filename)
+    write_mesh_cache(mesh, cache_filename, source_signature)
+    return mesh
+
+
+def read_obj_mesh(obj_filename):
+    """
+    Parse an OBJ file into a single mesh.
+    """
+    return trimesh.load(obj_filename, process=False, force="mesh", skip_materials=True, skip_texture=True)
+
+
+def write_mesh_cache(mesh, cache_filename, source_signature):
+    """
+    Write a mesh into the cache. The archive is written into a temporary file first, so that an interrupted run, or another process reading the cache, never sees a partial archive.
+    """
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    temporary_filename = cache_filename + ".%d.tmp" % os.getpid()
+    with open(temporary_filename, 'wb') as cache_file:
+        np.savez(cache_file,
+                 vertices=np.asarray(mesh.vertices, dtype=np.float64),
+                 faces=np.asarray(mesh.faces, dtype=np.int64),
+                 vertex_normals=np.asarray(mesh.vertex_normals, dtype=np.float64),
+                 source=source_signature)
+    os.replace(temporary_filename, cache_filename)
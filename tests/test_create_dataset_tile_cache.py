@@ -0,0 +1,63 @@
+import os
+import sys
+import numpy as np
+import laspy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts"))
+import create_dataset_tile_cache as tilecache
+
+
+def write_test_tile(tmp_path, point_count=2000, size=100.0):
+    rng = np.random.default_rng(0)
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = [0.001, 0.001, 0.001]
+    header.offsets = [1000.0, 2000.0, 0.0]
+    las = laspy.LasData(header)
+    las.x = 1000.0 + rng.uniform(0, size, point_count)
+    las.y = 2000.0 + rng.uniform(0, size, point_count)
+    las.z = rng.uniform(0, 10, point_count)
+    input_file = str(tmp_path / "tile.las")
+    las.write(input_file)
+    cache_folder = str(tmp_path / "cache" / "tile.las")
+    tilecache.write_tile_cache(input_file, cache_folder)
+    return tilecache.load_tile_cache(cache_folder)
+
+
+def get_range_point_count(point_ranges):
+    return sum(last_point - first_point for first_point, last_point in point_ranges)
+
+
+def test_bbox_outside_grid_returns_no_ranges(tmp_path):
+    tile_cache = write_test_tile(tmp_path)
+    # North-east, west, south and far outside of the 100 m tile
+    assert tilecache.get_tile_cache_point_ranges(tile_cache, [1200, 2000, 1300, 2100]) == []
+    assert tilecache.get_tile_cache_point_ranges(tile_cache, [1000, 2200, 1100, 2300]) == []
+    assert tilecache.get_tile_cache_point_ranges(tile_cache, [800, 2000, 900, 2100]) == []
+    assert tilecache.get_tile_cache_point_ranges(tile_cache, [1000, 1800, 1100, 1900]) == []
+
+
+def test_bbox_partly_outside_grid_is_clamped(tmp_path):
+    tile_cache = write_test_tile(tmp_path)
+    point_count = tile_cache['meta']['point_count']
+    assert get_range_point_count(tilecache.get_tile_cache_point_ranges(tile_cache, [900, 1900, 1200, 2200])) == point_count
+    x = np.asarray(tile_cache['x'])
+    y = np.asarray(tile_cache['y'])
+    query_bbox = [950, 2050, 1020, 2150]
+    point_ranges = tilecache.get_tile_cache_point_ranges(tile_cache, query_bbox)
+    selected = np.zeros(point_count, dtype=bool)
+    for first_point, last_point in point_ranges:
+        selected[first_point:last_point] = True
+    inside = (x >= query_bbox[0]) & (x <= query_bbox[2]) & (y >= query_bbox[1]) & (y <= query_bbox[3])
+    assert np.all(selected[inside])
+
+
+def test_points_are_sorted_by_cell_across_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(tilecache, "read_chunk_size", 300)
+    tile_cache = write_test_tile(tmp_path)
+    meta = tile_cache['meta']
+    las = laspy.read(str(tmp_path / "tile.las"))
+    cell_x = ((np.asarray(las.x) - meta['grid_origin'][0]) / meta['grid_cell_size']).astype(np.int64)
+    cell_y = ((np.asarray(las.y) - meta['grid_origin'][1]) / meta['grid_cell_size']).astype(np.int64)
+    point_order = np.argsort(cell_y * meta['grid_shape'][0] + cell_x, kind='stable')
+    assert np.array_equal(np.asarray(tile_cache['x']), np.asarray(las.x)[point_order])
+    assert np.array_equal(np.asarray(tile_cache['y']), np.asarray(las.y)[point_order])
@@ -0,0 +1,217 @@
+import os
+import sys
+import io
+import contextlib
+import importlib.util
+import pytest
+from shapely.geometry import LineString
+
+scripts_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts")
+footprints_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Data", "Footprints")
+sys.path.insert(0, scripts_path)
+import footprint_table as footprinttable
+
+# The script name starts with a number, so it can not be imported by name
+module_spec = importlib.util.spec_from_file_location("polygon_expansion", os.path.join(scripts_path, "02_polygon_expansion.py"))
+polygonexpansion = importlib.util.module_from_spec(module_spec)
+module_spec.loader.exec_module(polygonexpansion)
+
+UNDILATED_FOOTPRINT_FILES = ["footprint_polygons_0m_dilation.txt", "test_footprint_0m_dilation.txt"]
+DILATED_FOOTPRINT_FILES   = ["footprint_polygons_1_9m_dilation.txt", "test_footprint_2_0m_dilation.txt"]
+
+
+def remove_self_intersections_reference(input_x, input_y):
+    """
+    Original implementation of 'remove_self_intersections()', which checks every edge pair with Shapely, and starts over after each clipped loop.
+    Kept here only as the oracle the sort-and-sweep implementation is compared against.
+
+    Go through the input polygon, and see if any of the edges get intersected by the other edges.
+    If intersections are found, create a new node in the intersection point, and erase all nodes in between.
+    NOTE: if the check starts inside a loop, e.g. a building exterior corners that are under 180 degrees, the loop might be preserved, while the rest of the building is erased!
+    """
+    
+    input_x, input_y = polygonexpansion.remove_duplicate_nodes(input_x, input_y)    
+    
+    #print("input length: %d" % len(input_x))
+    if len(input_x) > 8:
+        # Move the starting point of the polygon until 5 successive edges can be found without 3-edge intersections, and set the middle one as the first edge.
+        # Looking at the actual polygons, there are several corners that are more than 3 edges long, leading to that long list of tests below...
+        for node_number in range(4, len(input_x)-4):
+            edge_0 = LineString( [(input_x[node_number-4], input_y[node_number-4]), (input_x[node_number-3], input_y[node_number-3])] )
+            edge_1 = LineString( [(input_x[node_number-3], input_y[node_number-3]), (input_x[node_number-2], input_y[node_number-2])] )
+            edge_2 = LineString( [(input_x[node_number-2], input_y[node_number-2]), (input_x[node_number-1], input_y[node_number-1])] )
+            edge_3 = LineString( [(input_x[node_number-1], input_y[node_number-1]), (input_x[node_number],   input_y[node_number])] )
+            edge_4 = LineString( [(input_x[node_number],   input_y[node_number]),   (input_x[node_number+1], input_y[node_number+1])] )
+            edge_5 = LineString( [(input_x[node_number+1], input_y[node_number+1]), (input_x[node_number+2], input_y[node_number+2])] )
+            edge_6 = LineString( [(input_x[node_number+2], input_y[node_number+2]), (input_x[node_number+3], input_y[node_number+3])] )
+            if edge_0.intersects(edge_2) == True:
+                continue
+            if edge_0.intersects(edge_3) == True:
+                continue
+            if edge_0.intersects(edge_4) == True:
+                continue
+            if edge_0.intersects(edge_5) == True:
+                continue
+            if edge_0.intersects(edge_6) == True:
+                continue
+            
+            if edge_1.intersects(edge_3) == True:
+                continue
+            if edge_1.intersects(edge_4) == True:
+                continue
+            if edge_1.intersects(edge_5) == True:
+                continue
+            if edge_1.intersects(edge_6) == True:
+                continue
+            
+            if edge_2.intersects(edge_4) == True:
+                continue
+            if edge_2.intersects(edge_5) == True:
+                continue
+            if edge_2.intersects(edge_6) == True:
+                continue
+            
+            if edge_3.intersects(edge_5) == True:
+                continue
+            if edge_3.intersects(edge_6) == True:
+                continue
+            
+            if edge_4.intersects(edge_6) == True:
+                continue
+            
+            # No intersection was found, select node[node_number] as the starting node, and modify the coordinate lists accordingly
+            #print("Moving polygon start point to node_number %d" % node_number)
+            tmp_x = input_x[:node_number]
+            input_x = input_x[node_number:] + tmp_x
+            tmp_y = input_y[:node_number]
+            input_y = input_y[node_number:] + tmp_y
+            break
+
+    # Loop through the polygon, simplifying it        
+    found_intersection = True
+    intersection_point = []
+    first_clip_node_number = -1
+    last_clip_node_number = -1
+    while found_intersection == True:
+        #print("loop_start: 'found_intersection':", found_intersection)
+        found_intersection = False
+        for node_number in range(len(input_x)-1):
+            if found_intersection == True:
+                break
+            current_edge = LineString( [(input_x[node_number], input_y[node_number]), (input_x[node_number+1], input_y[node_number+1])] )
+            for test_node_number in range(len(input_x)-1):
+                if test_node_number >= node_number-1 and test_node_number <= node_number+1:
+                    continue
+                #print("Testing %d" % test_node_number)
+                test_edge = LineString( [(input_x[test_node_number], input_y[test_node_number]), (input_x[test_node_number+1], input_y[test_node_number+1])] )
+                if test_edge.intersects(current_edge) == True:
+                    # Create a new node at intersection point, and erase the nodes between them (in whichever direction there are less of them)
+                    found_intersection = True
+                    intersection_point = test_edge.intersection(current_edge)
+                    #print("  Found a new loop, trying to remove. node_number=%d, test_node_number=%d" % (node_number, test_node_number) )
+                    diff = abs(test_node_number-node_number)
+                    #print("    Diff: %d, total nodes: %d" % (diff, len(input_x)) )
+                    if diff < (len(input_x)/2.0):
+                        # Most polygon nodes are outside the two nodes (loop is between them)
+                        if node_number < test_node_number:
+                            first_clip_node_number = node_number+1
+                            last_clip_node_number = test_node_number
+                        else:
+                            first_clip_node_number = test_node_number+1
+                            last_clip_node_number = node_number
+                        #print("    --> Erasing between. First clip number=%d,last clip number=%d" % (first_clip_node_number, last_clip_node_number) )
+                        # Create the new node right before the node[first_clip_node_number] (and update the clip numbers)
+                        new_x = intersection_point.x
+                        new_y = intersection_point.y
+                        input_x.insert(first_clip_node_number, new_x)
+                        input_y.insert(first_clip_node_number, new_y)
+                        first_clip_node_number += 1
+                        last_clip_node_number += 1               
+                        input_x = input_x[:first_clip_node_number] + input_x[last_clip_node_number+1:]
+                        input_y = input_y[:first_clip_node_number] + input_y[last_clip_node_number+1:]
+                    else:
+                        # Most polygon nodes are between the two nodes, erasure wraps around
+                        if node_number < test_node_number:
+                            first_clip_node_number = test_node_number # In the end of polygon chain, but first to be deleted
+                            last_clip_node_number = node_number
+                        else:
+                            first_clip_node_number = node_number
+                            last_clip_node_number = test_node_number
+                        #print("    --> Erasing outside. First clip number=%d,last clip number=%d" % (first_clip_node_number, last_clip_node_number) )
+                        # Some issue with the new node creation, fix later. For now, combine loose ends right before returning from the function
+                        first_clip_node_number += 1
+                        input_x = input_x[:first_clip_node_number]
+                        input_x = input_x[last_clip_node_number:] 
+                        input_y = input_y[:first_clip_node_number]
+                        input_y = input_y[last_clip_node_number:]
+                        
+                    break
+    if input_x[0] != input_x[len(input_x)-1]:
+        # Fix for when looping around the polygon
+        input_x.append(input_x[0])
+        input_y.append(input_y[0])  
+        
+    return input_x, input_y
+
+
+def collect_dilated_rings(footprint_filename):
+    """
+    Dilate every polygon of a footprint file, and collect the rings passed to 'remove_self_intersections()'.
+    """
+    rings = []
+    remove_self_intersections = polygonexpansion.remove_self_intersections
+    def record_ring(input_x, input_y):
+        rings.append([list(input_x), list(input_y)])
+        return remove_self_intersections(input_x, input_y)
+    footprints = polygonexpansion.simplify_polygons(footprinttable.load_footprint_table(os.path.join(footprints_path, footprint_filename)))
+    polygonexpansion.init_dilation_worker(footprints)
+    polygonexpansion.remove_self_intersections = record_ring
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for polygon_number in range(len(footprints['names'])):
+                polygonexpansion.dilate_building(polygon_number)
+    finally:
+        polygonexpansion.remove_self_intersections = remove_self_intersections
+    return rings
+
+
+def assert_same_as_reference(input_x, input_y):
+    result_x, result_y = polygonexpansion.remove_self_intersections(list(input_x), list(input_y))
+    reference_x, reference_y = remove_self_intersections_reference(list(input_x), list(input_y))
+    assert result_x == reference_x
+    assert result_y == reference_y
+
+
+@pytest.mark.parametrize("footprint_filename", UNDILATED_FOOTPRINT_FILES)
+def test_dilated_polygons_match_reference(footprint_filename):
+    rings = collect_dilated_rings(footprint_filename)
+    assert len(rings) > 0
+    for input_x, input_y in rings:
+        assert_same_as_reference(input_x, input_y)
+
+
+@pytest.mark.parametrize("footprint_filename", DILATED_FOOTPRINT_FILES)
+def test_footprint_file_polygons_match_reference(footprint_filename):
+    footprints = footprinttable.load_footprint_table(os.path.join(footprints_path, footprint_filename))
+    for building_number in range(len(footprints['names'])):
+        polygon = footprinttable.get_polygon(footprints, building_number)
+        assert_same_as_reference(polygon[:,0].tolist(), polygon[:,1].tolist())
+
+
+# Closed rings, as passed in by the dilation. The first edge becomes the closing edge after 'remove_duplicate_nodes()', and is not checked for intersections.
+@pytest.mark.parametrize("ring", [
+    # Bow tie
+    [[0.0, 0.0], [10.0, 0.0], [0.0, 10.0], [10.0, 10.0], [0.0, 0.0]],
+    # Small loop on an edge, as left by dilating both edges of a concave corner
+    [[0.0, 0.0], [20.0, 0.0], [20.0, 10.0], [8.0, 10.0], [10.0, 12.0], [12.0, 8.0], [0.0, 10.0], [0.0, 0.0]],
+    # Two loops on the same side
+    [[0.0, 0.0], [30.0, 0.0], [30.0, 10.0], [20.0, 10.0], [22.0, 12.0], [24.0, 8.0], [12.0, 10.0], [8.0, 10.0], [10.0, 12.0], [12.0, 8.0], [0.0, 10.0], [0.0, 0.0]],
+    # Loop spanning most of the nodes, so that the clipping wraps around the start of the ring
+    [[0.0, 0.0], [10.0, 0.0], [10.0, 1.0], [1.0, 1.0], [1.0, 9.0], [10.0, 9.0], [10.0, 10.0], [0.0, 10.0], [-1.0, 5.0], [2.0, -2.0], [5.0, -1.0]],
+    # Longer ring (more than 8 nodes) with a loop near the end, so that the start node is moved
+    [[0.0, 0.0], [16.0, 0.0], [16.0, 6.0], [16.0, 12.0], [12.0, 12.0], [8.0, 12.0], [4.0, 12.0], [0.0, 12.0], [0.0, 8.0], [0.0, 6.0], [0.0, 4.0], [1.0, 2.0], [1.0, 3.0], [-1.0, 1.0], [0.0, 0.0]],
+    # Rectangle without self-intersections
+    [[0.0, 0.0], [10.0, 0.0], [10.0, 5.0], [0.0, 5.0], [0.0, 0.0]],
+])
+def test_hand_made_rings_match_reference(ring):
+    assert_same_as_reference([node[0] for node in ring], [node[1] for node in ring])